@@ -1,67 +1,334 @@
 # -*- coding: utf-8 -*-
 """API endpoints for the Trilium Knowledge Agent."""
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from typing import Dict, Any
+import asyncio
+import json
+import threading
+import time
 
-from app.api.schemas import QuestionRequest, AnswerResponse
-from app.core.config import get_config
-from app.core.llm_service import LLMService
-from app.core.knowledge_base import KnowledgeBase
+from app.api.schemas import AnswerResponse, BatchQuestionRequest, QuestionRequest
+from app.core.inference_executor import (
+    ExecutorSaturatedError,
+    InferenceExecutor,
+    QueueTimeoutError
+)
+from app.core.llm_service import GenerationCancelled
+from app.core.metrics import QUERY_STAGE_SECONDS, REQUEST_SECONDS, record_answer
 from app.core.qa_service import QAService
+from app.core.service_container import ServiceContainer
 
 router = APIRouter()
 
 
-def get_qa_service():
-    """获取问答服务实例."""
-    config = get_config()
-    llm_service = LLMService(config)
-    knowledge_base = KnowledgeBase(config)
-    qa_service = QAService(config, llm_service, knowledge_base)
-    return qa_service
+def get_service_container(request: Request) -> ServiceContainer:
+    """获取在应用生命周期中创建的服务容器."""
+    container = getattr(request.app.state, "service_container", None)
+    if container is None:
+        raise HTTPException(status_code=503, detail="服务容器尚未初始化")
+    return container
+
+
+def get_qa_service(container: ServiceContainer = Depends(get_service_container)) -> QAService:
+    """获取共享的问答服务实例."""
+    return container.get_qa_service()
+
+
+def _response_timings(container: ServiceContainer, result: Dict[str, Any]):
+    """按配置决定是否在响应中返回各阶段耗时."""
+    return result.get("timings") if container.config.response_timings else None
+
+
+def get_inference_executor(
+    container: ServiceContainer = Depends(get_service_container)
+) -> InferenceExecutor:
+    """获取共享的推理执行器."""
+    return container.executor
 
 
 @router.post("/ask", response_model=AnswerResponse)
-async def ask_question(request: QuestionRequest) -> AnswerResponse:
+async def ask_question(
+    request: QuestionRequest,
+    qa_service: QAService = Depends(get_qa_service),
+    executor: InferenceExecutor = Depends(get_inference_executor),
+    container: ServiceContainer = Depends(get_service_container)
+) -> Response:
     """Ask a question based on the knowledge base.
     
     Args:
         request: The question request.
+        qa_service: The shared QA service.
+        executor: The bounded inference executor.
+        container: The process-wide service container.
         
     Returns:
         The answer response with sources.
     """
-    # 实现实际的问答逻辑
-    qa_service = get_qa_service()
-    result = qa_service.ask_question(request.question)
+    started = time.perf_counter()
+    # 在推理执行器中运行阻塞的问答逻辑，避免阻塞事件循环
+    try:
+        result, queue_wait = await executor.run(
+            qa_service.ask_question,
+            request.question,
+            subtree=request.subtree,
+            labels=request.labels,
+            session_id=request.session_id
+        )
+    except (ExecutorSaturatedError, QueueTimeoutError) as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
     
-    # 确保返回的数据符合AnswerResponse模型
-    return AnswerResponse(
+    # 确保返回的数据符合AnswerResponse模型；在这里序列化以便统计序列化耗时
+    start = time.perf_counter()
+    body = AnswerResponse(
         answer=result["answer"],
-        sources=result.get("sources", [])
+        sources=result.get("sources", []),
+        retrieval_k=result.get("retrieval_k"),
+        queue_wait_ms=round(queue_wait * 1000, 2),
+        prompt_tokens=result.get("prompt_tokens"),
+        cache=result.get("cache"),
+        timings=_response_timings(container, result)
+    ).model_dump_json()
+    QUERY_STAGE_SECONDS.observe(time.perf_counter() - start, stage="serialize")
+    record_answer("ask", result, time.perf_counter() - started)
+    return Response(content=body, media_type="application/json")
+
+
+def _format_sse(event: str, data: Any) -> str:
+    """将事件编码为Server-Sent Events格式."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post("/ask/stream")
+async def ask_question_stream(
+    request: QuestionRequest,
+    http_request: Request,
+    qa_service: QAService = Depends(get_qa_service),
+    executor: InferenceExecutor = Depends(get_inference_executor),
+    container: ServiceContainer = Depends(get_service_container)
+) -> StreamingResponse:
+    """Ask a question and stream the answer as Server-Sent Events.
+    
+    Emits a ``sources`` event right after retrieval, one ``token`` event per
+    generated token and a final ``done`` (or ``error``) event. Generation is
+    cancelled as soon as the client disconnects.
+    
+    Args:
+        request: The question request.
+        http_request: The raw HTTP request, used to detect disconnects.
+        qa_service: The shared QA service.
+        executor: The bounded inference executor.
+        container: The process-wide service container.
+        
+    Returns:
+        A text/event-stream response.
+    """
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    cancelled = threading.Event()
+    
+    def emit(event: str, data: Any) -> None:
+        if not cancelled.is_set():
+            loop.call_soon_threadsafe(queue.put_nowait, (event, data))
+    
+    try:
+        future = executor.submit(
+            qa_service.stream_answer,
+            request.question,
+            emit,
+            cancelled.is_set,
+            subtree=request.subtree,
+            labels=request.labels,
+            session_id=request.session_id
+        )
+    except ExecutorSaturatedError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    # 任务结束（包括异常）后放入结束标记
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(queue.put_nowait, (None, None)))
+    
+    async def event_stream():
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    if await http_request.is_disconnected():
+                        break
+                    # 保持连接，避免代理在长时间预填充期间断开
+                    yield ": keep-alive\n\n"
+                    continue
+                
+                if event is None:
+                    try:
+                        result, queue_wait = future.result()
+                    except GenerationCancelled:
+                        break
+                    except Exception as e:
+                        yield _format_sse("error", {"detail": str(e)})
+                        break
+                    yield _format_sse("done", {
+                        "answer": result["answer"],
+                        "retrieval_k": result.get("retrieval_k"),
+                        "queue_wait_ms": round(queue_wait * 1000, 2),
+                        "prompt_tokens": result.get("prompt_tokens"),
+                        "cache": result.get("cache"),
+                        "timings": _response_timings(container, result)
+                    })
+                    record_answer("ask_stream", result, time.perf_counter() - started)
+                    break
+                
+                yield _format_sse(event, data)
+        finally:
+            # 客户端断开或流结束时通知生成线程停止
+            cancelled.set()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 
+@router.post("/ask/batch")
+async def ask_question_batch(
+    request: BatchQuestionRequest,
+    http_request: Request,
+    qa_service: QAService = Depends(get_qa_service),
+    executor: InferenceExecutor = Depends(get_inference_executor),
+    container: ServiceContainer = Depends(get_service_container)
+) -> StreamingResponse:
+    """Answer a batch of questions and stream the results as NDJSON.
+    
+    All questions are embedded in one encoder call and searched together;
+    retrieval for the next question overlaps generation of the current one.
+    Each output line is one answer, in request order, carrying its ``index``
+    and ``question``. The whole batch occupies a single inference slot.
+    
+    Args:
+        request: The batch request.
+        http_request: The raw HTTP request, used to detect disconnects.
+        qa_service: The shared QA service.
+        executor: The bounded inference executor.
+        container: The process-wide service container.
+        
+    Returns:
+        An application/x-ndjson response.
+    """
+    started = time.perf_counter()
+    max_questions = container.config.batch_max_questions
+    if len(request.questions) > max_questions:
+        raise HTTPException(status_code=413, detail=f"每个请求最多 {max_questions} 个问题")
+    
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    cancelled = threading.Event()
+    
+    def on_result(result: Dict[str, Any]) -> None:
+        record_answer("ask_batch", result)
+        if not container.config.response_timings:
+            result = {key: value for key, value in result.items() if key != "timings"}
+        if not cancelled.is_set():
+            loop.call_soon_threadsafe(queue.put_nowait, result)
+    
+    try:
+        future = executor.submit(
+            qa_service.ask_batch,
+            request.questions,
+            on_result,
+            cancelled.is_set,
+            subtree=request.subtree,
+            labels=request.labels
+        )
+    except ExecutorSaturatedError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(queue.put_nowait, None))
+    
+    async def result_stream():
+        try:
+            while True:
+                try:
+                    result = await asyncio.wait_for(queue.get(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    if await http_request.is_disconnected():
+                        break
+                    continue
+                
+                if result is None:
+                    try:
+                        future.result()
+                    except GenerationCancelled:
+                        pass
+                    except Exception as e:
+                        yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+                    REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="ask_batch")
+                    break
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            cancelled.set()
+    
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+
 @router.get("/status")
-async def get_status() -> Dict[str, Any]:
+async def get_status(
+    container: ServiceContainer = Depends(get_service_container)
+) -> Dict[str, Any]:
     """Get the status of the knowledge agent.
     
+    Args:
+        container: The process-wide service container.
+        
     Returns:
         Status information.
     """
-    config = get_config()
-    qa_service = get_qa_service()
+    config = container.config
+    # 只读取已缓存的组件状态，不会实例化任何服务
+    component_status = container.status()
     
     status_info = {
         "status": "running",
         "trilium_base_url": config.trilium_base_url,
         "embedding_model": config.embedding_model,
-        "initialization_errors": []
+        "initialization_errors": component_status.pop("initialization_errors")
     }
+    status_info.update(component_status)
     
-    # 添加初始化错误信息（如果有）
-    if hasattr(qa_service, 'init_errors') and qa_service.init_errors:
-        status_info["initialization_errors"] = qa_service.init_errors
+    return status_info
+
+
+@router.post("/reindex")
+async def trigger_reindex(
+    container: ServiceContainer = Depends(get_service_container)
+) -> Dict[str, Any]:
+    """Start a background incremental reindex.
     
-    return status_info
\ No newline at end of file
+    If a reindex is already running, the request is coalesced into one
+    follow-up run. Queries keep using the current index meanwhile.
+    
+    Args:
+        container: The process-wide service container.
+        
+    Returns:
+        Whether a new job was started and the reindex status.
+    """
+    started = container.reindexer.request()
+    return {"started": started, **container.reindexer.status()}
+
+
+@router.post("/reload")
+async def reload_services(
+    container: ServiceContainer = Depends(get_service_container)
+) -> Dict[str, Any]:
+    """Reload configuration and rebuild all service components.
+    
+    Args:
+        container: The process-wide service container.
+        
+    Returns:
+        Component status after the reload.
+    """
+    await run_in_threadpool(container.reload)
+    return container.status()
\ No newline at end of file
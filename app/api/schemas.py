@@ -2,12 +2,26 @@
 """用于API请求/响应验证的Pydantic模型."""
 
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 
 class QuestionRequest(BaseModel):
     """用于提问的请求模型."""
     question: str
+    # 只在这些笔记的子树中检索
+    subtree: Optional[List[str]] = None
+    # 只检索带有全部这些标签的笔记
+    labels: Optional[List[str]] = None
+    # 会话ID，同一会话的问题共享对话记忆；为空时不使用记忆
+    session_id: Optional[str] = None
+
+
+class BatchQuestionRequest(BaseModel):
+    """用于批量提问的请求模型."""
+    questions: List[str]
+    # 过滤条件对所有问题生效
+    subtree: Optional[List[str]] = None
+    labels: Optional[List[str]] = None
 
 
 class SourceDocument(BaseModel):
@@ -16,9 +30,18 @@ class SourceDocument(BaseModel):
     content: Optional[str] = None
     title: Optional[str] = None
     url: Optional[str] = None
+    score: Optional[float] = None
 
 
 class AnswerResponse(BaseModel):
     """回答问题的响应模型."""
     answer: str
-    sources: Optional[List[SourceDocument]] = None
\ No newline at end of file
+    sources: Optional[List[SourceDocument]] = None
+    retrieval_k: Optional[int] = None
+    queue_wait_ms: Optional[float] = None
+    # 提示（含模板、上下文和问题）的token数
+    prompt_tokens: Optional[int] = None
+    # 命中答案缓存时为 exact 或 semantic
+    cache: Optional[str] = None
+    # 各阶段耗时（毫秒）
+    timings: Optional[Dict[str, float]] = None
\ No newline at end of file
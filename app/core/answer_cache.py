@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""按问题文本和问题向量命中的语义答案缓存."""
+
+import hashlib
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# 尝试导入numpy，用于批量计算余弦相似度
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+# 问题末尾不影响语义的标点
+_TRAILING_PUNCTUATION = "?？!！。.，,;；~～ "
+
+
+def normalize_question(question: str) -> str:
+    """规范化问题文本：Unicode规范化、忽略大小写、合并空白并去除末尾标点.
+
+    Args:
+        question: 原始问题.
+
+    Returns:
+        规范化后的问题.
+    """
+    text = unicodedata.normalize("NFKC", question).casefold()
+    return _WHITESPACE_PATTERN.sub(" ", text).strip().rstrip(_TRAILING_PUNCTUATION)
+
+
+class _Entry:
+    """一条缓存的答案."""
+
+    __slots__ = ("question", "scope", "vector", "norm", "result", "created_at")
+
+    def __init__(self, question: str, scope: str, vector: Optional[List[float]], result: Dict[str, Any]) -> None:
+        self.question = question
+        self.scope = scope
+        self.vector = vector
+        self.norm = math.sqrt(sum(x * x for x in vector)) if vector else 0.0
+        self.result = result
+        self.created_at = time.monotonic()
+
+
+class AnswerCache:
+    """位于 QAService.ask_question 之前的答案缓存.
+
+    先按规范化问题的哈希精确匹配，未命中时再与缓存中的问题向量比较余弦相似度，
+    超过阈值即视为同一问题；只有检索范围（子树和标签过滤）相同的条目才会命中。
+    条目绑定索引版本，索引变化后整个缓存失效；
+    按最近使用顺序淘汰并限制条目数，过期条目在访问时删除。
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 3600,
+                 similarity_threshold: float = 0.95) -> None:
+        """初始化答案缓存.
+
+        Args:
+            max_entries: 最多缓存的答案数.
+            ttl_seconds: 条目有效期秒数，0表示不过期.
+            similarity_threshold: 语义命中所需的最小余弦相似度，大于等于1表示只做精确匹配.
+        """
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.index_version: Optional[int] = None
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(question: str, scope: str = "") -> str:
+        """计算检索范围和规范化问题的哈希."""
+        return hashlib.sha256(f"{scope}\0{normalize_question(question)}".encode("utf-8")).hexdigest()
+
+    def _check_version(self, index_version: int) -> None:
+        """索引版本变化时清空缓存（调用方需持有锁）."""
+        if self.index_version != index_version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.index_version = index_version
+
+    def _expired(self, entry: _Entry) -> bool:
+        """判断条目是否过期."""
+        return bool(self.ttl_seconds) and time.monotonic() - entry.created_at > self.ttl_seconds
+
+    def _most_similar(self, vector: List[float], scope: str = "") -> Tuple[Optional[str], float]:
+        """返回同一检索范围内与给定向量最相似的条目（调用方需持有锁）."""
+        keys = [
+            key for key, entry in self._entries.items()
+            if entry.vector and entry.norm and entry.scope == scope
+        ]
+        if not keys or not vector:
+            return None, 0.0
+        if np is not None:
+            matrix = np.asarray([self._entries[key].vector for key in keys], dtype=np.float32)
+            query = np.asarray(vector, dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+            similarities = matrix @ query / np.where(norms == 0, 1.0, norms)
+            best = int(np.argmax(similarities))
+            return keys[best], float(similarities[best])
+
+        query_norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        best_key, best_score = None, 0.0
+        for key in keys:
+            entry = self._entries[key]
+            score = sum(a * b for a, b in zip(entry.vector, vector)) / (entry.norm * query_norm)
+            if score > best_score:
+                best_key, best_score = key, score
+        return best_key, best_score
+
+    def lookup(self, question: str, index_version: int,
+               embed: Callable[[str], List[float]],
+               scope: str = "") -> Tuple[Optional[Dict[str, Any]], Optional[str], Optional[List[float]]]:
+        """查找缓存的答案.
+
+        Args:
+            question: 用户问题.
+            index_version: 当前索引版本.
+            embed: 计算问题向量的函数，只有精确匹配未命中时才会调用.
+            scope: 检索范围，空字符串表示整个知识库.
+
+        Returns:
+            (缓存的结果, 命中类型 exact/semantic, 问题向量)；未命中时结果为None，
+            返回的问题向量可在写入缓存和检索时复用.
+        """
+        key = self._key(question, scope)
+        with self._lock:
+            self._check_version(index_version)
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry.result, "exact", entry.vector
+
+        vector = embed(question)
+        if self.similarity_threshold < 1:
+            with self._lock:
+                if self.index_version == index_version:
+                    best_key, score = self._most_similar(vector, scope)
+                    if best_key is not None and score >= self.similarity_threshold:
+                        entry = self._entries[best_key]
+                        if self._expired(entry):
+                            del self._entries[best_key]
+                            self.expirations += 1
+                        else:
+                            self._entries.move_to_end(best_key)
+                            self.semantic_hits += 1
+                            return entry.result, "semantic", vector
+        with self._lock:
+            self.misses += 1
+        return None, None, vector
+
+    def put(self, question: str, index_version: int, vector: Optional[List[float]],
+            result: Dict[str, Any], scope: str = "") -> None:
+        """缓存一个答案.
+
+        Args:
+            question: 用户问题.
+            index_version: 生成答案时的索引版本.
+            vector: 问题向量.
+            result: 问答结果.
+            scope: 检索范围，空字符串表示整个知识库.
+        """
+        key = self._key(question, scope)
+        with self._lock:
+            self._check_version(index_version)
+            self._entries[key] = _Entry(question, scope, vector, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """清空缓存."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中率统计."""
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            total = hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "index_version": self.index_version,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / total, 4) if total else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "similarity_threshold": self.similarity_threshold,
+            }
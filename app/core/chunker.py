@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""按笔记结构和嵌入模型token数切分文本块."""
+
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# 尝试导入langchain组件
+try:
+    from langchain.docstore.document import Document
+except ImportError:
+    Document = None
+
+# 没有分词器时的近似切分：每个CJK字符、每个单词、每个标点各算一个token
+_CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_APPROX_TOKEN_PATTERN = re.compile(rf"[{_CJK_RANGES}]|[^\W{_CJK_RANGES}]+|[^\w\s]")
+# Markdown标题行；整理上下文时也用它识别文本块开头重复的章节标题
+HEADING_PATTERN = re.compile(r"^#{1,6} \S")
+_SENTENCE_PATTERN = re.compile(r"(?<=[。！？；!?;])|(?<=[.:])\s+")
+
+# 需要按标题、段落和代码块切分的内容类型；其余（代码笔记等）按行切分
+STRUCTURED_MIME_TYPES = {None, "", "text/html", "text/markdown"}
+
+
+class TokenCounter:
+    """使用嵌入模型的分词器统计token并在token边界处切分文本.
+
+    分词器不支持偏移映射或不可用时退化为基于正则的近似切分。
+    """
+
+    def __init__(self, tokenizer=None) -> None:
+        """初始化token计数器.
+
+        Args:
+            tokenizer: HuggingFace分词器，为空时使用近似切分.
+        """
+        self.tokenizer = tokenizer
+        self.exact = bool(tokenizer is not None and getattr(tokenizer, "is_fast", False))
+
+    def offsets(self, text: str) -> List[Tuple[int, int]]:
+        """返回每个token在文本中的字符区间."""
+        if self.exact:
+            encoded = self.tokenizer(
+                text,
+                add_special_tokens=False,
+                return_offsets_mapping=True,
+                truncation=False
+            )
+            return [tuple(span) for span in encoded["offset_mapping"]]
+        return [match.span() for match in _APPROX_TOKEN_PATTERN.finditer(text)]
+
+    def count(self, text: str) -> int:
+        """统计文本的token数."""
+        if self.exact:
+            return len(self.tokenizer(text, add_special_tokens=False, truncation=False)["input_ids"])
+        return sum(1 for _ in _APPROX_TOKEN_PATTERN.finditer(text))
+
+    def split(self, text: str, max_tokens: int) -> List[str]:
+        """在token边界处把文本切成不超过 max_tokens 的片段."""
+        spans = self.offsets(text)
+        pieces = []
+        for start in range(0, len(spans), max_tokens):
+            window = spans[start:start + max_tokens]
+            begin = window[0][0] if start else 0
+            end = spans[start + max_tokens][0] if start + max_tokens < len(spans) else len(text)
+            piece = text[begin:end].strip()
+            if piece:
+                pieces.append(piece)
+        return pieces
+
+    def tail(self, text: str, max_tokens: int) -> str:
+        """返回文本末尾不超过 max_tokens 个token的部分."""
+        if max_tokens <= 0:
+            return ""
+        spans = self.offsets(text)
+        if len(spans) <= max_tokens:
+            return text
+        return text[spans[-max_tokens][0]:].strip()
+
+
+class ChunkStats:
+    """记录导入过程中文本块的token长度分布."""
+
+    def __init__(self, max_tokens: int) -> None:
+        """初始化统计.
+
+        Args:
+            max_tokens: 文本块的token上限.
+        """
+        self.max_tokens = max_tokens
+        self.reset()
+
+    def reset(self) -> None:
+        """清空统计."""
+        self.lengths: List[int] = []
+
+    def record(self, tokens: int) -> None:
+        """记录一个文本块的token数."""
+        self.lengths.append(tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回文本块长度统计."""
+        lengths = sorted(self.lengths)
+        if not lengths:
+            return {"chunks": 0, "max_tokens": self.max_tokens}
+
+        def percentile(p: float) -> int:
+            return lengths[min(len(lengths) - 1, int(p * len(lengths)))]
+
+        return {
+            "chunks": len(lengths),
+            "max_tokens": self.max_tokens,
+            "min": lengths[0],
+            "mean": round(sum(lengths) / len(lengths), 1),
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "max": lengths[-1],
+            "over_limit": sum(1 for length in lengths if length > self.max_tokens),
+        }
+
+
+class StructureAwareChunker:
+    """按标题、段落和代码块切分文本，并按嵌入模型的token数控制块大小.
+
+    相邻的段落会被合并到同一块中直到达到token上限；每个块都以所在章节的
+    标题开头，新块开头带上上一块末尾 overlap_tokens 个token作为重叠。
+    超长的段落先按句子、再按token边界切分，因此不会有文本被嵌入模型静默截断。
+    """
+
+    def __init__(self, counter: TokenCounter, max_tokens: int = 254, overlap_tokens: int = 32) -> None:
+        """初始化分块器.
+
+        Args:
+            counter: token计数器.
+            max_tokens: 每个文本块的最大token数（不含特殊token）.
+            overlap_tokens: 相邻文本块之间重叠的token数.
+        """
+        self.counter = counter
+        self.max_tokens = max(16, max_tokens)
+        self.overlap_tokens = max(0, min(overlap_tokens, self.max_tokens // 2))
+        self.chunk_stats = ChunkStats(self.max_tokens)
+
+    @staticmethod
+    def _blocks(text: str, structured: bool) -> List[Tuple[str, str]]:
+        """把文本拆分为 (类型, 内容) 块，类型为 heading、code 或 text."""
+        if not structured:
+            return [("code", text)]
+
+        blocks = []
+        paragraph: List[str] = []
+        code: Optional[List[str]] = None
+
+        def flush_paragraph() -> None:
+            if paragraph:
+                blocks.append(("text", "\n".join(paragraph)))
+                paragraph.clear()
+
+        for line in text.split("\n"):
+            if code is not None:
+                code.append(line)
+                if line.strip().startswith("```"):
+                    blocks.append(("code", "\n".join(code)))
+                    code = None
+            elif line.lstrip().startswith("```"):
+                flush_paragraph()
+                code = [line]
+            elif HEADING_PATTERN.match(line):
+                flush_paragraph()
+                blocks.append(("heading", line.strip()))
+            elif not line.strip():
+                flush_paragraph()
+            else:
+                paragraph.append(line)
+        flush_paragraph()
+        if code is not None:
+            blocks.append(("code", "\n".join(code)))
+        return blocks
+
+    def _split_block(self, kind: str, text: str, budget: int) -> List[Tuple[str, int]]:
+        """把超长的块切为不超过 budget 个token的片段.
+
+        代码按行、正文按句子合并，单个行或句子仍然超长时在token边界处硬切。
+        """
+        units = text.split("\n") if kind == "code" else [u for u in _SENTENCE_PATTERN.split(text) if u]
+        joiner = "\n" if kind == "code" else " "
+        pieces: List[Tuple[str, int]] = []
+        current: List[str] = []
+        current_tokens = 0
+        for unit in units:
+            tokens = self.counter.count(unit)
+            if tokens > budget:
+                if current:
+                    pieces.append((joiner.join(current), current_tokens))
+                split = self.counter.split(unit, budget)
+                pieces.extend((piece, self.counter.count(piece)) for piece in split[:-1])
+                # 最后一段可以继续与后面的句子合并
+                current = split[-1:]
+                current_tokens = self.counter.count(current[0]) if current else 0
+                continue
+            if current and current_tokens + tokens > budget:
+                pieces.append((joiner.join(current), current_tokens))
+                current, current_tokens = [], 0
+            current.append(unit)
+            current_tokens += tokens
+        if current:
+            pieces.append((joiner.join(current), current_tokens))
+        return [(piece.strip(), tokens) for piece, tokens in pieces if piece.strip()]
+
+    def split_text(self, text: str, structured: bool = True) -> List[str]:
+        """切分一篇笔记的文本.
+
+        Args:
+            text: 规范化后的笔记文本.
+            structured: 是否按标题、段落和代码块切分；代码笔记应为False.
+
+        Returns:
+            文本块列表.
+        """
+        chunks: List[str] = []
+        heading: Optional[Tuple[str, int]] = None
+        body: List[Tuple[str, int]] = []
+        prefix: List[Tuple[str, int]] = []
+
+        def emit() -> None:
+            nonlocal body, prefix
+            if not body:
+                return
+            units = prefix + body
+            chunks.append("\n\n".join(unit for unit, _ in units))
+            self.chunk_stats.record(sum(tokens for _, tokens in units))
+            # 下一块以章节标题和本块末尾的重叠部分开头
+            overlap = self.counter.tail(body[-1][0], self.overlap_tokens) if self.overlap_tokens else ""
+            prefix = [heading] if heading else []
+            if overlap:
+                prefix.append((overlap, self.counter.count(overlap)))
+            body = []
+
+        for kind, block in self._blocks(text, structured):
+            if kind == "heading":
+                tokens = self.counter.count(block)
+                if not body and heading and heading[1] + tokens <= self.max_tokens // 4:
+                    # 连续的标题合并为一个标题路径
+                    heading = (f"{heading[0]}\n{block}", heading[1] + tokens)
+                else:
+                    emit()
+                    heading = (block, tokens) if tokens <= self.max_tokens // 4 else None
+                prefix = [heading] if heading else []
+                continue
+
+            budget = self.max_tokens - (heading[1] if heading else 0)
+            tokens = self.counter.count(block)
+            # 超长块的片段预留重叠部分的空间，使相邻片段之间也有重叠
+            pieces = [(block, tokens)] if tokens <= budget else self._split_block(
+                kind, block, max(1, budget - self.overlap_tokens)
+            )
+            for piece, piece_tokens in pieces:
+                used = sum(t for _, t in prefix) + sum(t for _, t in body)
+                if body and used + piece_tokens > self.max_tokens:
+                    emit()
+                    used = sum(t for _, t in prefix)
+                if used + piece_tokens > self.max_tokens:
+                    # 放不下重叠部分时只保留标题
+                    prefix = [heading] if heading else []
+                body.append((piece, piece_tokens))
+        emit()
+
+        if not chunks and heading:
+            chunks.append(heading[0])
+            self.chunk_stats.record(heading[1])
+        return chunks
+
+    def split_documents(self, documents, structured: bool = True) -> list:
+        """切分文档，文本块继承原文档的元数据.
+
+        Args:
+            documents: Document对象列表.
+            structured: 是否按标题、段落和代码块切分.
+
+        Returns:
+            文本块列表.
+        """
+        chunks = []
+        for document in documents:
+            for text in self.split_text(document.page_content, structured=structured):
+                chunks.append(Document(page_content=text, metadata=dict(document.metadata)))
+        return chunks
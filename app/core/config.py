@@ -18,15 +18,94 @@ class Config:
         self.trilium_token = os.getenv("TRILIUM_TOKEN", "")
         self.trilium_data_dir = os.getenv("TRILIUM_DATA_DIR", "./data/trilium")
         self.note_ids = os.getenv("NOTE_IDS", "root").split(",")
+        # 文档加载方式：etapi 通过HTTP拉取；sqlite 直接只读打开数据目录中的 document.db
+        self.trilium_loader = os.getenv("TRILIUM_LOADER", "etapi").lower()
+        # 数据目录监控配置（变更平息的静默秒数、一批变更的最长等待秒数）
+        self.trilium_watch_enabled = os.getenv("TRILIUM_WATCH_ENABLED", "true").lower() == "true"
+        self.trilium_watch_quiet_period = float(os.getenv("TRILIUM_WATCH_QUIET_SECONDS", "5"))
+        self.trilium_watch_max_delay = float(os.getenv("TRILIUM_WATCH_MAX_DELAY", "60"))
+        # ETAPI增量同步配置（轮询间隔秒数（0为关闭）、每隔多少次轮询做一次完整遍历）
+        self.trilium_sync_interval = float(os.getenv("TRILIUM_SYNC_INTERVAL", "0"))
+        self.trilium_sync_full_scan_every = int(os.getenv("TRILIUM_SYNC_FULL_SCAN_EVERY", "12"))
+        # Trilium拉取配置（并发数、重试次数、退避秒数、每秒请求上限（0为不限）、请求超时）
+        self.trilium_fetch_concurrency = int(os.getenv("TRILIUM_FETCH_CONCURRENCY", "8"))
+        self.trilium_fetch_retries = int(os.getenv("TRILIUM_FETCH_RETRIES", "3"))
+        self.trilium_fetch_backoff = float(os.getenv("TRILIUM_FETCH_BACKOFF", "0.5"))
+        self.trilium_rate_limit = float(os.getenv("TRILIUM_RATE_LIMIT", "0"))
+        self.trilium_timeout = float(os.getenv("TRILIUM_TIMEOUT", "30"))
         
         # 向量数据库配置
         self.vector_db_dir = os.getenv("VECTOR_DB_DIR", "./data/vector_db/embeddings")
+        self.retrieval_k = int(os.getenv("RETRIEVAL_K", "3"))
+        self.index_manifest_path = os.getenv("INDEX_MANIFEST_PATH", "./data/vector_db/index_manifest.json")
+        # 答案缓存配置（最大条目数、有效期秒数（0为不过期）、语义命中的余弦相似度阈值）
+        self.answer_cache_enabled = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+        self.answer_cache_max_entries = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+        self.answer_cache_ttl = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+        self.answer_cache_similarity = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+        # 混合检索配置（倒排索引路径（留空关闭）、CJK字符n-gram长度、每路候选数、RRF常数）
+        self.lexical_index_path = os.getenv("LEXICAL_INDEX_PATH", "./data/vector_db/lexical_index.sqlite3")
+        self.lexical_ngram = int(os.getenv("LEXICAL_NGRAM", "2"))
+        self.hybrid_candidates = int(os.getenv("HYBRID_CANDIDATES", "20"))
+        self.rrf_k = int(os.getenv("RRF_K", "60"))
+        # 交叉编码器重排序配置（模型路径（留空关闭）、候选数、每个请求的打分时间预算毫秒数、批大小）
+        self.rerank_model = os.getenv("RERANK_MODEL", "")
+        self.rerank_candidates = int(os.getenv("RERANK_CANDIDATES", "20"))
+        self.rerank_budget_ms = float(os.getenv("RERANK_BUDGET_MS", "300"))
+        self.rerank_batch_size = int(os.getenv("RERANK_BATCH_SIZE", "32"))
+        # 上下文配置（完整提示的最大token数（0为不限，不超过 llm_n_ctx - llm_max_tokens）、近似重复段落的Jaccard相似度阈值）
+        self.context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1536"))
+        self.context_dedup_threshold = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.85"))
+        # 会话记忆配置（最近几轮问答和滚动摘要的token上限、内存中的最大会话数、
+        # 空闲过期秒数（0为不过期）、SQLite持久化路径（为空时只保存在内存中））
+        self.memory_window_tokens = int(os.getenv("MEMORY_WINDOW_TOKENS", "384"))
+        self.memory_summary_tokens = int(os.getenv("MEMORY_SUMMARY_TOKENS", "128"))
+        self.memory_max_sessions = int(os.getenv("MEMORY_MAX_SESSIONS", "1000"))
+        self.memory_idle_seconds = float(os.getenv("MEMORY_IDLE_SECONDS", "3600"))
+        self.memory_persist_path = os.getenv("MEMORY_PERSIST_PATH", "")
+        # 批量问答配置（每个请求的最大问题数、检索领先生成的问题数）
+        self.batch_max_questions = int(os.getenv("BATCH_MAX_QUESTIONS", "500"))
+        self.batch_prefetch = int(os.getenv("BATCH_PREFETCH", "2"))
+        # 分块配置（每块最大token数，0表示使用嵌入模型的最大序列长度；相邻块重叠的token数）
+        self.chunk_max_tokens = int(os.getenv("CHUNK_MAX_TOKENS", "0"))
+        self.chunk_overlap_tokens = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+        
+        # 导入流水线配置（每批文档数、检查点文件）
+        self.ingest_batch_size = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+        self.ingest_checkpoint_path = os.getenv("INGEST_CHECKPOINT_PATH", "./data/vector_db/ingest_checkpoint.json")
         
         # 嵌入模型配置
         self.embedding_model = os.getenv("EMBEDDING_MODEL", "./data/models/sentence-transformers/all-MiniLM-L6-v2")
+        # 嵌入缓存配置（路径为空时禁用）
+        self.embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH", "./data/vector_db/embedding_cache.sqlite3")
+        self.embedding_cache_max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "500000"))
+        self.embedding_cache_dtype = os.getenv("EMBEDDING_CACHE_DTYPE", "float16")
+        # 批量嵌入配置（每批文本块数、编码进程数，小于2时在当前进程编码）
+        self.embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+        self.embedding_processes = int(os.getenv("EMBEDDING_PROCESSES", "0"))
         
         # 语言模型配置
         self.llm_model_path = os.getenv("LLM_MODEL_PATH", "./data/models/gpt4all/ggml-gpt4all-j-v1.3-groovy.bin")
+        # 推理后端（gpt4all 或 llama_cpp）
+        self.llm_backend = os.getenv("LLM_BACKEND", "gpt4all").strip().lower()
+        # 每个模型实例的推理线程数（0表示自动；多个工作进程时平分CPU核心）、上下文窗口、预填充批大小和最大生成token数
+        self.llm_n_threads = int(os.getenv("LLM_N_THREADS", "0"))
+        self.llm_n_ctx = int(os.getenv("LLM_N_CTX", "2048"))
+        self.llm_n_batch = int(os.getenv("LLM_N_BATCH", "512"))
+        self.llm_max_tokens = int(os.getenv("LLM_MAX_TOKENS", "256"))
+        # 模型工作进程数（大于1时每个进程各加载一个模型实例，权重通过mmap共享）
+        self.llm_workers = int(os.getenv("LLM_WORKERS", "1"))
+        # 缓存提示模板固定前缀的KV状态（仅llama_cpp后端）
+        self.llm_prefix_cache = os.getenv("LLM_PREFIX_CACHE", "true").lower() == "true"
+        
+        # 可观测性配置（是否提供 /metrics、是否在问答响应中返回各阶段耗时）
+        self.metrics_enabled = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+        self.response_timings = os.getenv("RESPONSE_TIMINGS", "true").lower() == "true"
+        
+        # 推理执行器配置
+        self.inference_workers = int(os.getenv("INFERENCE_WORKERS", "1"))
+        self.inference_max_queue = int(os.getenv("INFERENCE_MAX_QUEUE", "8"))
+        self.inference_queue_timeout = float(os.getenv("INFERENCE_QUEUE_TIMEOUT", "120"))
 
 
 def get_config() -> Config:
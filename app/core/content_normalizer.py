@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""将Trilium笔记的HTML内容规范化为适合分块和嵌入的纯文本."""
+
+import re
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional
+
+# 规范化规则的版本，规则变化时递增以触发重新索引
+NORMALIZER_VERSION = 1
+# 内嵌的 data: URI（通常是base64图片），对检索没有价值却会占用大量token
+DATA_URI_PATTERN = re.compile(r"data:[\w.+-]+/[\w.+-]+(?:;[\w-]+=[^;,\s]+)*;base64,[A-Za-z0-9+/=]+")
+# 用于判断内容是否为HTML
+_HTML_TAG_PATTERN = re.compile(r"<(?:[a-zA-Z][\w-]*|/[a-zA-Z]|!--)")
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_BLANK_LINES_PATTERN = re.compile(r"\n{3,}")
+
+# 前后需要换行的块级元素
+_BLOCK_TAGS = {
+    "p", "div", "section", "article", "header", "footer", "blockquote", "figure",
+    "figcaption", "table", "tr", "ul", "ol", "dl", "dt", "dd", "hr", "details", "summary",
+}
+# 内容整体丢弃的元素
+_SKIP_TAGS = {"script", "style", "head", "title", "template", "noscript", "svg"}
+_HEADING_TAGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+
+
+class _TextExtractor(HTMLParser):
+    """单遍的HTML到文本转换器，保留标题、列表、表格和代码块的结构."""
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self._skip_depth = 0
+        self._pre_depth = 0
+        self._pending_fence = False
+        self._lists: List[List[Any]] = []
+        self._cell_index = 0
+
+    def _tail(self) -> str:
+        """返回已输出内容末尾的少量字符."""
+        return "".join(self.parts[-2:])[-2:] if self.parts else "\n\n"
+
+    def _break(self, lines: int = 1) -> None:
+        """确保输出以至少 lines 个换行结束."""
+        tail = self._tail()
+        missing = lines - (len(tail) - len(tail.rstrip("\n")))
+        if missing > 0:
+            self.parts.append("\n" * missing)
+
+    def _flush_fence(self, language: str = "") -> None:
+        """输出代码块的起始标记."""
+        if self._pending_fence:
+            self._pending_fence = False
+            self.parts.append(f"```{language}\n")
+
+    def handle_starttag(self, tag: str, attrs: List) -> None:
+        if tag in _SKIP_TAGS:
+            self._skip_depth += 1
+            return
+        if self._skip_depth:
+            return
+        if tag == "pre":
+            self._break(2)
+            self._pre_depth += 1
+            self._pending_fence = True
+        elif tag == "code" and self._pending_fence:
+            classes = dict(attrs).get("class") or ""
+            match = re.search(r"language-([\w+#-]+)", classes)
+            self._flush_fence(match.group(1) if match else "")
+        elif tag in _HEADING_TAGS:
+            self._break(2)
+            self.parts.append("#" * _HEADING_TAGS[tag] + " ")
+        elif tag in ("ul", "ol"):
+            self._break(1 if self._lists else 2)
+            self._lists.append([tag, 0])
+        elif tag == "li":
+            self._break(1)
+            indent = "  " * max(0, len(self._lists) - 1)
+            if self._lists and self._lists[-1][0] == "ol":
+                self._lists[-1][1] += 1
+                self.parts.append(f"{indent}{self._lists[-1][1]}. ")
+            else:
+                self.parts.append(f"{indent}- ")
+        elif tag == "br":
+            self.parts.append("\n")
+        elif tag == "tr":
+            self._break(1)
+            self._cell_index = 0
+        elif tag in ("td", "th"):
+            if self._cell_index:
+                self.parts.append(" | ")
+            self._cell_index += 1
+        elif tag in _BLOCK_TAGS:
+            self._break(2)
+
+    def handle_startendtag(self, tag: str, attrs: List) -> None:
+        if tag == "br" and not self._skip_depth:
+            self.parts.append("\n")
+        elif tag == "hr" and not self._skip_depth:
+            self._break(2)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in _SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+            return
+        if self._skip_depth:
+            return
+        if tag == "pre" and self._pre_depth:
+            self._flush_fence()
+            self._pre_depth -= 1
+            self._break(1)
+            self.parts.append("```")
+            self._break(2)
+        elif tag in _HEADING_TAGS:
+            self._break(2)
+        elif tag in ("ul", "ol"):
+            if self._lists:
+                self._lists.pop()
+            self._break(1 if self._lists else 2)
+        elif tag in _BLOCK_TAGS:
+            self._break(1 if tag == "tr" else 2)
+
+    def handle_data(self, data: str) -> None:
+        if self._skip_depth or not data:
+            return
+        if self._pre_depth:
+            self._flush_fence()
+            self.parts.append(data)
+            return
+        text = _WHITESPACE_PATTERN.sub(" ", data)
+        if self._tail().endswith(("\n", " ")) or not self.parts:
+            text = text.lstrip()
+        if text:
+            self.parts.append(text)
+
+    def text(self) -> str:
+        """返回转换结果."""
+        return "".join(self.parts)
+
+
+def looks_like_html(content: str) -> bool:
+    """判断内容是否包含HTML标签."""
+    return bool(_HTML_TAG_PATTERN.search(content))
+
+
+def html_to_text(html: str) -> str:
+    """将HTML转换为保留结构提示的纯文本.
+
+    标题转换为 # 前缀，列表项转换为 - 或序号，代码块保留原始空白并用 ``` 包围，
+    实体被解码，脚本、样式和内嵌的 data: URI 被丢弃。
+
+    Args:
+        html: HTML内容.
+
+    Returns:
+        纯文本.
+    """
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return clean_text(parser.text())
+
+
+def clean_text(text: str) -> str:
+    """去除 data: URI 和多余的空行.
+
+    Args:
+        text: 文本.
+
+    Returns:
+        清理后的文本.
+    """
+    text = DATA_URI_PATTERN.sub("", text)
+    lines = [line.rstrip() for line in text.split("\n")]
+    return _BLANK_LINES_PATTERN.sub("\n\n", "\n".join(lines)).strip()
+
+
+class ContentNormalizer:
+    """导入流水线的内容提取阶段，统计规范化前后的字节数."""
+
+    def __init__(self) -> None:
+        """初始化内容规范化器."""
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        """清空字节统计."""
+        self.documents = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def normalize(self, content: str, mime: Optional[str] = None) -> str:
+        """规范化一篇笔记的内容.
+
+        Args:
+            content: 原始内容.
+            mime: 笔记的MIME类型；text/html 或未知类型且内容像HTML时按HTML处理，
+                其余（代码、Markdown等）只去除 data: URI.
+
+        Returns:
+            规范化后的文本.
+        """
+        content = content or ""
+        if mime == "text/html" or (not mime and looks_like_html(content)):
+            text = html_to_text(content)
+        else:
+            text = clean_text(content) if "data:" in content else content
+        self.documents += 1
+        self.bytes_in += len(content.encode("utf-8"))
+        self.bytes_out += len(text.encode("utf-8"))
+        return text
+
+    def stats(self) -> Dict[str, Any]:
+        """返回字节统计."""
+        return {
+            "documents": self.documents,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "reduction": round(1 - self.bytes_out / self.bytes_in, 4) if self.bytes_in else None,
+        }
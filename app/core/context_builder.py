@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""把检索到的文本块整理为不超过token预算的提示上下文."""
+
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from app.core.chunker import HEADING_PATTERN
+from app.core.lexical_index import tokenize
+
+# 相邻文本块之间字符级重叠的最小长度，更短的重复视为巧合
+_MIN_OVERLAP = 8
+
+
+def _is_heading(paragraph: str) -> bool:
+    """段落是否由标题行组成（分块器把连续的标题合并为一段）."""
+    return all(HEADING_PATTERN.match(line) for line in paragraph.split("\n"))
+
+
+def _strip_overlap(previous: str, text: str) -> str:
+    """去掉 text 开头与 previous 重复的部分.
+
+    先跳过开头那些与 previous 中某段完全相同的段落：分块器在每块开头重复的
+    章节标题，以及与 previous 最后一段相同的段落；再去掉剩余文本开头与
+    previous 结尾的字符级重叠。只比较完整的段落，正文中的片段（例如代码块的
+    围栏行）不会因为恰好出现在 previous 中而被删除。
+    """
+    previous_paragraphs = [p.strip() for p in previous.split("\n\n") if p.strip()]
+    repeated = {p for p in previous_paragraphs if _is_heading(p)}
+    if previous_paragraphs:
+        repeated.add(previous_paragraphs[-1])
+    paragraphs = text.split("\n\n")
+    while paragraphs and paragraphs[0].strip() in repeated:
+        paragraphs.pop(0)
+    rest = "\n\n".join(paragraphs).lstrip()
+    if not rest:
+        return ""
+
+    if len(rest) < _MIN_OVERLAP:
+        return rest
+    # 从最长的可能重叠开始找，第一个满足条件的位置就是最长重叠
+    probe = rest[:_MIN_OVERLAP]
+    position = previous.find(probe, max(0, len(previous) - len(rest)))
+    while position != -1:
+        tail = previous[position:]
+        if rest.startswith(tail):
+            return rest[len(tail):].lstrip()
+        position = previous.find(probe, position + 1)
+    return rest
+
+
+class _Passage:
+    """一段待放入上下文的文本，可能由同一笔记的多个相邻文本块合并而成."""
+
+    __slots__ = ("document", "text", "rank", "score", "note_id", "last_index", "tokens", "shingles")
+
+    def __init__(self, document, rank: int, score: Optional[float]) -> None:
+        self.document = document
+        self.text = document.page_content
+        self.rank = rank
+        self.score = score
+        self.note_id = document.metadata.get("note_id")
+        self.last_index = document.metadata.get("chunk_index")
+        self.tokens = 0
+        self.shingles: Set[str] = set()
+
+
+class ContextAssembler:
+    """在 "stuff" 提示之前整理检索结果.
+
+    同一笔记中相邻的文本块合并为一段并去掉重叠的文本，内容几乎相同的段落
+    只保留相关性最高的一个，然后按相关性依次放入，直到提示（含模板和问题）
+    达到token预算。token数使用语言模型的分词器统计。
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], token_budget: int = 1536,
+                 dedup_threshold: float = 0.85, prompt_template: str = "{context}\n\n{question}") -> None:
+        """初始化上下文整理器.
+
+        Args:
+            count_tokens: 使用语言模型分词器统计token数的函数.
+            token_budget: 完整提示的最大token数，0表示不限制.
+            dedup_threshold: 两段文本的词集合Jaccard相似度达到该值时视为重复，大于1表示不去重.
+            prompt_template: 含 {context} 和 {question} 的提示模板.
+        """
+        self.count_tokens = count_tokens
+        self.token_budget = max(0, token_budget)
+        self.dedup_threshold = dedup_threshold
+        self.prompt_template = prompt_template
+        # 段落之间的分隔符
+        self.separator = "\n\n"
+
+    def _merge(self, documents: list, scores: List[Optional[float]]) -> List[_Passage]:
+        """合并同一笔记中序号相邻的文本块."""
+        passages: List[_Passage] = []
+        # 按笔记和序号排列，使相邻文本块连续出现
+        indexed = [
+            (doc, rank, scores[rank] if rank < len(scores) else None)
+            for rank, doc in enumerate(documents)
+        ]
+        indexed.sort(key=lambda item: (
+            str(item[0].metadata.get("note_id")),
+            item[0].metadata.get("chunk_index") if item[0].metadata.get("chunk_index") is not None else item[1]
+        ))
+        for doc, rank, score in indexed:
+            chunk_index = doc.metadata.get("chunk_index")
+            previous = passages[-1] if passages else None
+            if (previous is not None and chunk_index is not None and previous.last_index is not None
+                    and previous.note_id == doc.metadata.get("note_id")
+                    and chunk_index == previous.last_index + 1):
+                addition = _strip_overlap(previous.text, doc.page_content)
+                if addition:
+                    previous.text = f"{previous.text}{self.separator}{addition}"
+                previous.last_index = chunk_index
+                # 合并后的段落取其中最相关文本块的排名和分数
+                if rank < previous.rank:
+                    previous.rank = rank
+                    previous.score = score
+                continue
+            passages.append(_Passage(doc, rank, score))
+        passages.sort(key=lambda passage: passage.rank)
+        return passages
+
+    def _deduplicate(self, passages: List[_Passage]) -> Tuple[List[_Passage], int]:
+        """去掉与更相关段落几乎相同的段落."""
+        if self.dedup_threshold > 1:
+            return passages, 0
+        kept: List[_Passage] = []
+        dropped = 0
+        for passage in passages:
+            passage.shingles = set(tokenize(passage.text))
+            duplicate = False
+            for other in kept:
+                union = len(passage.shingles | other.shingles)
+                if not union:
+                    continue
+                overlap = len(passage.shingles & other.shingles)
+                # 几乎相同，或几乎完全包含在更相关的段落中
+                if (overlap / union >= self.dedup_threshold
+                        or overlap / (len(passage.shingles) or 1) >= self.dedup_threshold):
+                    duplicate = True
+                    break
+            if duplicate:
+                dropped += 1
+            else:
+                kept.append(passage)
+        return kept, dropped
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        """按比例截短文本，直到不超过 max_tokens 个token."""
+        tokens = self.count_tokens(text)
+        while text and tokens > max_tokens:
+            text = text[:max(0, int(len(text) * max_tokens / tokens) - 1)].rstrip()
+            tokens = self.count_tokens(text)
+        return text
+
+    def _to_document(self, passage: _Passage):
+        """把合并或截短后的段落转换为Document."""
+        if passage.text == passage.document.page_content:
+            return passage.document
+        return type(passage.document)(page_content=passage.text, metadata=dict(passage.document.metadata))
+
+    def assemble(self, question: str, documents: list,
+                 scores: Optional[List[Optional[float]]] = None,
+                 preamble: str = "") -> Tuple[list, List[Optional[float]], Dict[str, Any]]:
+        """整理检索结果.
+
+        Args:
+            question: 用户问题.
+            documents: 按相关性排序的文档.
+            scores: 与文档一一对应的检索分数.
+            preamble: 放在上下文开头的文本（例如对话历史），计入预算.
+
+        Returns:
+            (放入上下文的文档, 对应的分数, 统计)；统计中 prompt_tokens 为完整提示的token数.
+        """
+        scores = list(scores or [])
+        passages = self._merge(documents, scores)
+        merged = len(documents) - len(passages)
+        passages, duplicates = self._deduplicate(passages)
+
+        base_tokens = self.count_tokens(self.prompt_template.format(context=preamble, question=question))
+        separator_tokens = self.count_tokens(self.separator)
+        remaining = self.token_budget - base_tokens if self.token_budget else None
+
+        selected: List[_Passage] = []
+        dropped = 0
+        for passage in passages:
+            passage.tokens = self.count_tokens(passage.text)
+            cost = passage.tokens + (separator_tokens if selected else 0)
+            if remaining is None or cost <= remaining:
+                selected.append(passage)
+                if remaining is not None:
+                    remaining -= cost
+            elif not selected and remaining > 0:
+                # 最相关的段落单独就超出预算时截短放入，保证上下文不为空
+                passage.text = self._truncate(passage.text, remaining)
+                if passage.text:
+                    passage.tokens = self.count_tokens(passage.text)
+                    selected.append(passage)
+                    remaining -= passage.tokens
+            else:
+                dropped += 1
+
+        packed = [self._to_document(passage) for passage in selected]
+        context = preamble + self.separator.join(doc.page_content for doc in packed)
+        prompt_tokens = self.count_tokens(self.prompt_template.format(context=context, question=question))
+        return packed, [passage.score for passage in selected], {
+            "prompt_tokens": prompt_tokens,
+            "context_tokens": sum(passage.tokens for passage in selected),
+            "chunks_in": len(documents),
+            "chunks_merged": merged,
+            "duplicates_dropped": duplicates,
+            "over_budget_dropped": dropped,
+        }
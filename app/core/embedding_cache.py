@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""基于内容寻址的持久化嵌入缓存."""
+
+import hashlib
+import os
+import sqlite3
+import struct
+import threading
+import time
+import unicodedata
+from typing import Any, Dict, List, Optional
+
+# 尝试导入langchain组件
+try:
+    from langchain_core.embeddings import Embeddings
+except ImportError:
+    Embeddings = object
+
+# 向量的存储格式：float16 体积减半，对检索精度影响可以忽略
+_STRUCT_CODES = {"float16": "e", "float32": "f"}
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本，使仅在Unicode形式或首尾空白上不同的文本共享缓存.
+
+    Args:
+        text: 原始文本.
+
+    Returns:
+        规范化后的文本.
+    """
+    return unicodedata.normalize("NFKC", text).strip()
+
+
+class EmbeddingCache:
+    """以 (模型ID, 规范化文本哈希) 为键的SQLite嵌入缓存.
+
+    条目数超过上限时按最近访问时间淘汰最旧的条目。
+    """
+
+    def __init__(self, path: str, model_id: str, max_entries: int = 500000,
+                 dtype: str = "float16") -> None:
+        """初始化嵌入缓存.
+
+        Args:
+            path: SQLite数据库文件路径.
+            model_id: 嵌入模型标识，不同模型的向量互不共享.
+            max_entries: 最多保留的条目数.
+            dtype: 向量存储类型，float16 或 float32.
+        """
+        if dtype not in _STRUCT_CODES:
+            raise ValueError(f"不支持的向量类型: {dtype}")
+        self.path = path
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.dtype = dtype
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " text_hash BLOB NOT NULL,"
+            " dtype TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_access REAL NOT NULL,"
+            " PRIMARY KEY (model, text_hash)"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)"
+        )
+        self._conn.commit()
+        # 条目数的上界估计：启动时精确统计一次，之后每次写入按写入行数累加
+        # （替换已有条目时偏大），超过上限时才重新精确统计，避免每次写入都全表计数
+        self._row_estimate = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def _hash(text: str) -> bytes:
+        """计算规范化文本的哈希."""
+        return hashlib.sha256(normalize_text(text).encode("utf-8")).digest()
+
+    def _pack(self, vector: List[float]) -> bytes:
+        """将向量编码为二进制."""
+        return struct.pack(f"<{len(vector)}{_STRUCT_CODES[self.dtype]}", *vector)
+
+    @staticmethod
+    def _unpack(blob: bytes, dtype: str) -> List[float]:
+        """将二进制解码为向量."""
+        code = _STRUCT_CODES[dtype]
+        count = len(blob) // struct.calcsize(code)
+        return list(struct.unpack(f"<{count}{code}", blob))
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """批量查询缓存.
+
+        Args:
+            texts: 要查询的文本.
+
+        Returns:
+            与输入一一对应的向量，未命中的位置为None.
+        """
+        keys = [self._hash(text) for text in texts]
+        found: Dict[bytes, List[float]] = {}
+        now = time.time()
+        with self._lock:
+            # 分批查询，避免超过SQLite的参数数量限制
+            unique_keys = list(dict.fromkeys(keys))
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, dtype, vector FROM embeddings "
+                    f"WHERE model = ? AND text_hash IN ({placeholders})",
+                    [self.model_id, *batch]
+                ).fetchall()
+                for text_hash, dtype, blob in rows:
+                    found[text_hash] = self._unpack(blob, dtype)
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                    [(now, self.model_id, key) for key in found]
+                )
+                self._conn.commit()
+
+            results = [found.get(key) for key in keys]
+            hit_count = sum(1 for vector in results if vector is not None)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+        return results
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]) -> None:
+        """批量写入缓存.
+
+        Args:
+            texts: 文本.
+            vectors: 与文本一一对应的向量.
+        """
+        now = time.time()
+        rows = [
+            (self.model_id, self._hash(text), self.dtype, self._pack(vector), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, dtype, vector, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+            self._row_estimate += len(rows)
+            self._evict()
+
+    def _evict(self) -> None:
+        """条目数超过上限时淘汰最久未访问的条目（调用方需持有锁）."""
+        if self._row_estimate <= self.max_entries:
+            return
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self._row_estimate = count
+        overflow = count - self.max_entries
+        if overflow <= 0:
+            return
+        # 多淘汰一部分，避免每次写入都触发淘汰
+        overflow += self.max_entries // 10
+        cursor = self._conn.execute(
+            "DELETE FROM embeddings WHERE (model, text_hash) IN "
+            "(SELECT model, text_hash FROM embeddings ORDER BY last_access LIMIT ?)",
+            (overflow,)
+        )
+        self._conn.commit()
+        self.evictions += cursor.rowcount
+        self._row_estimate -= cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计."""
+        total = self.hits + self.misses
+        return {
+            "model": self.model_id,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+            "evictions": self.evictions,
+            "max_entries": self.max_entries,
+        }
+
+    def close(self) -> None:
+        """关闭数据库连接."""
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """在底层嵌入模型前加一层 EmbeddingCache，文档和查询嵌入共用同一缓存."""
+
+    def __init__(self, embeddings, cache: EmbeddingCache) -> None:
+        """初始化带缓存的嵌入模型.
+
+        Args:
+            embeddings: 底层嵌入模型，例如 HuggingFaceEmbeddings.
+            cache: 嵌入缓存.
+        """
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """嵌入文档，只对缓存未命中的文本调用底层模型.
+
+        Args:
+            texts: 要嵌入的文本.
+
+        Returns:
+            向量列表.
+        """
+        vectors = self.cache.get_many(texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = self.embeddings.embed_documents([texts[i] for i in missing])
+            computed = [list(map(float, vector)) for vector in computed]
+            self.cache.put_many([texts[i] for i in missing], computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        """嵌入查询文本.
+
+        Args:
+            text: 查询文本.
+
+        Returns:
+            查询向量.
+        """
+        vector = self.cache.get_many([text])[0]
+        if vector is None:
+            vector = list(map(float, self.embeddings.embed_query(text)))
+            self.cache.put_many([text], [vector])
+        return vector
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""导入流水线中的批量嵌入阶段."""
+
+import time
+from typing import Any, Dict, List, Optional
+
+from app.core.config import Config
+from app.core.knowledge_base import KnowledgeBase
+
+
+class EmbeddingStage:
+    """按固定批大小计算文本块向量，可选地使用多进程编码.
+
+    先查询嵌入缓存，只有未命中的文本才会送入模型；统计编码的文本块数、
+    token数和耗时，用于估算导入吞吐量。
+    """
+
+    def __init__(self, config: Config, knowledge_base: KnowledgeBase) -> None:
+        """初始化嵌入阶段.
+
+        Args:
+            config: 应用程序配置.
+            knowledge_base: 提供嵌入模型和嵌入缓存的知识库.
+        """
+        self.knowledge_base = knowledge_base
+        self.batch_size = max(1, config.embedding_batch_size)
+        self.num_processes = max(0, config.embedding_processes)
+        self._pool = None
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        """清空吞吐量统计."""
+        self.chunks = 0
+        self.encoded_chunks = 0
+        self.tokens = 0
+        self.seconds = 0.0
+
+    @property
+    def _model(self):
+        """未经缓存包装的底层嵌入模型."""
+        return self.knowledge_base.base_embedding_model
+
+    def _sentence_transformer(self):
+        """返回底层的SentenceTransformer实例（如果有）."""
+        return getattr(self._model, "client", None)
+
+    def _count_tokens(self, texts: List[str]) -> int:
+        """使用嵌入模型的分词器统计token数，不可用时按空白粗略估算."""
+        client = self._sentence_transformer()
+        tokenizer = getattr(client, "tokenizer", None)
+        if tokenizer is not None:
+            try:
+                encoded = tokenizer(texts, add_special_tokens=False)["input_ids"]
+                return sum(len(ids) for ids in encoded)
+            except Exception:
+                pass
+        return sum(len(text.split()) for text in texts)
+
+    def _start_pool(self) -> None:
+        """按需启动sentence-transformers多进程编码池."""
+        if self._pool is not None or self.num_processes < 2:
+            return
+        client = self._sentence_transformer()
+        if client is None or not hasattr(client, "start_multi_process_pool"):
+            print("底层嵌入模型不支持多进程编码，将使用单进程")
+            self.num_processes = 0
+            return
+        self._pool = client.start_multi_process_pool(target_devices=["cpu"] * self.num_processes)
+        print(f"已启动 {self.num_processes} 个嵌入编码进程")
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        """调用模型编码文本."""
+        self._start_pool()
+        if self._pool is not None:
+            # 与 HuggingFaceEmbeddings.embed_documents 相同的预处理和编码参数，
+            # 保证向量与单进程路径及查询嵌入一致（它们共用嵌入缓存和向量库）
+            texts = [text.replace("\n", " ") for text in texts]
+            encode_kwargs = getattr(self._model, "encode_kwargs", None) or {}
+            # encode_multi_process 只接受部分编码参数，这里只传影响向量取值的归一化选项
+            extra = {}
+            if "normalize_embeddings" in encode_kwargs:
+                extra["normalize_embeddings"] = encode_kwargs["normalize_embeddings"]
+            vectors = self._sentence_transformer().encode_multi_process(
+                texts,
+                self._pool,
+                batch_size=self.batch_size,
+                **extra
+            )
+            return [list(map(float, vector)) for vector in vectors]
+
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            vectors.extend(list(map(float, vector)) for vector in self._model.embed_documents(batch))
+        return vectors
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """计算文本块向量.
+
+        Args:
+            texts: 文本块内容.
+
+        Returns:
+            与输入一一对应的向量.
+        """
+        if not texts:
+            return []
+        start = time.perf_counter()
+        cache = self.knowledge_base.embedding_cache
+        vectors: List[Optional[List[float]]] = cache.get_many(texts) if cache else [None] * len(texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            computed = self._encode(missing_texts)
+            if cache:
+                cache.put_many(missing_texts, computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+            self.encoded_chunks += len(missing)
+            self.tokens += self._count_tokens(missing_texts)
+
+        self.chunks += len(texts)
+        self.seconds += time.perf_counter() - start
+        return vectors
+
+    def stats(self) -> Dict[str, Any]:
+        """返回嵌入吞吐量统计."""
+        seconds = self.seconds or 0.0
+        return {
+            "chunks": self.chunks,
+            "encoded_chunks": self.encoded_chunks,
+            "tokens": self.tokens,
+            "seconds": round(seconds, 3),
+            "chunks_per_second": round(self.chunks / seconds, 2) if seconds else None,
+            "tokens_per_second": round(self.tokens / seconds, 2) if seconds else None,
+            "processes": self.num_processes or 1,
+            "batch_size": self.batch_size,
+        }
+
+    def close(self) -> None:
+        """停止多进程编码池."""
+        if self._pool is not None:
+            self._sentence_transformer().stop_multi_process_pool(self._pool)
+            self._pool = None
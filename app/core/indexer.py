@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""基于清单的增量索引服务."""
+
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import Config
+from app.core.knowledge_base import KnowledgeBase
+from app.core.note_filters import note_metadata
+
+# 尝试导入langchain组件
+try:
+    from langchain.docstore.document import Document
+except ImportError:
+    Document = None
+
+MANIFEST_VERSION = 1
+# 清单中保留的墓碑记录上限
+MAX_TOMBSTONES = 10000
+
+
+def chunk_id(note_id: str, index: int) -> str:
+    """生成文本块的确定性ID.
+
+    Args:
+        note_id: 笔记ID.
+        index: 文本块在笔记中的序号.
+
+    Returns:
+        文本块ID.
+    """
+    return f"{note_id}#{index}"
+
+
+def content_hash(title: str, content: str) -> str:
+    """计算笔记标题和内容的哈希.
+
+    Args:
+        title: 笔记标题.
+        content: 笔记内容.
+
+    Returns:
+        十六进制SHA-256摘要.
+    """
+    digest = hashlib.sha256()
+    digest.update(title.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(content.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def filter_digest(filters: Dict[str, Any]) -> str:
+    """计算过滤元数据的摘要.
+
+    各加载器给出祖先的顺序不同，摘要与顺序无关，只在祖先或标签集合变化时改变。
+
+    Args:
+        filters: note_metadata 返回的过滤元数据.
+
+    Returns:
+        十六进制SHA-256摘要.
+    """
+    return content_hash(
+        ",".join(sorted(filters['ancestors'].split(","))),
+        ",".join(sorted(filters['labels'].split(",")))
+    )
+
+
+def to_document(raw: Dict[str, Any]):
+    """将Trilium加载的原始文档转换为Document对象.
+
+    Args:
+        raw: 包含content、title、note_id的字典，可选的 ancestors 和 attributes
+            用于生成子树和标签过滤元数据.
+
+    Returns:
+        Document对象.
+    """
+    # 确保标题不为空
+    title = raw.get('title', '未知标题')
+    if not title or title.strip() == "":
+        title = "未知标题"
+
+    note_id = raw.get('note_id', '')
+    metadata = {
+        'title': title,
+        'note_id': note_id,
+        'source': f"trilium:{note_id}"
+    }
+    metadata.update(note_metadata(note_id, raw.get('ancestors'), raw.get('attributes')))
+    return Document(
+        page_content=raw.get('content', ''),
+        metadata=metadata
+    )
+
+
+class IndexVersionTracker:
+    """读取磁盘上索引清单的版本号，供查询侧判断索引是否已变化.
+
+    只有清单文件的修改时间变化时才重新读取；index_version 位于清单开头，
+    因此只需读取文件的前几百个字节，不必解析整个清单。
+    """
+
+    _PATTERN = re.compile(rb'"index_version":\s*(\d+)')
+
+    def __init__(self, manifest_path: str) -> None:
+        """初始化版本跟踪器.
+
+        Args:
+            manifest_path: 索引清单路径.
+        """
+        self.manifest_path = manifest_path
+        self._mtime = None
+        self._version = 0
+
+    def current(self) -> int:
+        """返回当前的索引版本号，清单不存在时为0."""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except OSError:
+            return 0
+        if mtime != self._mtime:
+            try:
+                with open(self.manifest_path, "rb") as f:
+                    match = self._PATTERN.search(f.read(512))
+                if match:
+                    self._version = int(match.group(1))
+                else:
+                    with open(self.manifest_path, "r", encoding="utf-8") as f:
+                        self._version = json.load(f).get("index_version", 0)
+                self._mtime = mtime
+            except Exception as e:
+                print(f"读取索引版本失败: {e}")
+        return self._version
+
+
+class IncrementalIndexer:
+    """维护增量索引清单：判断笔记是否变化，记录文本块ID并清理已删除的笔记.
+
+    清单记录每个笔记的 utcDateModified、内容哈希、文本块ID和处理签名，
+    文本块ID由笔记ID和序号确定，因此重复索引会覆盖而不是追加向量。
+    处理签名描述内容提取和分块的方式，签名变化后的笔记会被重新索引。
+    """
+
+    def __init__(self, config: Config, knowledge_base: KnowledgeBase) -> None:
+        """初始化增量索引器.
+
+        Args:
+            config: 应用程序配置.
+            knowledge_base: 要写入的知识库.
+        """
+        self.knowledge_base = knowledge_base
+        self.manifest_path = config.index_manifest_path
+        self.manifest = self._load_manifest()
+        # 当前的内容提取和分块方式，由导入流水线设置
+        self.processing_signature = ""
+
+    def _load_manifest(self) -> Dict[str, Any]:
+        """从磁盘读取清单，不存在或损坏时返回空清单."""
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+                if manifest.get("version") == MANIFEST_VERSION:
+                    return manifest
+                print(f"索引清单版本不匹配，将重建: {self.manifest_path}")
+            except Exception as e:
+                print(f"读取索引清单失败，将重建: {e}")
+        return {
+            "version": MANIFEST_VERSION,
+            "index_version": 0,
+            "notes": {},
+            "tombstones": {}
+        }
+
+    def save_manifest(self) -> None:
+        """原子地将清单写回磁盘."""
+        directory = os.path.dirname(self.manifest_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    @property
+    def index_version(self) -> int:
+        """索引版本号，每次索引内容发生变化时递增."""
+        return self.manifest.get("index_version", 0)
+
+    def known_versions(self) -> Dict[str, str]:
+        """返回已索引笔记的修改时间，供加载器跳过未变化的笔记.
+
+        Returns:
+            note_id 到 utcDateModified 的映射.
+        """
+        return {
+            note_id: entry.get("utc_date_modified")
+            for note_id, entry in self.manifest["notes"].items()
+            if entry.get("utc_date_modified") and self._is_current(entry)
+        }
+
+    def _is_current(self, entry: Dict[str, Any]) -> bool:
+        """判断条目是否使用当前的处理签名生成."""
+        return entry.get("signature", "") == self.processing_signature
+
+    def needs_reprocessing(self) -> bool:
+        """是否有笔记是用旧的内容提取或分块方式索引的."""
+        return any(not self._is_current(entry) for entry in self.manifest["notes"].values())
+
+    def check_unchanged(self, raw: Dict[str, Any]) -> Tuple[bool, str]:
+        """判断笔记的标题和内容自上次索引以来是否未变化.
+
+        Args:
+            raw: 加载器返回的原始文档；带有 unchanged=True 的条目
+                只表示该笔记仍然存在且修改时间未变.
+
+        Returns:
+            (是否未变化, 内容哈希)；占位条目的哈希为空字符串.
+        """
+        entry = self.manifest["notes"].get(raw.get('note_id'))
+        if entry and not self._is_current(entry):
+            entry = None
+        if raw.get('unchanged') and entry:
+            return True, ""
+
+        digest = content_hash(raw.get('title') or "", raw.get('content') or "")
+        if entry and entry.get("content_hash") == digest:
+            # 内容未变但修改时间变了，更新时间以便下次直接跳过（导出归档没有修改时间，保留原值）
+            if raw.get('utc_date_modified'):
+                entry["utc_date_modified"] = raw['utc_date_modified']
+            return True, digest
+        return False, digest
+
+    def check_filters(self, raw: Dict[str, Any]) -> Tuple[List[str], Dict[str, Any]]:
+        """检查内容未变化的笔记的祖先和标签是否变化.
+
+        移动笔记、增删克隆或修改标签不会改变笔记的修改时间，因此不能只看修改时间。
+        变化时在清单中记录新的摘要，由调用方改写这些文本块的元数据。
+
+        Args:
+            raw: 加载器返回的原始文档或占位条目.
+
+        Returns:
+            (需要改写元数据的文本块ID, 新的过滤元数据)；未变化或文档中没有祖先和属性时ID列表为空.
+        """
+        entry = self.manifest["notes"].get(raw.get('note_id'))
+        if not entry or ('ancestors' not in raw and 'attributes' not in raw):
+            return [], {}
+        filters = note_metadata(raw['note_id'], raw.get('ancestors'), raw.get('attributes'))
+        digest = filter_digest(filters)
+        if entry.get("filter_digest") == digest:
+            return [], filters
+        entry["filter_digest"] = digest
+        return list(entry.get("chunk_ids", [])), filters
+
+    def record_note(self, note_id: str, utc_date_modified: str, digest: str,
+                    chunk_ids: List[str], filters: str = "") -> Tuple[bool, List[str]]:
+        """记录笔记的新版本.
+
+        Args:
+            note_id: 笔记ID.
+            utc_date_modified: 笔记的修改时间.
+            digest: 内容哈希.
+            chunk_ids: 新写入的文本块ID.
+            filters: 过滤元数据的摘要.
+
+        Returns:
+            (是否为新笔记, 旧版本中需要删除的多余文本块ID).
+        """
+        notes = self.manifest["notes"]
+        entry = notes.get(note_id)
+        new_ids = set(chunk_ids)
+        stale_ids = [cid for cid in (entry or {}).get("chunk_ids", []) if cid not in new_ids]
+        notes[note_id] = {
+            "utc_date_modified": utc_date_modified,
+            "content_hash": digest,
+            "filter_digest": filters,
+            "chunk_ids": list(chunk_ids),
+            "signature": self.processing_signature
+        }
+        self.manifest["tombstones"].pop(note_id, None)
+        return entry is None, stale_ids
+
+    @property
+    def sync_watermark(self) -> Optional[str]:
+        """增量同步的水位线：已完整同步到的最大 utcDateModified.
+
+        旧清单没有记录水位线时，使用已索引笔记中最大的修改时间。
+        """
+        watermark = self.manifest.get("sync_watermark")
+        if watermark:
+            return watermark
+        return max(self.known_versions().values(), default=None)
+
+    def advance_watermark(self, utc_date_modified: Optional[str]) -> None:
+        """将水位线推进到给定的修改时间（只会前进，不会后退）.
+
+        Args:
+            utc_date_modified: 本次同步看到的最大修改时间.
+        """
+        if utc_date_modified and utc_date_modified > (self.manifest.get("sync_watermark") or ""):
+            self.manifest["sync_watermark"] = utc_date_modified
+
+    def note_ids(self) -> List[str]:
+        """返回清单中所有已索引的笔记ID."""
+        return list(self.manifest["notes"])
+
+    def bump_version(self) -> None:
+        """索引内容发生变化后递增索引版本号."""
+        self.manifest["index_version"] = self.index_version + 1
+
+    def remove_notes(self, note_ids: List[str]) -> Dict[str, int]:
+        """删除笔记的全部文本块并记录墓碑.
+
+        Args:
+            note_ids: 要删除的笔记ID.
+
+        Returns:
+            removed 和 chunks_deleted 统计.
+        """
+        notes = self.manifest["notes"]
+        tombstones = self.manifest["tombstones"]
+        stats = {"removed": 0, "chunks_deleted": 0}
+        deleted_at = datetime.now(timezone.utc).isoformat()
+
+        for note_id in note_ids:
+            entry = notes.get(note_id)
+            if entry is None:
+                continue
+            chunk_ids = entry.get("chunk_ids", [])
+            self.knowledge_base.delete_documents(chunk_ids)
+            del notes[note_id]
+            tombstones.pop(note_id, None)
+            tombstones[note_id] = deleted_at
+            stats["removed"] += 1
+            stats["chunks_deleted"] += len(chunk_ids)
+
+        # 墓碑按插入顺序保存，超过上限时丢弃最旧的记录
+        overflow = len(tombstones) - MAX_TOMBSTONES
+        for note_id in list(tombstones)[:max(0, overflow)]:
+            del tombstones[note_id]
+        return stats
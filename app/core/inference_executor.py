@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""带准入控制的推理执行器."""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+
+class ExecutorSaturatedError(RuntimeError):
+    """执行器的工作线程和等待队列均已占满."""
+
+
+class QueueTimeoutError(RuntimeError):
+    """任务在队列中等待的时间超过了允许的上限."""
+
+
+class InferenceExecutor:
+    """用于运行阻塞式推理任务的有界线程池.
+
+    同时在途的任务数（运行中 + 排队中）不超过 max_workers + max_queue_size，
+    超出时 submit 立即抛出 ExecutorSaturatedError，而不是让请求无限堆积。
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 1,
+        max_queue_size: int = 8,
+        max_queue_wait: Optional[float] = None
+    ) -> None:
+        """初始化推理执行器.
+
+        Args:
+            max_workers: 工作线程数量.
+            max_queue_size: 允许排队等待的最大任务数.
+            max_queue_wait: 任务最长排队秒数，超过后不再执行；为空表示不限制.
+        """
+        self.max_workers = max(1, max_workers)
+        self.max_queue_size = max(0, max_queue_size)
+        self.max_queue_wait = max_queue_wait
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="inference"
+        )
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._running = 0
+        # 每个任务的序号和尚未结束的任务，用于等待某一时刻之前提交的任务完成
+        self._last_sequence = 0
+        self._pending: Set[int] = set()
+        self._finished = threading.Condition(self._lock)
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.expired = 0
+
+    @property
+    def capacity(self) -> int:
+        """允许同时在途的最大任务数."""
+        return self.max_workers + self.max_queue_size
+
+    def _acquire_slot(self) -> int:
+        """占用一个在途任务名额并返回任务序号，名额耗尽时抛出异常."""
+        with self._lock:
+            if self._in_flight >= self.capacity:
+                self.rejected += 1
+                raise ExecutorSaturatedError(
+                    f"推理队列已满（{self._in_flight}/{self.capacity}）"
+                )
+            self._in_flight += 1
+            self.submitted += 1
+            self._last_sequence += 1
+            self._pending.add(self._last_sequence)
+            return self._last_sequence
+
+    def _release_slot(self, sequence: int) -> None:
+        """释放任务名额（调用方需持有锁）."""
+        self._in_flight -= 1
+        self._pending.discard(sequence)
+        self._finished.notify_all()
+
+    def _run_task(self, sequence: int, enqueued_at: float, fn: Callable[..., Any],
+                  args, kwargs) -> Tuple[Any, float]:
+        """在工作线程中执行任务并返回结果和排队耗时."""
+        queue_wait = time.perf_counter() - enqueued_at
+        try:
+            if self.max_queue_wait is not None and queue_wait > self.max_queue_wait:
+                with self._lock:
+                    self.expired += 1
+                raise QueueTimeoutError(f"任务排队 {queue_wait:.1f} 秒后超时")
+            with self._lock:
+                self._running += 1
+            try:
+                return fn(*args, **kwargs), queue_wait
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self.completed += 1
+        finally:
+            with self._lock:
+                self._release_slot(sequence)
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs):
+        """提交阻塞任务.
+
+        Args:
+            fn: 要执行的函数.
+            *args: 位置参数.
+            **kwargs: 关键字参数.
+
+        Returns:
+            concurrent.futures.Future，其结果为 (返回值, 排队秒数).
+
+        Raises:
+            ExecutorSaturatedError: 执行器已饱和.
+        """
+        sequence = self._acquire_slot()
+        try:
+            return self._executor.submit(self._run_task, sequence, time.perf_counter(), fn, args, kwargs)
+        except Exception:
+            with self._lock:
+                self._release_slot(sequence)
+            raise
+
+    def mark(self) -> int:
+        """返回最近提交的任务序号，配合 wait_until_done 等待此前提交的任务."""
+        with self._lock:
+            return self._last_sequence
+
+    def wait_until_done(self, sequence: int, timeout: Optional[float] = None) -> bool:
+        """等待序号不大于 sequence 的任务全部结束，之后提交的任务不影响等待.
+
+        Args:
+            sequence: mark() 返回的序号.
+            timeout: 最长等待秒数，为空表示一直等待.
+
+        Returns:
+            这些任务是否已全部结束.
+        """
+        with self._lock:
+            return self._finished.wait_for(
+                lambda: not any(pending <= sequence for pending in self._pending), timeout
+            )
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Tuple[Any, float]:
+        """在执行器中运行阻塞任务并异步等待结果.
+
+        Args:
+            fn: 要执行的函数.
+            *args: 位置参数.
+            **kwargs: 关键字参数.
+
+        Returns:
+            (返回值, 排队秒数).
+        """
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def stats(self) -> Dict[str, Any]:
+        """返回执行器当前的负载统计."""
+        with self._lock:
+            running = self._running
+            in_flight = self._in_flight
+        return {
+            "max_workers": self.max_workers,
+            "max_queue_size": self.max_queue_size,
+            "running": running,
+            "queued": max(0, in_flight - running),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "expired": self.expired,
+        }
+
+    def shutdown(self, wait: bool = False) -> None:
+        """关闭执行器.
+
+        Args:
+            wait: 是否等待正在执行的任务结束.
+        """
+        self._executor.shutdown(wait=wait, cancel_futures=True)
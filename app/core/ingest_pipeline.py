@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+"""分批流式处理的知识库导入流水线."""
+
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from app.core.chunker import STRUCTURED_MIME_TYPES
+from app.core.config import Config
+from app.core.content_normalizer import NORMALIZER_VERSION, ContentNormalizer
+from app.core.embedding_stage import EmbeddingStage
+from app.core.indexer import IncrementalIndexer, chunk_id, filter_digest, to_document
+from app.core.knowledge_base import KnowledgeBase
+from app.core.metrics import INGEST_CHUNKS_TOTAL, INGEST_DOCUMENTS_TOTAL, INGEST_STAGE_SECONDS
+from app.core.note_filters import METADATA_VERSION, note_metadata
+from app.core.trilium_export import TriliumExportReader
+from app.core.trilium_integration import TriliumService
+
+
+def batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """将可迭代对象切分为固定大小的批次.
+
+    Args:
+        items: 任意可迭代对象.
+        size: 每批的最大元素数.
+
+    Yields:
+        元素列表.
+    """
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class IngestPipeline:
+    """将文档流按批依次经过清洗、分块、嵌入和写入阶段.
+
+    每批结束后提交索引清单并更新检查点，任意时刻内存中只保留一个批次，
+    因此峰值内存与知识库规模无关。进程崩溃后重新运行时，已提交的笔记
+    会因修改时间未变而被跳过，从中断处继续。
+    """
+
+    def __init__(self, config: Config, knowledge_base: KnowledgeBase,
+                 indexer: Optional[IncrementalIndexer] = None) -> None:
+        """初始化导入流水线.
+
+        Args:
+            config: 应用程序配置.
+            knowledge_base: 要写入的知识库.
+            indexer: 增量索引器，为空时自动创建.
+        """
+        self.knowledge_base = knowledge_base
+        self.indexer = indexer or IncrementalIndexer(config, knowledge_base)
+        chunker = knowledge_base.get_chunker()
+        # 内容提取、分块参数或元数据格式变化后，已索引的笔记需要重新处理
+        self.indexer.processing_signature = (
+            f"normalize={NORMALIZER_VERSION};chunk={chunker.max_tokens}/{chunker.overlap_tokens};"
+            f"lexical={knowledge_base.lexical_index.ngram if knowledge_base.lexical_index else 0};"
+            f"meta={METADATA_VERSION}"
+        )
+        self.normalizer = ContentNormalizer()
+        self.embedding_stage = EmbeddingStage(config, knowledge_base)
+        self.batch_size = max(1, config.ingest_batch_size)
+        self.checkpoint_path = config.ingest_checkpoint_path
+        self._reset()
+
+    def _reset(self) -> None:
+        """清空本次运行的状态."""
+        self.seen = set()
+        self.normalizer.reset_stats()
+        self.knowledge_base.get_chunker().chunk_stats.reset()
+        self.embedding_stage.reset_stats()
+        self.changed = False
+        self.batches = 0
+        self.started_at = None
+        # 本次看到的最大修改时间，用于推进增量同步水位线
+        self.max_modified: Optional[str] = None
+        self.stats = {
+            "added": 0,
+            "updated": 0,
+            "unchanged": 0,
+            "retagged": 0,
+            "removed": 0,
+            "chunks_written": 0,
+            "chunks_deleted": 0
+        }
+        # 各阶段累计耗时（秒）
+        self.stage_seconds = {stage: 0.0 for stage in ("fetch", "clean", "chunk", "embed", "write")}
+
+    def _record_stage(self, stage: str, start: float) -> float:
+        """记录一个阶段从 start 到现在的耗时.
+
+        Returns:
+            当前时间，可作为下一阶段的开始时间.
+        """
+        now = time.perf_counter()
+        self.stage_seconds[stage] += now - start
+        INGEST_STAGE_SECONDS.observe(now - start, stage=stage)
+        return now
+
+    def _count(self, result: str, amount: int = 1) -> None:
+        """累加文档统计."""
+        self.stats[result] += amount
+        INGEST_DOCUMENTS_TOTAL.inc(amount, result=result)
+
+    def _write_checkpoint(self, status: str) -> None:
+        """写入检查点文件，记录运行状态和进度."""
+        if not self.checkpoint_path:
+            return
+        directory = os.path.dirname(self.checkpoint_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        checkpoint = {
+            "status": status,
+            "started_at": self.started_at,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "batches": self.batches,
+            "documents_seen": len(self.seen),
+            "stats": self.stats
+        }
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def read_checkpoint(self) -> Optional[Dict[str, Any]]:
+        """读取上一次运行的检查点.
+
+        Returns:
+            检查点内容，不存在或无法读取时返回None.
+        """
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return None
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"读取导入检查点失败: {e}")
+            return None
+
+    def begin(self) -> None:
+        """开始一次导入运行."""
+        if not self.knowledge_base.vector_store:
+            raise RuntimeError("向量存储未正确初始化")
+        previous = self.read_checkpoint()
+        if previous and previous.get("status") == "running":
+            print(
+                f"上一次导入未完成（已提交 {previous.get('batches', 0)} 批、"
+                f"{previous.get('documents_seen', 0)} 个文档），已提交的笔记将被跳过"
+            )
+        self._reset()
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self._write_checkpoint("running")
+
+    def process(self, documents: Iterable[Dict[str, Any]]) -> None:
+        """按批处理文档流.
+
+        Args:
+            documents: 原始文档的可迭代对象，可以是生成器.
+        """
+        # 拉取阶段的耗时为等待文档流产出下一批的时间
+        fetch_start = time.perf_counter()
+        for batch in batched(documents, self.batch_size):
+            start = self._record_stage("fetch", fetch_start)
+            self._process_batch(batch)
+            self.batches += 1
+            # 每批提交一次清单，作为崩溃恢复的检查点
+            self.indexer.save_manifest()
+            self._write_checkpoint("running")
+            print(
+                f"第 {self.batches} 批完成: {len(batch)} 个文档，"
+                f"耗时 {time.perf_counter() - start:.2f} 秒，累计 {len(self.seen)} 个文档"
+            )
+            fetch_start = time.perf_counter()
+
+    def _process_batch(self, batch: List[Dict[str, Any]]) -> None:
+        """处理一个批次的文档.
+
+        Args:
+            batch: 原始文档列表.
+        """
+        pending = []
+        retag = []
+        for raw in batch:
+            note_id = raw.get('note_id')
+            if not note_id or note_id in self.seen:
+                continue
+            self.seen.add(note_id)
+            utc_date_modified = raw.get('utc_date_modified')
+            if utc_date_modified and utc_date_modified > (self.max_modified or ""):
+                self.max_modified = utc_date_modified
+            unchanged, digest = self.indexer.check_unchanged(raw)
+            if unchanged:
+                self._count("unchanged")
+                retag_ids, filters = self.indexer.check_filters(raw)
+                if retag_ids:
+                    retag.append((retag_ids, filters))
+            else:
+                pending.append((raw, digest))
+
+        if retag:
+            # 只有祖先或标签变化的笔记改写元数据，复用已有向量
+            start = time.perf_counter()
+            for retag_ids, filters in retag:
+                self.knowledge_base.update_note_metadata(retag_ids, filters)
+            self._record_stage("write", start)
+            self.stats["retagged"] += len(retag)
+            self.changed = True
+
+        if not pending:
+            return
+
+        # 清洗阶段
+        start = time.perf_counter()
+        documents = [self.clean(raw) for raw, _ in pending]
+        start = self._record_stage("clean", start)
+        # 分块阶段
+        chunk_groups = [
+            self.chunk(document, structured=raw.get('mime') in STRUCTURED_MIME_TYPES)
+            for (raw, _), document in zip(pending, documents)
+        ]
+        chunks = []
+        ids = []
+        for (raw, _), group in zip(pending, chunk_groups):
+            for i, chunk in enumerate(group):
+                # 文本块ID写入元数据，检索时用于合并多路结果
+                chunk.metadata["chunk_id"] = chunk_id(raw['note_id'], i)
+                chunk.metadata["chunk_index"] = i
+                chunks.append(chunk)
+                ids.append(chunk.metadata["chunk_id"])
+        start = self._record_stage("chunk", start)
+        # 嵌入阶段
+        embeddings = self.embedding_stage.embed([chunk.page_content for chunk in chunks])
+        start = self._record_stage("embed", start)
+        # 写入阶段：整批写入，持久化留到运行结束
+        self.knowledge_base.upsert_embeddings(chunks, ids, embeddings)
+
+        stale_ids = []
+        for (raw, digest), group in zip(pending, chunk_groups):
+            note_id = raw['note_id']
+            is_new, stale = self.indexer.record_note(
+                note_id,
+                raw.get('utc_date_modified'),
+                digest,
+                [chunk_id(note_id, i) for i in range(len(group))],
+                filter_digest(note_metadata(note_id, raw.get('ancestors'), raw.get('attributes')))
+            )
+            stale_ids.extend(stale)
+            self._count("added" if is_new else "updated")
+        self.knowledge_base.delete_documents(stale_ids)
+        self._record_stage("write", start)
+
+        self.stats["chunks_written"] += len(ids)
+        self.stats["chunks_deleted"] += len(stale_ids)
+        INGEST_CHUNKS_TOTAL.inc(len(ids), action="written")
+        INGEST_CHUNKS_TOTAL.inc(len(stale_ids), action="deleted")
+        self.changed = True
+
+    def clean(self, raw: Dict[str, Any]):
+        """清洗阶段：去除HTML标记后将原始文档转换为Document.
+
+        Args:
+            raw: 原始文档.
+
+        Returns:
+            Document对象.
+        """
+        content = self.normalizer.normalize(raw.get('content') or "", raw.get('mime'))
+        return to_document(dict(raw, content=content))
+
+    def chunk(self, document, structured: bool = True) -> list:
+        """分块阶段：将单个文档切分为文本块.
+
+        Args:
+            document: Document对象.
+            structured: 是否按标题、段落和代码块切分.
+
+        Returns:
+            文本块列表.
+        """
+        return self.knowledge_base.split_documents([document], structured=structured)
+
+    def remove(self, note_ids: List[str]) -> None:
+        """删除已不存在的笔记.
+
+        Args:
+            note_ids: 要删除的笔记ID.
+        """
+        removed = self.indexer.remove_notes(note_ids)
+        self._count("removed", removed["removed"])
+        self.stats["chunks_deleted"] += removed["chunks_deleted"]
+        INGEST_CHUNKS_TOTAL.inc(removed["chunks_deleted"], action="deleted")
+        if removed["removed"]:
+            self.changed = True
+
+    def finish(self, remove_missing: bool = False) -> Dict[str, Any]:
+        """结束导入运行.
+
+        Args:
+            remove_missing: 是否删除本次未出现的笔记；只有在文档流完整且没有错误时才应为True.
+
+        Returns:
+            本次运行的统计，normalize 字段为内容提取的字节数，chunking 字段为文本块长度分布，
+                embedding 字段为嵌入吞吐量，stages 字段为各阶段累计秒数.
+        """
+        if remove_missing:
+            self.remove([note_id for note_id in self.indexer.note_ids() if note_id not in self.seen])
+
+        if self.changed:
+            self.indexer.bump_version()
+            self.knowledge_base.persist()
+        self.indexer.save_manifest()
+        self._write_checkpoint("complete")
+
+        normalize = self.normalizer.stats()
+        print(
+            f"内容提取: {normalize['documents']} 个文档，{normalize['bytes_in']} 字节 -> "
+            f"{normalize['bytes_out']} 字节（减少 {normalize['reduction']}）"
+        )
+        chunking = self.knowledge_base.get_chunker().chunk_stats.stats()
+        if chunking["chunks"]:
+            print(
+                f"文本块长度: {chunking['chunks']} 块，上限 {chunking['max_tokens']} token，"
+                f"平均 {chunking['mean']}，p50 {chunking['p50']}，p95 {chunking['p95']}，"
+                f"最大 {chunking['max']}，超限 {chunking['over_limit']}"
+            )
+        embedding = self.embedding_stage.stats()
+        print(
+            f"嵌入吞吐量: {embedding['chunks']} 个文本块（实际编码 {embedding['encoded_chunks']} 个），"
+            f"{embedding['chunks_per_second']} 块/秒，{embedding['tokens_per_second']} token/秒，"
+            f"进程数 {embedding['processes']}，批大小 {embedding['batch_size']}"
+        )
+        stages = {stage: round(seconds, 3) for stage, seconds in self.stage_seconds.items()}
+        print("各阶段耗时: " + "，".join(f"{stage} {seconds:.2f} 秒" for stage, seconds in stages.items()))
+        return dict(self.stats, normalize=normalize, chunking=chunking, embedding=embedding, stages=stages)
+
+    def close(self) -> None:
+        """释放嵌入阶段占用的进程池."""
+        self.embedding_stage.close()
+
+    def run(self, documents: Iterable[Dict[str, Any]], remove_missing: bool = False) -> Dict[str, Any]:
+        """完整执行一次导入.
+
+        Args:
+            documents: 原始文档的可迭代对象.
+            remove_missing: 是否删除本次未出现的笔记.
+
+        Returns:
+            本次运行的统计.
+        """
+        self.begin()
+        self.process(documents)
+        return self.finish(remove_missing=remove_missing)
+
+
+def run_trilium_ingest(config: Config, knowledge_base: KnowledgeBase,
+                       trilium_service: TriliumService, full: bool = False) -> Dict[str, Any]:
+    """从Trilium增量导入一次知识库.
+
+    Args:
+        config: 应用程序配置.
+        knowledge_base: 要写入的知识库.
+        trilium_service: Trilium服务.
+        full: 为True时忽略已记录的修改时间，重新拉取所有笔记内容.
+
+    Returns:
+        本次运行的统计；没有可用的加载器时不写入任何内容，error 字段说明原因.
+    """
+    pipeline = IngestPipeline(config, knowledge_base)
+    if not trilium_service.loader:
+        # load_documents 此时只会返回示例文档，不能写入真实索引
+        error = "Trilium客户端和本地数据库均不可用，跳过导入"
+        print(error)
+        pipeline.close()
+        return dict(pipeline.stats, error=error)
+    # 未修改的笔记只返回占位条目，不再拉取内容
+    known_versions = {} if full else pipeline.indexer.known_versions()
+    try:
+        pipeline.begin()
+        pipeline.process(trilium_service.iter_documents(known_versions=known_versions))
+
+        # 只有完整遍历且没有请求失败时才清理已删除的笔记并推进同步水位线
+        if trilium_service.last_load_complete:
+            pipeline.indexer.advance_watermark(pipeline.max_modified)
+        return pipeline.finish(remove_missing=trilium_service.last_load_complete)
+    finally:
+        pipeline.close()
+
+
+def run_export_ingest(config: Config, knowledge_base: KnowledgeBase,
+                      archive_path: str, prune: bool = False,
+                      ancestors: Optional[List[str]] = None) -> Dict[str, Any]:
+    """从Trilium导出的.zip归档导入知识库，不需要网络.
+
+    归档通常只是某个子树的导出，默认不删除任何笔记。归档根是整个知识库
+    （root）或指定 prune 时，删除位于导出子树中、但归档里已没有的笔记；
+    子树之外的笔记不受影响。
+
+    Args:
+        config: 应用程序配置.
+        knowledge_base: 要写入的知识库.
+        archive_path: 导出归档路径.
+        prune: 是否删除导出子树中已不存在的笔记.
+        ancestors: 导出根笔记在Trilium中的祖先笔记ID，用于补全子树过滤元数据.
+
+    Returns:
+        本次运行的统计.
+    """
+    reader = TriliumExportReader(archive_path, root_ancestors=ancestors)
+    pipeline = IngestPipeline(config, knowledge_base)
+    try:
+        pipeline.begin()
+        pipeline.process(reader.iter_documents())
+        # 只有全部成员读取成功时，归档才能作为导出子树的完整快照
+        if reader.last_load_complete and reader.root_ids and (prune or "root" in reader.root_ids):
+            indexed = pipeline.indexer.note_ids()
+            if "root" not in reader.root_ids:
+                in_subtree = knowledge_base.note_ids_in_subtree(reader.root_ids)
+                indexed = [note_id for note_id in indexed if note_id in in_subtree]
+            pipeline.remove([note_id for note_id in indexed if note_id not in pipeline.seen])
+        elif prune:
+            print("导出归档读取不完整，本次跳过删除")
+        return pipeline.finish(remove_missing=False)
+    finally:
+        pipeline.close()
+
+
+def run_trilium_delta_sync(config: Config, knowledge_base: KnowledgeBase,
+                           trilium_service: TriliumService, full_scan: bool = False) -> Dict[str, Any]:
+    """通过ETAPI搜索只同步水位线之后修改过的笔记.
+
+    没有水位线（从未完整导入过）或分块方式变化时退化为一次完整的增量导入。
+    full_scan 为True时额外遍历整个子树的元数据：未变化的笔记只产出带祖先和属性的
+    占位条目，移动或修改标签的笔记借此改写过滤元数据；缺少的笔记（例如从子树外移入、
+    修改时间早于水位线）被补充拉取；遍历完整时清单中多出的笔记被删除。
+
+    Args:
+        config: 应用程序配置.
+        knowledge_base: 要写入的知识库.
+        trilium_service: Trilium服务.
+        full_scan: 是否完整遍历子树的元数据.
+
+    Returns:
+        本次运行的统计，mode 字段为 delta 或 full.
+    """
+    pipeline = IngestPipeline(config, knowledge_base)
+    indexer = pipeline.indexer
+    since = indexer.sync_watermark
+    if not since or not trilium_service.loader or indexer.needs_reprocessing():
+        pipeline.close()
+        return dict(run_trilium_ingest(config, knowledge_base, trilium_service), mode="full")
+
+    known_versions = indexer.known_versions()
+    try:
+        pipeline.begin()
+        pipeline.process(trilium_service.iter_changed_documents(since, known_versions=known_versions))
+        complete = trilium_service.last_load_complete
+
+        if full_scan:
+            # 已在增量阶段处理过的笔记会被流水线跳过
+            pipeline.process(trilium_service.iter_documents(known_versions=known_versions))
+            if trilium_service.last_load_complete:
+                pipeline.remove([note_id for note_id in indexer.note_ids() if note_id not in pipeline.seen])
+            else:
+                print("完整遍历不完整，本次跳过删除检测")
+                complete = False
+
+        # 有内容请求失败时不推进水位线，下次同步会重新拉取这些笔记
+        if complete:
+            indexer.advance_watermark(pipeline.max_modified)
+        stats = pipeline.finish(remove_missing=False)
+        return dict(stats, mode="delta", watermark=indexer.sync_watermark)
+    finally:
+        pipeline.close()
+
+
+class BackgroundReindexer:
+    """在后台线程中运行重新索引任务，同一时间最多只有一个任务.
+
+    任务运行期间收到的请求会被合并为一次后续运行，因此连续的变更
+    不会排起长队；查询服务在任务运行期间继续使用当前索引。
+    """
+
+    def __init__(self, job: Callable[[], Dict[str, Any]]) -> None:
+        """初始化后台重新索引器.
+
+        Args:
+            job: 执行一次重新索引并返回统计的函数.
+        """
+        self.job = job
+        self.runs = 0
+        self.last_stats: Optional[Dict[str, Any]] = None
+        self.last_error: Optional[str] = None
+        self.last_started_at: Optional[str] = None
+        self.last_finished_at: Optional[str] = None
+        self._running = False
+        self._pending = False
+        self._lock = threading.Lock()
+
+    def request(self) -> bool:
+        """请求一次重新索引.
+
+        Returns:
+            True表示立即启动了新任务；False表示已有任务在运行，本次请求将在其结束后合并执行.
+        """
+        with self._lock:
+            if self._running:
+                self._pending = True
+                return False
+            self._running = True
+        thread = threading.Thread(target=self._loop, name="reindex", daemon=True)
+        thread.start()
+        return True
+
+    def _loop(self) -> None:
+        """运行任务，直到没有待处理的请求."""
+        while True:
+            self.last_started_at = datetime.now(timezone.utc).isoformat()
+            print("后台重新索引开始")
+            try:
+                self.last_stats = self.job()
+                self.last_error = (self.last_stats or {}).get("error")
+            except Exception as e:
+                print(f"后台重新索引失败: {e}")
+                self.last_error = str(e)
+            self.runs += 1
+            self.last_finished_at = datetime.now(timezone.utc).isoformat()
+
+            with self._lock:
+                if not self._pending:
+                    self._running = False
+                    return
+                self._pending = False
+
+    def status(self) -> Dict[str, Any]:
+        """返回重新索引任务的状态."""
+        with self._lock:
+            running = self._running
+            pending = self._pending
+        return {
+            "running": running,
+            "pending": pending,
+            "runs": self.runs,
+            "last_started_at": self.last_started_at,
+            "last_finished_at": self.last_finished_at,
+            "last_stats": self.last_stats,
+            "last_error": self.last_error,
+        }
@@ -1,21 +1,25 @@
 # -*- coding: utf-8 -*-
 """知识库管理服务."""
 
+from app.core.chunker import StructureAwareChunker, TokenCounter
 from app.core.config import Config
+from app.core.embedding_cache import CachedEmbeddings, EmbeddingCache
+from app.core.lexical_index import LexicalIndex
+from app.core.note_filters import build_filter, filter_tags, replace_note_metadata, to_chroma_where
 
 # 尝试导入langchain组件
 try:
     # 使用社区版本导入路径
     from langchain_community.embeddings import HuggingFaceEmbeddings
     from langchain_community.vectorstores import Chroma
-    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from langchain.docstore.document import Document
     IMPORT_SUCCESS = True
 except ImportError as e:
     print(f"无法导入langchain组件: {e}")
     IMPORT_SUCCESS = False
     HuggingFaceEmbeddings = None
     Chroma = None
-    RecursiveCharacterTextSplitter = None
+    Document = None
 
 
 class KnowledgeBase:
@@ -30,73 +34,236 @@ class KnowledgeBase:
         self.config = config
         self.embedding_model = None
         self.vector_store = None
-        self.text_splitter = None
+        self.chunker = None
+        self.embedding_cache = None
+        self.lexical_index = None
+        # 未经缓存包装的嵌入模型，供批量嵌入阶段直接编码
+        self.base_embedding_model = None
         
         if IMPORT_SUCCESS and HuggingFaceEmbeddings and Chroma:
             try:
                 # 使用本地缓存的模型，避免网络连接问题
+                model_name = "./data/models/sentence-transformers/all-MiniLM-L6-v2"
                 self.embedding_model = HuggingFaceEmbeddings(
-                    model_name="./data/models/sentence-transformers/all-MiniLM-L6-v2",
+                    model_name=model_name,
                     cache_folder="./data/models"
                     # model_kwargs={'local_files_only': True}  # 强制只使用本地文件
                 )
+                self.base_embedding_model = self.embedding_model
                 print("嵌入模型初始化成功")
                 
+                # 文档和查询嵌入共用同一个持久化缓存
+                if config.embedding_cache_path:
+                    try:
+                        self.embedding_cache = EmbeddingCache(
+                            config.embedding_cache_path,
+                            model_id=model_name,
+                            max_entries=config.embedding_cache_max_entries,
+                            dtype=config.embedding_cache_dtype
+                        )
+                        self.embedding_model = CachedEmbeddings(self.embedding_model, self.embedding_cache)
+                        print("嵌入缓存初始化成功")
+                    except Exception as e:
+                        print(f"初始化嵌入缓存失败，将不使用缓存: {e}")
+                        self.embedding_cache = None
+                
                 self.vector_store = Chroma(
                     embedding_function=self.embedding_model,
                     persist_directory=config.vector_db_dir
                 )
                 print("向量存储初始化成功")
                 
-                # 只有在需要时才初始化文本分割器
-                # self.text_splitter = RecursiveCharacterTextSplitter(
-                #     chunk_size=1000,
-                #     chunk_overlap=200
-                # )
-                # print("文本分割器初始化成功")
+                # 与向量存储同步维护的BM25倒排索引，用于混合检索
+                if config.lexical_index_path:
+                    try:
+                        self.lexical_index = LexicalIndex(config.lexical_index_path, ngram=config.lexical_ngram)
+                        print("倒排索引初始化成功")
+                    except Exception as e:
+                        print(f"初始化倒排索引失败，将只使用向量检索: {e}")
+                        self.lexical_index = None
             except Exception as e:
                 print(f"初始化知识库组件时出错: {e}")
                 self.embedding_model = None
+                self.base_embedding_model = None
                 self.vector_store = None
-                self.text_splitter = None
         else:
             print("缺少必要的Langchain组件")
             self.embedding_model = None
             self.vector_store = None
-            self.text_splitter = None
     
-    def update_vector_store(self, documents) -> None:
-        """更新向量数据库.
+    def get_chunker(self) -> StructureAwareChunker:
+        """返回按嵌入模型token数切分文本的分块器（延迟初始化）.
         
-        Args:
-            documents: 要添加到向量存储的文档.
+        CHUNK_MAX_TOKENS 为0时使用嵌入模型的最大序列长度减去首尾两个特殊token，
+        all-MiniLM-L6-v2 为 256 - 2 = 254。
         """
-        # 延迟初始化文本分割器
-        if not self.text_splitter and RecursiveCharacterTextSplitter:
-            self.text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1000,
-                chunk_overlap=200
+        if self.chunker is None:
+            client = getattr(self.base_embedding_model, "client", None)
+            tokenizer = getattr(client, "tokenizer", None)
+            max_tokens = self.config.chunk_max_tokens
+            if max_tokens <= 0:
+                max_tokens = (getattr(client, "max_seq_length", None) or 256) - 2
+            self.chunker = StructureAwareChunker(
+                TokenCounter(tokenizer),
+                max_tokens=max_tokens,
+                overlap_tokens=self.config.chunk_overlap_tokens
             )
+            if tokenizer is None:
+                print("嵌入模型分词器不可用，文本块大小使用近似token数")
+        return self.chunker
+    
+    def split_documents(self, documents, structured: bool = True) -> list:
+        """将文档按标题、段落和代码块分割为适合嵌入的文本块.
+        
+        Args:
+            documents: 要分割的文档.
+            structured: 是否按文档结构切分；代码笔记应为False，按行切分.
             
+        Returns:
+            文本块列表，每块不超过嵌入模型的token窗口.
+        """
+        return self.get_chunker().split_documents(documents, structured=structured)
+    
+    def upsert_embeddings(self, documents, ids, embeddings, batch_size: int = 1000) -> None:
+        """写入已经计算好向量的文本块，不再经过嵌入模型.
+        
+        Args:
+            documents: 文本块.
+            ids: 与文本块一一对应的ID.
+            embeddings: 与文本块一一对应的向量.
+            batch_size: 每次写入向量存储的最大条目数.
+        """
         if not IMPORT_SUCCESS or not self.vector_store:
-            print("向量存储未正确初始化")
+            raise RuntimeError("向量存储未正确初始化")
+        collection = self.vector_store._collection
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            collection.upsert(
+                ids=list(ids[start:end]),
+                embeddings=list(embeddings[start:end]),
+                metadatas=[doc.metadata for doc in documents[start:end]],
+                documents=[doc.page_content for doc in documents[start:end]]
+            )
+        if self.lexical_index:
+            self.lexical_index.upsert(
+                list(ids),
+                [doc.page_content for doc in documents],
+                [filter_tags(doc.metadata) for doc in documents]
+            )
+    
+    def update_note_metadata(self, ids, filters) -> None:
+        """替换文本块的子树和标签元数据，复用已存储的向量，不经过嵌入模型.
+        
+        Args:
+            ids: 同一笔记的文本块ID.
+            filters: note_metadata 返回的新过滤元数据.
+        """
+        if not IMPORT_SUCCESS or not self.vector_store:
+            raise RuntimeError("向量存储未正确初始化")
+        if not ids:
+            return
+        collection = self.vector_store._collection
+        result = collection.get(ids=list(ids), include=["embeddings", "documents", "metadatas"])
+        if not result["ids"]:
             return
+        metadatas = [replace_note_metadata(metadata or {}, filters) for metadata in result["metadatas"]]
+        # update 会合并元数据，旧的祖先和标签键会残留，因此整条覆盖写回
+        collection.upsert(
+            ids=result["ids"],
+            embeddings=result["embeddings"],
+            metadatas=metadatas,
+            documents=result["documents"]
+        )
+        if self.lexical_index:
+            self.lexical_index.set_tags(result["ids"], [filter_tags(metadata) for metadata in metadatas])
+    
+    def delete_documents(self, ids) -> None:
+        """按ID删除文本块.
+        
+        Args:
+            ids: 要删除的文本块ID.
+        """
+        if not IMPORT_SUCCESS or not self.vector_store:
+            raise RuntimeError("向量存储未正确初始化")
+        if ids:
+            self.vector_store.delete(ids=list(ids))
+            if self.lexical_index:
+                self.lexical_index.delete(list(ids))
+    
+    def search_by_vectors(self, embeddings, k: int, where=None) -> list:
+        """用多个查询向量一次检索向量存储.
+        
+        Args:
+            embeddings: 查询向量列表.
+            k: 每个查询返回的文本块数.
+            where: Chroma元数据过滤条件（可选）.
             
-        try:
-            # 如果没有文本分割器，直接使用原始文档
-            if self.text_splitter:
-                # 分割文档
-                texts = self.text_splitter.split_documents(documents)
-            else:
-                # 直接使用原始文档
-                texts = documents
+        Returns:
+            与查询一一对应的 [(Document, 距离), ...] 列表.
+        """
+        if not IMPORT_SUCCESS or not self.vector_store or not embeddings:
+            return []
+        kwargs = {"where": where} if where else {}
+        result = self.vector_store._collection.query(
+            query_embeddings=[list(vector) for vector in embeddings],
+            n_results=k,
+            include=["documents", "metadatas", "distances"],
+            **kwargs
+        )
+        return [
+            [
+                (Document(page_content=text or "", metadata=metadata or {}), float(distance))
+                for text, metadata, distance in zip(texts, metadatas, distances)
+            ]
+            for texts, metadatas, distances in zip(
+                result["documents"], result["metadatas"], result["distances"]
+            )
+        ]
+    
+    def get_documents(self, ids) -> list:
+        """按ID从向量存储中取回文本块.
+        
+        Args:
+            ids: 文本块ID.
             
-            # 更新向量数据库
-            self.vector_store.add_documents(texts)
+        Returns:
+            与输入顺序一致的Document列表，不存在的ID被跳过.
+        """
+        if not IMPORT_SUCCESS or not self.vector_store or not ids:
+            return []
+        result = self.vector_store._collection.get(ids=list(ids), include=["documents", "metadatas"])
+        found = {
+            chunk_id: Document(page_content=text or "", metadata=metadata or {})
+            for chunk_id, text, metadata in zip(result["ids"], result["documents"], result["metadatas"])
+        }
+        return [found[chunk_id] for chunk_id in ids if chunk_id in found]
+    
+    def note_ids_in_subtree(self, root_ids) -> set:
+        """返回已索引的、位于给定子树中的笔记ID（包括子树根笔记本身）.
+        
+        Args:
+            root_ids: 子树根笔记ID.
+            
+        Returns:
+            笔记ID集合.
+        """
+        where = to_chroma_where(build_filter(subtree=root_ids))
+        if not IMPORT_SUCCESS or not self.vector_store or where is None:
+            return set()
+        result = self.vector_store._collection.get(where=where, include=["metadatas"])
+        return {metadata["note_id"] for metadata in result["metadatas"] if metadata and metadata.get("note_id")}
+    
+    def persist(self) -> None:
+        """将向量存储持久化到磁盘."""
+        if self.vector_store:
             self.vector_store.persist()
-            print(f"成功添加 {len(texts)} 个文档到向量存储")
-        except Exception as e:
-            print(f"更新向量存储时出错: {e}")
+    
+    def close(self) -> None:
+        """关闭倒排索引和嵌入缓存的数据库连接."""
+        if self.lexical_index is not None:
+            self.lexical_index.close()
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
     
     def semantic_search(self, query: str, k: int = 5):
         """执行语义搜索以查找相关文档.
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""与向量索引并存的BM25倒排索引及结果融合."""
+
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+_CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+# 连续的CJK字符，或由字母、数字、下划线组成的词（保留错误码、标识符等完整形式）
+_TOKEN_PATTERN = re.compile(rf"[{_CJK_RANGES}]+|[^\W{_CJK_RANGES}]+")
+_CJK_PATTERN = re.compile(rf"[{_CJK_RANGES}]")
+
+# BM25参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str, ngram: int = 2) -> List[str]:
+    """将文本切分为检索词.
+
+    非CJK文本按词切分并转为小写；CJK文本没有空格分隔，按字符 n-gram 切分，
+    长度不足 n 的片段整体作为一个词。
+
+    Args:
+        text: 文本.
+        ngram: CJK字符 n-gram 的长度.
+
+    Returns:
+        检索词列表.
+    """
+    tokens = []
+    for run in _TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).casefold()):
+        if _CJK_PATTERN.match(run):
+            if len(run) <= ngram:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + ngram] for i in range(len(run) - ngram + 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Hashable]], k: int = 60) -> List[Tuple[Hashable, float]]:
+    """用倒数排名融合（RRF）合并多个排序结果.
+
+    Args:
+        rankings: 多个按相关性排序的键列表.
+        k: RRF常数，越大则排名靠后的结果权重衰减越慢.
+
+    Returns:
+        按融合分数降序排列的 (键, 分数) 列表.
+    """
+    scores: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class LexicalIndex:
+    """存储在SQLite中的BM25倒排索引.
+
+    文本块用整数ID编号，倒排表以 (词, 文本块) 为主键且不带rowid，
+    只存储词频，因此体积紧凑；按文本块ID增量写入和删除，
+    与向量存储中的文本块一一对应。
+    """
+
+    def __init__(self, path: str, ngram: int = 2) -> None:
+        """初始化倒排索引.
+
+        Args:
+            path: SQLite数据库文件路径.
+            ngram: CJK字符 n-gram 的长度.
+        """
+        self.path = path
+        self.ngram = max(1, ngram)
+        self._lock = threading.Lock()
+        self._corpus_stats = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " id INTEGER PRIMARY KEY,"
+            " chunk_id TEXT NOT NULL UNIQUE,"
+            " length INTEGER NOT NULL"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " term TEXT NOT NULL,"
+            " chunk INTEGER NOT NULL,"
+            " tf INTEGER NOT NULL,"
+            " PRIMARY KEY (term, chunk)"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings (chunk)")
+        # 文本块的子树和标签过滤键，检索时把过滤条件下推到倒排表查询
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tags ("
+            " tag TEXT NOT NULL,"
+            " chunk INTEGER NOT NULL,"
+            " PRIMARY KEY (tag, chunk)"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tags_chunk ON tags (chunk)")
+        self._conn.commit()
+
+    def _delete(self, chunk_ids: Sequence[str]) -> None:
+        """删除文本块及其倒排记录（调用方需持有锁）."""
+        for start in range(0, len(chunk_ids), 500):
+            batch = list(chunk_ids[start:start + 500])
+            placeholders = ",".join("?" * len(batch))
+            rows = self._conn.execute(
+                f"SELECT id FROM chunks WHERE chunk_id IN ({placeholders})", batch
+            ).fetchall()
+            if not rows:
+                continue
+            internal = [row[0] for row in rows]
+            id_placeholders = ",".join("?" * len(internal))
+            self._conn.execute(f"DELETE FROM postings WHERE chunk IN ({id_placeholders})", internal)
+            self._conn.execute(f"DELETE FROM tags WHERE chunk IN ({id_placeholders})", internal)
+            self._conn.execute(f"DELETE FROM chunks WHERE id IN ({id_placeholders})", internal)
+
+    def upsert(self, chunk_ids: Sequence[str], texts: Sequence[str],
+               tags: Optional[Sequence[Sequence[str]]] = None) -> None:
+        """写入或覆盖文本块.
+
+        Args:
+            chunk_ids: 文本块ID.
+            texts: 与ID一一对应的文本.
+            tags: 与ID一一对应的过滤键列表（可选）.
+        """
+        if not chunk_ids:
+            return
+        tags = tags if tags is not None else [()] * len(chunk_ids)
+        with self._lock:
+            self._delete(chunk_ids)
+            for chunk_id, text, chunk_tags in zip(chunk_ids, texts, tags):
+                counts = Counter(tokenize(text, self.ngram))
+                cursor = self._conn.execute(
+                    "INSERT INTO chunks (chunk_id, length) VALUES (?, ?)",
+                    (chunk_id, sum(counts.values()))
+                )
+                internal = cursor.lastrowid
+                self._conn.executemany(
+                    "INSERT INTO postings (term, chunk, tf) VALUES (?, ?, ?)",
+                    [(term, internal, tf) for term, tf in counts.items()]
+                )
+                if chunk_tags:
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO tags (tag, chunk) VALUES (?, ?)",
+                        [(tag, internal) for tag in chunk_tags]
+                    )
+            self._conn.commit()
+            self._corpus_stats = None
+
+    def set_tags(self, chunk_ids: Sequence[str], tags: Sequence[Sequence[str]]) -> None:
+        """替换文本块的过滤键，不改动倒排记录.
+
+        Args:
+            chunk_ids: 文本块ID，不存在的ID被跳过.
+            tags: 与ID一一对应的过滤键列表.
+        """
+        if not chunk_ids:
+            return
+        with self._lock:
+            for chunk_id, chunk_tags in zip(chunk_ids, tags):
+                row = self._conn.execute("SELECT id FROM chunks WHERE chunk_id = ?", (chunk_id,)).fetchone()
+                if row is None:
+                    continue
+                self._conn.execute("DELETE FROM tags WHERE chunk = ?", (row[0],))
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO tags (tag, chunk) VALUES (?, ?)",
+                    [(tag, row[0]) for tag in chunk_tags]
+                )
+            self._conn.commit()
+
+    def delete(self, chunk_ids: Sequence[str]) -> None:
+        """删除文本块.
+
+        Args:
+            chunk_ids: 文本块ID.
+        """
+        if not chunk_ids:
+            return
+        with self._lock:
+            self._delete(chunk_ids)
+            self._conn.commit()
+            self._corpus_stats = None
+
+    def _stats(self) -> Tuple[int, float]:
+        """返回文本块总数和平均长度（调用方需持有锁）."""
+        if self._corpus_stats is None:
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks").fetchone()
+            self._corpus_stats = (count, (total / count) if count else 0.0)
+        return self._corpus_stats
+
+    @staticmethod
+    def _filter_sql(groups: Sequence[Sequence[str]]) -> Tuple[str, List[str]]:
+        """把过滤键分组转换为限定文本块的子查询.
+
+        Args:
+            groups: 过滤键分组，组内为"或"，组间为"与".
+
+        Returns:
+            (附加到倒排表查询的条件, 参数).
+        """
+        selects = []
+        params: List[str] = []
+        for group in groups:
+            selects.append(f"SELECT chunk FROM tags WHERE tag IN ({','.join('?' * len(group))})")
+            params.extend(group)
+        return f" AND p.chunk IN ({' INTERSECT '.join(selects)})", params
+
+    def search(self, query: str, k: int = 20,
+               tag_filter: Optional[Sequence[Sequence[str]]] = None) -> List[Tuple[str, float]]:
+        """按BM25分数检索文本块.
+
+        Args:
+            query: 查询文本.
+            k: 返回的结果数.
+            tag_filter: 过滤键分组（组内为"或"，组间为"与"），只检索满足条件的文本块.
+
+        Returns:
+            按分数降序排列的 (文本块ID, 分数) 列表.
+        """
+        terms = list(dict.fromkeys(tokenize(query, self.ngram)))
+        if not terms:
+            return []
+        groups = [group for group in tag_filter or [] if group]
+        filter_sql, filter_params = self._filter_sql(groups) if groups else ("", [])
+        scores: Dict[int, float] = {}
+        with self._lock:
+            count, average_length = self._stats()
+            if not count:
+                return []
+            for term in terms:
+                # 文档频率按整个语料统计，过滤只限定参与打分的文本块
+                document_frequency = self._conn.execute(
+                    "SELECT COUNT(*) FROM postings WHERE term = ?", (term,)
+                ).fetchone()[0] if groups else None
+                rows = self._conn.execute(
+                    "SELECT p.chunk, p.tf, c.length FROM postings p JOIN chunks c ON c.id = p.chunk "
+                    f"WHERE p.term = ?{filter_sql}",
+                    (term, *filter_params)
+                ).fetchall()
+                if not rows:
+                    continue
+                df = document_frequency if document_frequency is not None else len(rows)
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                for chunk, tf, length in rows:
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (average_length or 1))
+                    scores[chunk] = scores.get(chunk, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+            if not scores:
+                return []
+            top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            placeholders = ",".join("?" * len(top))
+            names = dict(self._conn.execute(
+                f"SELECT id, chunk_id FROM chunks WHERE id IN ({placeholders})",
+                [chunk for chunk, _ in top]
+            ).fetchall())
+        return [(names[chunk], score) for chunk, score in top if chunk in names]
+
+    def stats(self) -> Dict[str, Any]:
+        """返回索引规模（使用缓存的语料统计，不扫描倒排表）."""
+        with self._lock:
+            count, average_length = self._stats()
+        return {
+            "chunks": count,
+            "average_length": round(average_length, 1),
+            "ngram": self.ngram,
+        }
+
+    def close(self) -> None:
+        """关闭数据库连接."""
+        with self._lock:
+            self._conn.close()
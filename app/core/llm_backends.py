@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""可替换的本地语言模型后端."""
+
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from app.core.config import Config
+
+# 尝试导入langchain组件
+try:
+    from langchain_community.llms import GPT4All
+    from langchain_core.callbacks import BaseCallbackHandler
+    LANGCHAIN_IMPORTED = True
+except ImportError:
+    LANGCHAIN_IMPORTED = False
+    GPT4All = None
+    BaseCallbackHandler = object
+
+# 尝试导入llama.cpp绑定
+try:
+    from llama_cpp import Llama
+except ImportError:
+    Llama = None
+
+
+class GenerationCancelled(Exception):
+    """生成过程被调用方取消."""
+
+
+class _TokenCallbackHandler(BaseCallbackHandler):
+    """将GPT4All生成回调中的每个token转发给调用方，并记录第一个token的时间."""
+
+    # 让取消异常穿透回调管理器，从而中断生成循环
+    raise_error = True
+
+    def __init__(self, on_token: Optional[Callable[[str], None]] = None,
+                 should_stop: Optional[Callable[[], bool]] = None) -> None:
+        """初始化回调处理器.
+
+        Args:
+            on_token: 每生成一个token时调用（可选）.
+            should_stop: 返回True时中断生成.
+        """
+        self.on_token = on_token
+        self.should_stop = should_stop
+        self.tokens = 0
+        self.first_token_at: Optional[float] = None
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        """处理新生成的token."""
+        if self.should_stop and self.should_stop():
+            raise GenerationCancelled()
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.tokens += 1
+        if self.on_token:
+            self.on_token(token)
+
+
+def _common_prefix(first: List[int], second: List[int]) -> int:
+    """返回两个token序列的公共前缀长度."""
+    length = 0
+    for a, b in zip(first, second):
+        if a != b:
+            break
+        length += 1
+    return length
+
+
+class LLMBackend:
+    """语言模型后端的公共接口."""
+
+    name = "none"
+
+    def __init__(self, config: Config) -> None:
+        """初始化后端.
+
+        Args:
+            config: 应用程序配置.
+        """
+        self.config = config
+        self.max_tokens = config.llm_max_tokens
+
+    @property
+    def available(self) -> bool:
+        """模型是否已成功加载."""
+        return False
+
+    @property
+    def langchain_llm(self):
+        """可用于langchain链的模型对象，后端不支持时为None."""
+        return None
+
+    def count_tokens(self, text: str) -> Optional[int]:
+        """用模型自己的分词器统计token数，不支持时返回None."""
+        return None
+
+    def cache_prefix(self, prefix: str) -> None:
+        """预先计算所有提示共用的前缀，后端不支持时忽略."""
+
+    def generate(self, prompt: str, on_token: Optional[Callable[[str], None]] = None,
+                 should_stop: Optional[Callable[[], bool]] = None,
+                 stats: Optional[Dict[str, Any]] = None) -> str:
+        """生成文本.
+
+        Args:
+            prompt: 完整提示.
+            on_token: 每生成一个token时调用（可选）.
+            should_stop: 返回True时中断生成.
+            stats: 本次生成的统计（可选），后端就地写入已知的 prompt_tokens、
+                completion_tokens、prefill_seconds 和 decode_seconds.
+
+        Returns:
+            生成的文本.
+
+        Raises:
+            GenerationCancelled: 生成被should_stop中断.
+        """
+        raise RuntimeError("语言模型不可用")
+
+    def stats(self) -> Dict[str, Any]:
+        """返回后端的配置和统计."""
+        return {"backend": self.name, "available": self.available}
+
+    def close(self) -> None:
+        """释放后端占用的资源."""
+
+
+class GPT4AllBackend(LLMBackend):
+    """通过langchain调用GPT4All模型."""
+
+    name = "gpt4all"
+
+    def __init__(self, config: Config) -> None:
+        """初始化GPT4All后端.
+
+        Args:
+            config: 应用程序配置.
+        """
+        super().__init__(config)
+        self.llm = None
+        if not (LANGCHAIN_IMPORTED and GPT4All):
+            print("Langchain不可用。LLM服务已禁用。")
+            return
+        try:
+            # 检查模型文件是否存在
+            if not os.path.exists(config.llm_model_path):
+                print(f"模型文件不存在: {config.llm_model_path}")
+                return
+
+            # streaming=True 使生成回调逐token触发
+            self.llm = GPT4All(
+                model=config.llm_model_path,
+                streaming=True,
+                verbose=False,
+                n_threads=config.llm_n_threads or None,
+                n_ctx=config.llm_n_ctx,
+                n_batch=config.llm_n_batch,
+                max_tokens=config.llm_max_tokens,
+                n_predict=config.llm_max_tokens
+            )
+            print("LLM初始化成功")
+        except Exception as e:
+            print(f"初始化LLM失败: {e}")
+            # 尝试使用更简单的参数初始化
+            try:
+                self.llm = GPT4All(model=config.llm_model_path)
+                print("LLM使用简化参数初始化成功")
+            except Exception as e2:
+                print(f"再次尝试初始化LLM失败: {e2}")
+                self.llm = None
+
+    @property
+    def available(self) -> bool:
+        """模型是否已成功加载."""
+        return self.llm is not None
+
+    @property
+    def langchain_llm(self):
+        """langchain的GPT4All对象."""
+        return self.llm
+
+    def count_tokens(self, text: str) -> Optional[int]:
+        """使用langchain提供的分词器统计token数."""
+        return self.llm.get_num_tokens(text) if self.llm is not None else None
+
+    def generate(self, prompt: str, on_token: Optional[Callable[[str], None]] = None,
+                 should_stop: Optional[Callable[[], bool]] = None,
+                 stats: Optional[Dict[str, Any]] = None) -> str:
+        """生成文本，需要逐token输出或可取消时通过回调转发.
+
+        不使用回调时无法区分预填充和解码，stats 保持不变.
+        """
+        if self.llm is None:
+            raise RuntimeError("语言模型不可用")
+        if on_token is None and should_stop is None:
+            return self.llm.invoke(prompt)
+        handler = _TokenCallbackHandler(on_token, should_stop)
+        start = time.perf_counter()
+        text = self.llm.invoke(prompt, config={"callbacks": [handler]})
+        end = time.perf_counter()
+        if stats is not None and handler.first_token_at is not None:
+            stats.update(
+                completion_tokens=handler.tokens,
+                prefill_seconds=handler.first_token_at - start,
+                decode_seconds=end - handler.first_token_at
+            )
+        return text
+
+    def stats(self) -> Dict[str, Any]:
+        """返回后端的配置."""
+        return dict(
+            super().stats(),
+            n_threads=self.config.llm_n_threads or None,
+            n_ctx=self.config.llm_n_ctx,
+            n_batch=self.config.llm_n_batch,
+            max_tokens=self.max_tokens
+        )
+
+
+class LlamaCppBackend(LLMBackend):
+    """通过llama.cpp运行GGUF模型，并复用固定提示前缀的KV缓存.
+
+    所有提示共用的指令前缀在加载时只计算一次，其KV状态保存在内存中；
+    每个请求开始前若模型当前的KV状态与前缀不一致，就恢复保存的状态，
+    之后llama.cpp只需对前缀之后的token做预填充。模型对象不是线程安全的，
+    生成过程由锁串行化。
+    """
+
+    name = "llama_cpp"
+
+    def __init__(self, config: Config, vocab_only: bool = False) -> None:
+        """初始化llama.cpp后端.
+
+        Args:
+            config: 应用程序配置.
+            vocab_only: 只加载分词器而不加载权重，用于在其他进程生成时统计token数.
+        """
+        super().__init__(config)
+        self.model = None
+        self.n_ctx = config.llm_n_ctx
+        self.prefix_cache_enabled = config.llm_prefix_cache
+        self._lock = threading.Lock()
+        self._prefix_tokens: List[int] = []
+        self._prefix_state = None
+        self.requests = 0
+        self.prefix_reused = 0
+        self.prompt_tokens = 0
+        self.prefill_seconds = 0.0
+        self.completion_tokens = 0
+        self.decode_seconds = 0.0
+
+        if Llama is None:
+            print("llama-cpp-python不可用。LLM服务已禁用。")
+            return
+        if not os.path.exists(config.llm_model_path):
+            print(f"模型文件不存在: {config.llm_model_path}")
+            return
+        try:
+            # 权重通过mmap加载，多个进程可以共享同一份页缓存
+            self.model = Llama(
+                model_path=config.llm_model_path,
+                n_ctx=config.llm_n_ctx,
+                n_threads=config.llm_n_threads or None,
+                n_batch=config.llm_n_batch,
+                use_mmap=True,
+                vocab_only=vocab_only,
+                verbose=False
+            )
+            if not vocab_only:
+                print("LLM初始化成功（llama.cpp）")
+        except Exception as e:
+            print(f"初始化llama.cpp模型失败: {e}")
+            self.model = None
+
+    @property
+    def available(self) -> bool:
+        """模型是否已成功加载."""
+        return self.model is not None
+
+    def _tokenize(self, text: str, add_bos: bool) -> List[int]:
+        """使用模型的分词器切分文本."""
+        return self.model.tokenize(text.encode("utf-8"), add_bos=add_bos)
+
+    def count_tokens(self, text: str) -> Optional[int]:
+        """使用模型的分词器统计token数."""
+        if self.model is None:
+            return None
+        return len(self._tokenize(text, add_bos=False))
+
+    def cache_prefix(self, prefix: str) -> None:
+        """计算固定前缀的KV状态并保存.
+
+        Args:
+            prefix: 所有提示共用的开头部分.
+        """
+        if self.model is None or not self.prefix_cache_enabled or not prefix:
+            return
+        with self._lock:
+            try:
+                start = time.perf_counter()
+                tokens = self._tokenize(prefix, add_bos=True)
+                self.model.reset()
+                self.model.eval(tokens)
+                self._prefix_state = self.model.save_state()
+                self._prefix_tokens = list(tokens)
+                print(
+                    f"提示前缀的KV状态已缓存: {len(tokens)} 个token，"
+                    f"耗时 {time.perf_counter() - start:.2f} 秒"
+                )
+            except Exception as e:
+                print(f"缓存提示前缀失败，将对完整提示做预填充: {e}")
+                self._prefix_state = None
+                self._prefix_tokens = []
+
+    def _restore_prefix(self, tokens: List[int]) -> int:
+        """必要时恢复前缀的KV状态（调用方需持有锁）.
+
+        Returns:
+            可以直接复用的前缀token数.
+        """
+        if self._prefix_state is None:
+            return 0
+        # 前缀末尾的token可能与后续文本合并切分，因此按最长公共前缀比较
+        shared = _common_prefix(self._prefix_tokens, tokens)
+        if not shared:
+            return 0
+        # 上一个请求同样以该前缀开头时，KV缓存中已经有这部分，无需恢复
+        current = list(self.model.input_ids[:self.model.n_tokens])
+        if _common_prefix(current, tokens) < shared:
+            self.model.load_state(self._prefix_state)
+        return shared
+
+    def generate(self, prompt: str, on_token: Optional[Callable[[str], None]] = None,
+                 should_stop: Optional[Callable[[], bool]] = None,
+                 stats: Optional[Dict[str, Any]] = None) -> str:
+        """生成文本，stats 中写入全部四项统计.
+
+        Raises:
+            GenerationCancelled: 生成被should_stop中断.
+            ValueError: 提示超出上下文窗口.
+        """
+        if self.model is None:
+            raise RuntimeError("语言模型不可用")
+        tokens = self._tokenize(prompt, add_bos=True)
+        if len(tokens) >= self.n_ctx:
+            raise ValueError(f"提示有 {len(tokens)} 个token，超出上下文窗口 {self.n_ctx}")
+        max_tokens = max(1, min(self.max_tokens, self.n_ctx - len(tokens)))
+
+        with self._lock:
+            reused = self._restore_prefix(tokens)
+            pieces = []
+            start = time.perf_counter()
+            first_token_at = None
+            # create_completion 会跳过与当前KV缓存相同的前缀，只预填充其余token
+            for chunk in self.model.create_completion(tokens, max_tokens=max_tokens, stream=True):
+                if should_stop and should_stop():
+                    raise GenerationCancelled()
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                text = chunk["choices"][0].get("text", "")
+                if text:
+                    pieces.append(text)
+                    if on_token:
+                        on_token(text)
+            end = time.perf_counter()
+
+            self.requests += 1
+            self.prefix_reused += reused
+            self.prompt_tokens += len(tokens)
+            self.prefill_seconds += (first_token_at or end) - start
+            self.completion_tokens += len(pieces)
+            self.decode_seconds += end - (first_token_at or end)
+        if stats is not None:
+            stats.update(
+                prompt_tokens=len(tokens),
+                completion_tokens=len(pieces),
+                prefill_seconds=(first_token_at or end) - start,
+                decode_seconds=end - (first_token_at or end)
+            )
+        return "".join(pieces)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回后端的配置和预填充统计."""
+        return dict(
+            super().stats(),
+            n_threads=self.config.llm_n_threads or None,
+            n_ctx=self.n_ctx,
+            n_batch=self.config.llm_n_batch,
+            max_tokens=self.max_tokens,
+            prefix_tokens=len(self._prefix_tokens),
+            requests=self.requests,
+            prompt_tokens=self.prompt_tokens,
+            prefix_tokens_reused=self.prefix_reused,
+            prefill_seconds=round(self.prefill_seconds, 3),
+            decode_tokens_per_second=(
+                round(self.completion_tokens / self.decode_seconds, 2) if self.decode_seconds else None
+            )
+        )
+
+
+# 可通过 LLM_BACKEND 选择的后端
+BACKENDS = {
+    GPT4AllBackend.name: GPT4AllBackend,
+    LlamaCppBackend.name: LlamaCppBackend,
+}
+
+
+def create_backend(config: Config) -> LLMBackend:
+    """按配置创建语言模型后端.
+
+    Args:
+        config: 应用程序配置.
+
+    Returns:
+        后端实例；未知的后端名称退回GPT4All.
+    """
+    backend_class = BACKENDS.get(config.llm_backend)
+    if backend_class is None:
+        print(f"未知的LLM后端 {config.llm_backend}，使用 {GPT4AllBackend.name}")
+        backend_class = GPT4AllBackend
+    return backend_class(config)
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""在多个进程中运行语言模型实例的工作池."""
+
+import copy
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from app.core.config import Config
+from app.core.llm_backends import (
+    GenerationCancelled,
+    LLMBackend,
+    LlamaCppBackend,
+    create_backend
+)
+
+# 等待工作进程回复时检查取消和进程存活的间隔（秒）
+_POLL_INTERVAL = 0.1
+# 关闭工作池时等待进行中的请求完成的最长时间（秒）
+_DRAIN_TIMEOUT = 120.0
+
+
+def _worker_main(config: Config, conn, prefix: Optional[str]) -> None:
+    """工作进程入口：加载模型后循环处理父进程发来的请求.
+
+    消息格式（父进程 -> 工作进程）:
+        ("generate", request_id, prompt, stream)
+        ("cancel", request_id)
+        ("prefix", prefix)
+        ("stop",)
+    回复格式:
+        ("ready", available)、("token", text)、("done", text, stats)、
+        ("cancelled",)、("error", message)、("ok",)
+    """
+    backend = create_backend(config)
+    if backend.available and prefix:
+        backend.cache_prefix(prefix)
+    conn.send(("ready", backend.available))
+    # 生成期间收到停止消息时，中断当前生成并在回复后退出
+    stopping = False
+
+    while not stopping:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        kind = message[0]
+        if kind == "stop":
+            break
+        if kind == "prefix":
+            backend.cache_prefix(message[1])
+            conn.send(("ok",))
+            continue
+        if kind != "generate":
+            # 请求已结束后才到达的取消消息
+            continue
+
+        _, request_id, prompt, stream = message
+        cancelled = False
+
+        def should_stop() -> bool:
+            nonlocal cancelled, stopping
+            while not cancelled and conn.poll():
+                incoming = conn.recv()
+                if incoming[0] == "stop":
+                    stopping = cancelled = True
+                elif incoming[0] == "cancel" and incoming[1] == request_id:
+                    cancelled = True
+            return cancelled
+
+        def on_token(text: str) -> None:
+            conn.send(("token", text))
+
+        try:
+            stats: Dict[str, Any] = {}
+            text = backend.generate(
+                prompt, on_token=on_token if stream else None, should_stop=should_stop, stats=stats
+            )
+            conn.send(("done", text, stats))
+        except GenerationCancelled:
+            conn.send(("cancelled",))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+class _Worker:
+    """父进程中对一个工作进程的记录."""
+
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.available = False
+        self.requests = 0
+        self.restarts = 0
+        self.tokens = 0
+        self.decode_seconds = 0.0
+
+
+class WorkerCrashedError(RuntimeError):
+    """工作进程在处理请求时退出."""
+
+
+class LLMWorkerPool(LLMBackend):
+    """由多个模型进程组成的语言模型后端.
+
+    每个工作进程各自加载一个模型实例。模型权重通过mmap映射同一个文件，
+    各进程共享操作系统的页缓存，常驻内存不会随进程数成倍增加，
+    额外开销主要是每个实例的KV缓存和计算缓冲区。请求交给空闲的工作进程，
+    全部繁忙时排队等待；工作进程崩溃后自动重启。关闭时先拒绝新请求，
+    等待已开始（包括正在排队）的请求完成后再停止工作进程。
+    """
+
+    name = "pool"
+
+    def __init__(self, config: Config, workers: int) -> None:
+        """初始化并启动工作池.
+
+        Args:
+            config: 应用程序配置.
+            workers: 工作进程数.
+        """
+        super().__init__(config)
+        self.num_workers = max(1, workers)
+        # 未指定线程数时在各工作进程之间平分CPU核心
+        self.threads_per_worker = config.llm_n_threads or max(1, (os.cpu_count() or 1) // self.num_workers)
+        self._worker_config = copy.copy(config)
+        self._worker_config.llm_n_threads = self.threads_per_worker
+        self._context = multiprocessing.get_context("spawn")
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._lock = threading.Lock()
+        # 已进入 generate 或 cache_prefix 的调用数，关闭时等待其归零
+        self._active = 0
+        self._drained = threading.Condition(self._lock)
+        self._request_ids = itertools.count(1)
+        self._prefix: Optional[str] = None
+        self._closed = False
+        self._busy = 0
+        self._busy_since = 0.0
+        self.busy_seconds = 0.0
+        self.failed = 0
+
+        # 父进程只加载分词器用于统计token数（仅llama_cpp支持）
+        self._tokenizer = None
+        if config.llm_backend == LlamaCppBackend.name:
+            tokenizer = LlamaCppBackend(config, vocab_only=True)
+            self._tokenizer = tokenizer if tokenizer.available else None
+
+        self.workers: List[_Worker] = [_Worker(index) for index in range(self.num_workers)]
+        start = time.perf_counter()
+        for worker in self.workers:
+            self._spawn(worker)
+        for worker in self.workers:
+            self._wait_ready(worker)
+            self._idle.put(worker)
+        ready = sum(1 for worker in self.workers if worker.available)
+        print(
+            f"已启动 {self.num_workers} 个LLM工作进程（可用 {ready} 个，每个 {self.threads_per_worker} 个线程），"
+            f"耗时 {time.perf_counter() - start:.2f} 秒"
+        )
+
+    def _spawn(self, worker: _Worker) -> None:
+        """启动工作进程，不等待模型加载完成."""
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(self._worker_config, child_conn, self._prefix),
+            name=f"llm-worker-{worker.index}",
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        worker.process = process
+        worker.conn = parent_conn
+        worker.available = False
+
+    def _wait_ready(self, worker: _Worker) -> None:
+        """等待工作进程加载模型."""
+        try:
+            _, available = worker.conn.recv()
+            worker.available = available
+        except (EOFError, OSError) as e:
+            print(f"LLM工作进程 {worker.index} 启动失败: {e}")
+            worker.available = False
+
+    def _restart(self, worker: _Worker) -> None:
+        """结束并重新启动工作进程."""
+        self._stop_process(worker)
+        if self._closed:
+            return
+        worker.restarts += 1
+        print(f"重启LLM工作进程 {worker.index}（第 {worker.restarts} 次）")
+        self._spawn(worker)
+        self._wait_ready(worker)
+
+    @staticmethod
+    def _stop_process(worker: _Worker, timeout: float = 5.0) -> None:
+        """结束工作进程并关闭管道."""
+        process = worker.process
+        if process is None:
+            return
+        if process.is_alive():
+            try:
+                worker.conn.send(("stop",))
+            except (OSError, ValueError):
+                pass
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout)
+        try:
+            worker.conn.close()
+        except OSError:
+            pass
+        worker.process = None
+
+    def _enter(self) -> None:
+        """登记一个进行中的调用，工作池已关闭时抛出异常."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("LLM工作池已关闭")
+            self._active += 1
+
+    def _exit(self) -> None:
+        """注销一个进行中的调用."""
+        with self._lock:
+            self._active -= 1
+            if self._active == 0:
+                self._drained.notify_all()
+
+    def _acquire(self) -> _Worker:
+        """取出一个空闲的工作进程，全部繁忙时等待."""
+        worker = self._idle.get()
+        if worker.process is None or not worker.process.is_alive():
+            self._restart(worker)
+        with self._lock:
+            if self._busy == 0:
+                self._busy_since = time.perf_counter()
+            self._busy += 1
+        return worker
+
+    def _release(self, worker: _Worker) -> None:
+        """把工作进程放回空闲队列."""
+        with self._lock:
+            self._busy -= 1
+            if self._busy == 0:
+                self.busy_seconds += time.perf_counter() - self._busy_since
+        self._idle.put(worker)
+
+    def _receive(self, worker: _Worker, should_stop: Optional[Callable[[], bool]],
+                 on_cancel: Callable[[], None]):
+        """等待工作进程的下一条回复，期间检查取消和进程存活."""
+        while True:
+            if should_stop and should_stop():
+                on_cancel()
+            if worker.conn.poll(_POLL_INTERVAL):
+                try:
+                    return worker.conn.recv()
+                except EOFError:
+                    pass
+            if not worker.process.is_alive():
+                worker.process.join()
+                raise WorkerCrashedError(f"LLM工作进程 {worker.index} 已退出（exitcode={worker.process.exitcode}）")
+
+    @property
+    def available(self) -> bool:
+        """是否至少有一个工作进程成功加载了模型."""
+        return any(worker.available for worker in self.workers)
+
+    def count_tokens(self, text: str) -> Optional[int]:
+        """使用父进程中的分词器统计token数，不可用时返回None."""
+        return self._tokenizer.count_tokens(text) if self._tokenizer else None
+
+    def cache_prefix(self, prefix: str) -> None:
+        """让每个工作进程缓存提示前缀；重启的进程也会使用该前缀."""
+        self._prefix = prefix
+        self._enter()
+        try:
+            for _ in self.workers:
+                worker = self._acquire()
+                try:
+                    if worker.available:
+                        worker.conn.send(("prefix", prefix))
+                        self._receive(worker, None, lambda: None)
+                except (EOFError, OSError, WorkerCrashedError) as e:
+                    print(f"LLM工作进程 {worker.index} 缓存提示前缀失败: {e}")
+                    self._stop_process(worker)
+                finally:
+                    self._release(worker)
+        finally:
+            self._exit()
+
+    def generate(self, prompt: str, on_token: Optional[Callable[[str], None]] = None,
+                 should_stop: Optional[Callable[[], bool]] = None,
+                 stats: Optional[Dict[str, Any]] = None) -> str:
+        """在空闲的工作进程中生成文本，stats 中写入工作进程中后端报告的统计.
+
+        Raises:
+            GenerationCancelled: 生成被should_stop中断.
+            WorkerCrashedError: 工作进程在生成过程中退出（下次取用时自动重启）.
+        """
+        self._enter()
+        try:
+            return self._generate(prompt, on_token, should_stop, stats)
+        finally:
+            self._exit()
+
+    def _generate(self, prompt: str, on_token: Optional[Callable[[str], None]],
+                  should_stop: Optional[Callable[[], bool]], stats: Optional[Dict[str, Any]]) -> str:
+        """取用一个工作进程完成一次生成."""
+        worker = self._acquire()
+        request_id = next(self._request_ids)
+        cancel_sent = False
+
+        def send_cancel() -> None:
+            nonlocal cancel_sent
+            if not cancel_sent:
+                worker.conn.send(("cancel", request_id))
+                cancel_sent = True
+
+        try:
+            if not worker.available:
+                raise RuntimeError(f"LLM工作进程 {worker.index} 未能加载模型")
+            worker.conn.send(("generate", request_id, prompt, on_token is not None))
+            while True:
+                reply = self._receive(worker, should_stop, send_cancel)
+                kind = reply[0]
+                if kind == "token":
+                    if on_token:
+                        on_token(reply[1])
+                elif kind == "done":
+                    _, text, reply_stats = reply
+                    worker.requests += 1
+                    worker.tokens += reply_stats.get("completion_tokens", 0)
+                    worker.decode_seconds += reply_stats.get("decode_seconds", 0.0)
+                    if stats is not None:
+                        stats.update(reply_stats)
+                    return text
+                elif kind == "cancelled":
+                    raise GenerationCancelled()
+                elif kind == "error":
+                    raise RuntimeError(reply[1])
+        except (EOFError, OSError, WorkerCrashedError) as e:
+            self.failed += 1
+            print(f"LLM工作进程 {worker.index} 异常: {e}")
+            # 下次取用该工作进程时重新启动
+            self._stop_process(worker)
+            raise WorkerCrashedError(str(e)) from e
+        finally:
+            self._release(worker)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回工作池的配置和吞吐量统计."""
+        with self._lock:
+            busy_seconds = self.busy_seconds
+            if self._busy:
+                busy_seconds += time.perf_counter() - self._busy_since
+            busy = self._busy
+        tokens = sum(worker.tokens for worker in self.workers)
+        return dict(
+            super().stats(),
+            model_backend=self.config.llm_backend,
+            workers=self.num_workers,
+            busy_workers=busy,
+            threads_per_worker=self.threads_per_worker,
+            failed_requests=self.failed,
+            completion_tokens=tokens,
+            # 至少有一个工作进程在生成期间的总吞吐量
+            aggregate_tokens_per_second=round(tokens / busy_seconds, 2) if busy_seconds else None,
+            worker_stats=[
+                {
+                    "index": worker.index,
+                    "pid": worker.process.pid if worker.process else None,
+                    "available": worker.available,
+                    "requests": worker.requests,
+                    "restarts": worker.restarts,
+                    "tokens_per_second": (
+                        round(worker.tokens / worker.decode_seconds, 2) if worker.decode_seconds else None
+                    ),
+                }
+                for worker in self.workers
+            ]
+        )
+
+    def close(self, timeout: float = _DRAIN_TIMEOUT) -> None:
+        """拒绝新请求，等待进行中的请求完成后停止所有工作进程.
+
+        Args:
+            timeout: 最长等待秒数，超时后仍在生成的请求会因工作进程停止而失败.
+        """
+        with self._lock:
+            self._closed = True
+            if not self._drained.wait_for(lambda: self._active == 0, timeout):
+                print(f"LLM工作池关闭时仍有 {self._active} 个请求未完成，强制停止工作进程")
+        for worker in self.workers:
+            self._stop_process(worker)
@@ -1,16 +1,14 @@
 # -*- coding: utf-8 -*-
 """Trilium知识体代理的语言模型服务."""
 
+from app.core.chunker import TokenCounter
 from app.core.config import Config
-import os
+from app.core.llm_backends import GenerationCancelled, LLMBackend, create_backend
+from app.core.llm_pool import LLMWorkerPool
+from app.core.metrics import LLM_DECODE_TOKENS_PER_SECOND, LLM_TOKENS_TOTAL, QUERY_STAGE_SECONDS
+from typing import Any, Callable, Dict, Optional
 
-# 尝试导入langchain组件
-try:
-    from langchain_community.llms import GPT4All
-    LANGCHAIN_IMPORTED = True
-except ImportError:
-    LANGCHAIN_IMPORTED = False
-    GPT4All = None
+__all__ = ["GenerationCancelled", "LLMService"]
 
 
 class LLMService:
@@ -23,45 +21,113 @@ class LLMService:
             config: 应用程序配置.
         """
         self.config = config
-        self.llm = None
-        self._initialize_llm()
-    
-    def _initialize_llm(self) -> None:
-        """初始化语言模型."""
-        if LANGCHAIN_IMPORTED and GPT4All:
-            try:
-                # 检查模型文件是否存在
-                if not os.path.exists(self.config.llm_model_path):
-                    print(f"模型文件不存在: {self.config.llm_model_path}")
-                    self.llm = None
-                    return
-                    
-                # 尝试使用当前版本的参数
-                self.llm = GPT4All(
-                    model=self.config.llm_model_path,
-                    verbose=False
-                )
-                print("LLM初始化成功")
-            except Exception as e:
-                print(f"初始化LLM失败: {e}")
-                # 尝试使用更简单的参数初始化
-                try:
-                    self.llm = GPT4All(model=self.config.llm_model_path)
-                    print("LLM使用简化参数初始化成功")
-                except Exception as e2:
-                    print(f"再次尝试初始化LLM失败: {e2}")
-                    self.llm = None
+        # 语言模型的分词器不可用时使用近似计数
+        self._approximate_counter = TokenCounter()
+        self._exact_tokens = True
+        # 多个工作进程时每个进程各自加载模型，否则在当前进程加载
+        if config.llm_workers > 1:
+            self.backend: LLMBackend = LLMWorkerPool(config, config.llm_workers)
         else:
-            print("Langchain不可用。LLM服务已禁用。")
+            self.backend = create_backend(config)
+        # 仅GPT4All后端提供langchain模型对象
+        self.llm = self.backend.langchain_llm
+    
+    @property
+    def available(self) -> bool:
+        """语言模型是否可用."""
+        return self.backend.available
     
     def get_llm(self):
-        """获取语言模型实例.
+        """获取langchain语言模型实例.
         
         Returns:
-            语言模型实例，如果未初始化则返回None.
+            语言模型实例，如果未初始化或后端不提供则返回None.
         """
         return self.llm
     
+    def count_tokens(self, text: str) -> int:
+        """用语言模型的分词器统计token数.
+        
+        分词器不可用（例如离线环境无法加载）时退化为近似计数，之后不再重试.
+        
+        Args:
+            text: 文本.
+            
+        Returns:
+            token数.
+        """
+        if self.backend.available and self._exact_tokens:
+            try:
+                tokens = self.backend.count_tokens(text)
+                if tokens is not None:
+                    return tokens
+            except Exception as e:
+                print(f"无法使用语言模型的分词器，改用近似token计数: {e}")
+            self._exact_tokens = False
+        return self._approximate_counter.count(text)
+    
+    def cache_prompt_prefix(self, prefix: str) -> None:
+        """让后端预先计算所有提示共用的前缀.
+        
+        Args:
+            prefix: 提示模板中位于上下文之前的固定部分.
+        """
+        if self.backend.available:
+            self.backend.cache_prefix(prefix)
+    
+    def _generate(self, prompt: str, on_token: Optional[Callable[[str], None]] = None,
+                  should_stop: Optional[Callable[[], bool]] = None,
+                  timings: Optional[dict] = None, prompt_tokens: Optional[int] = None) -> str:
+        """调用后端生成文本，并记录后端报告的预填充和解码耗时.
+        
+        预填充耗时为开始生成到第一个token的时间，解码耗时为其后的时间；
+        后端没有报告（例如GPT4All不逐token生成时）的项不记录.
+        """
+        stats: Dict[str, Any] = {}
+        text = self.backend.generate(prompt, on_token=on_token, should_stop=should_stop, stats=stats)
+        # 后端用自己的分词器统计的提示token数优先，否则使用调用方已统计的值
+        prompt_tokens = stats.get("prompt_tokens", prompt_tokens)
+        completion_tokens = stats.get("completion_tokens")
+        prefill = stats.get("prefill_seconds")
+        decode = stats.get("decode_seconds")
+        if prompt_tokens is not None:
+            LLM_TOKENS_TOTAL.inc(prompt_tokens, kind="prompt")
+        if completion_tokens is not None:
+            LLM_TOKENS_TOTAL.inc(completion_tokens, kind="completion")
+        if prefill is not None:
+            QUERY_STAGE_SECONDS.observe(prefill, stage="llm_prefill")
+        if decode is not None:
+            QUERY_STAGE_SECONDS.observe(decode, stage="llm_decode")
+        tokens_per_second = (
+            completion_tokens / decode if decode and completion_tokens and completion_tokens > 1 else None
+        )
+        if tokens_per_second is not None:
+            LLM_DECODE_TOKENS_PER_SECOND.observe(tokens_per_second)
+        if timings is not None:
+            if prefill is not None:
+                timings["llm_prefill_ms"] = round(prefill * 1000, 2)
+            if decode is not None:
+                timings["llm_decode_ms"] = round(decode * 1000, 2)
+            if completion_tokens is not None:
+                timings["completion_tokens"] = completion_tokens
+            if tokens_per_second is not None:
+                timings["decode_tokens_per_second"] = round(tokens_per_second, 2)
+        return text
+    
+    def complete(self, prompt: str, timings: Optional[dict] = None,
+                 prompt_tokens: Optional[int] = None) -> str:
+        """使用语言模型生成文本，出错时抛出异常.
+        
+        Args:
+            prompt: 用于生成文本的提示.
+            timings: 用于记录预填充和解码耗时的字典（可选），会被就地更新.
+            prompt_tokens: 调用方已统计的提示token数（可选），后端不报告时用于计数.
+            
+        Returns:
+            生成的文本.
+        """
+        return self._generate(prompt, timings=timings, prompt_tokens=prompt_tokens)
+    
     def generate_text(self, prompt: str) -> str:
         """使用语言模型生成文本.
         
@@ -71,11 +137,54 @@ class LLMService:
         Returns:
             生成的文本.
         """
-        if not self.llm:
+        if not self.backend.available:
             return "语言模型不可用。"
         
         try:
-            return self.llm.invoke(prompt)
+            return self.complete(prompt)
         except Exception as e:
             print(f"生成文本时出错: {e}")
-            return "生成响应时出错。"
\ No newline at end of file
+            return "生成响应时出错。"
+    
+    def stream_text(self, prompt: str, on_token: Callable[[str], None],
+                    should_stop: Optional[Callable[[], bool]] = None,
+                    timings: Optional[dict] = None, prompt_tokens: Optional[int] = None) -> str:
+        """使用语言模型逐token生成文本.
+        
+        Args:
+            prompt: 用于生成文本的提示.
+            on_token: 每生成一个token时调用.
+            should_stop: 返回True时中断生成，用于客户端断开后停止计算.
+            timings: 用于记录预填充和解码耗时的字典（可选），会被就地更新.
+            prompt_tokens: 调用方已统计的提示token数（可选）.
+            
+        Returns:
+            已生成的完整文本.
+            
+        Raises:
+            GenerationCancelled: 生成被should_stop中断.
+        """
+        if not self.backend.available:
+            text = "语言模型不可用。"
+            on_token(text)
+            return text
+        
+        try:
+            return self._generate(prompt, on_token=on_token, should_stop=should_stop,
+                                  timings=timings, prompt_tokens=prompt_tokens)
+        except GenerationCancelled:
+            print("生成已被取消")
+            raise
+        except Exception as e:
+            print(f"流式生成文本时出错: {e}")
+            text = "生成响应时出错。"
+            on_token(text)
+            return text
+    
+    def stats(self) -> Dict[str, Any]:
+        """返回语言模型后端的配置和统计."""
+        return self.backend.stats()
+    
+    def close(self) -> None:
+        """释放语言模型后端（停止工作进程）."""
+        self.backend.close()
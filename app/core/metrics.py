@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""进程内的计数器和直方图，以Prometheus文本格式导出."""
+
+import bisect
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 延迟直方图的桶边界（秒），覆盖从毫秒级的检索到数十秒的CPU生成
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# 生成速度直方图的桶边界（token/秒）
+THROUGHPUT_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0)
+
+# 问答结果 timings 中的键（毫秒）与阶段名的对应关系；
+# 语言模型的预填充和解码耗时由 LLMService 在每次生成时直接记录，不在此列
+QUERY_STAGES = {
+    "cache_lookup_ms": "cache_lookup",
+    "embed_ms": "embed",
+    "batch_embed_ms": "embed",
+    "vector_search_ms": "vector_search",
+    "batch_vector_search_ms": "vector_search",
+    "lexical_search_ms": "lexical_search",
+    "fusion_ms": "fusion",
+    "rerank_ms": "rerank",
+    "context_ms": "context",
+    "generate_ms": "generate",
+}
+
+
+def _escape(value: str) -> str:
+    """转义标签值中的反斜杠、引号和换行."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    """把标签格式化为 {a="x",b="y"}."""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    """格式化样本值."""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """带标签的指标的公共部分."""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        """按标签名顺序取出标签值."""
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        """返回该指标的文本格式行."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """只增不减的计数器."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """增加计数.
+
+        Args:
+            amount: 增加量，不能为负.
+            **labels: 标签值.
+        """
+        if amount < 0:
+            raise ValueError("计数器只能增加")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """可以任意设置的当前值."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        """设置当前值."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def _samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    """按固定桶统计观测值分布的直方图."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签：(各桶计数（非累计）, 总和, 总数)
+        self._values: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """记录一个观测值.
+
+        Args:
+            value: 观测值.
+            **labels: 标签值.
+        """
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class MetricsRegistry:
+    """进程内所有指标的集合."""
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        """注册指标，同名指标只保留第一个."""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        """创建或获取计数器."""
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        """创建或获取当前值指标."""
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        """创建或获取直方图."""
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """以Prometheus文本格式（0.0.4）导出全部指标."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+QUERY_STAGE_SECONDS = REGISTRY.histogram(
+    "trilium_agent_query_stage_seconds",
+    "Time spent in each stage of answering a question.",
+    ["stage"]
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "trilium_agent_request_seconds",
+    "End-to-end time of question answering requests, including queueing.",
+    ["endpoint"]
+)
+ANSWERS_TOTAL = REGISTRY.counter(
+    "trilium_agent_answers_total",
+    "Answers returned, by endpoint and answer cache outcome.",
+    ["endpoint", "cache"]
+)
+LLM_TOKENS_TOTAL = REGISTRY.counter(
+    "trilium_agent_llm_tokens_total",
+    "Prompt and completion tokens processed by the language model.",
+    ["kind"]
+)
+LLM_DECODE_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "trilium_agent_llm_decode_tokens_per_second",
+    "Decode speed of each generation.",
+    buckets=THROUGHPUT_BUCKETS
+)
+INGEST_STAGE_SECONDS = REGISTRY.histogram(
+    "trilium_agent_ingest_stage_seconds",
+    "Time spent in each ingest stage per batch.",
+    ["stage"]
+)
+INGEST_DOCUMENTS_TOTAL = REGISTRY.counter(
+    "trilium_agent_ingest_documents_total",
+    "Documents processed by ingest, by outcome.",
+    ["result"]
+)
+INGEST_CHUNKS_TOTAL = REGISTRY.counter(
+    "trilium_agent_ingest_chunks_total",
+    "Chunks written to or deleted from the index.",
+    ["action"]
+)
+INFERENCE_TASKS = REGISTRY.gauge(
+    "trilium_agent_inference_tasks",
+    "Tasks currently running or queued in the inference executor.",
+    ["state"]
+)
+
+
+def record_answer(endpoint: str, result: dict, seconds: Optional[float] = None) -> None:
+    """记录一次回答的各阶段耗时和缓存结果.
+
+    Args:
+        endpoint: 端点名称.
+        result: 问答结果，timings 中以毫秒为单位的阶段耗时会被计入直方图.
+        seconds: 请求总耗时（秒，可选）.
+    """
+    for key, value in (result.get("timings") or {}).items():
+        stage = QUERY_STAGES.get(key)
+        if stage is not None and value is not None:
+            QUERY_STAGE_SECONDS.observe(value / 1000, stage=stage)
+    ANSWERS_TOTAL.inc(endpoint=endpoint, cache=result.get("cache") or "miss")
+    if seconds is not None:
+        REQUEST_SECONDS.observe(seconds, endpoint=endpoint)
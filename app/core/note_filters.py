@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""文本块的子树和标签元数据，以及查询时下推到检索的过滤条件."""
+
+from typing import Any, Dict, Iterable, List, Optional
+
+# 元数据格式版本，变化后已索引的笔记需要重新处理
+METADATA_VERSION = 1
+
+# Chroma的元数据不支持列表，每个祖先笔记和标签各写为一个布尔键
+ANCESTOR_PREFIX = "anc_"
+LABEL_PREFIX = "label_"
+
+
+def note_metadata(note_id: str, ancestors: Optional[Iterable[str]] = None,
+                  attributes: Optional[Iterable[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """生成一篇笔记的过滤元数据.
+
+    笔记自身也记为自己的祖先，因此按某个笔记过滤时包含该笔记本身。
+
+    Args:
+        note_id: 笔记ID.
+        ancestors: 祖先笔记ID，由近及远.
+        attributes: 笔记属性，只有 label 类型的属性会被记录.
+
+    Returns:
+        元数据字典：ancestors 和 labels 为逗号分隔的可读字段，其余为布尔过滤键.
+    """
+    ancestor_ids = [ancestor for ancestor in dict.fromkeys(ancestors or []) if ancestor]
+    labels = [
+        attr.get('name') for attr in attributes or []
+        if attr.get('type') == 'label' and attr.get('name')
+    ]
+    labels = list(dict.fromkeys(labels))
+
+    metadata: Dict[str, Any] = {
+        'ancestors': ",".join(ancestor_ids),
+        'labels': ",".join(labels)
+    }
+    for ancestor in [note_id, *ancestor_ids]:
+        if ancestor:
+            metadata[f"{ANCESTOR_PREFIX}{ancestor}"] = True
+    for label in labels:
+        metadata[f"{LABEL_PREFIX}{label}"] = True
+    return metadata
+
+
+def filter_tags(metadata: Dict[str, Any]) -> List[str]:
+    """从文本块元数据中取出过滤键.
+
+    Args:
+        metadata: 文本块元数据.
+
+    Returns:
+        值为True的祖先和标签键.
+    """
+    return [
+        key for key, value in metadata.items()
+        if value is True and (key.startswith(ANCESTOR_PREFIX) or key.startswith(LABEL_PREFIX))
+    ]
+
+
+def replace_note_metadata(metadata: Dict[str, Any], filters: Dict[str, Any]) -> Dict[str, Any]:
+    """用新的过滤元数据替换文本块元数据中的旧值.
+
+    Args:
+        metadata: 文本块元数据.
+        filters: note_metadata 返回的新过滤元数据.
+
+    Returns:
+        新的元数据字典，其余字段保持不变.
+    """
+    kept = {
+        key: value for key, value in metadata.items()
+        if key not in ('ancestors', 'labels')
+        and not key.startswith(ANCESTOR_PREFIX) and not key.startswith(LABEL_PREFIX)
+    }
+    kept.update(filters)
+    return kept
+
+
+def build_filter(subtree: Optional[Iterable[str]] = None,
+                 labels: Optional[Iterable[str]] = None) -> List[List[str]]:
+    """把查询的子树和标签条件转换为合取范式.
+
+    文本块位于任一给定子树中、并且带有所有给定标签时才会被检索到。
+
+    Args:
+        subtree: 子树根笔记ID，满足其一即可.
+        labels: 标签名，必须全部满足.
+
+    Returns:
+        过滤键分组的列表，组内为"或"，组间为"与"；没有条件时为空列表.
+    """
+    groups = []
+    roots = sorted({root for root in subtree or [] if root})
+    if roots:
+        groups.append([f"{ANCESTOR_PREFIX}{root}" for root in roots])
+    for label in sorted({label.lstrip("#") for label in labels or [] if label and label.lstrip("#")}):
+        groups.append([f"{LABEL_PREFIX}{label}"])
+    return groups
+
+
+def to_chroma_where(groups: List[List[str]]) -> Optional[Dict[str, Any]]:
+    """把过滤条件转换为Chroma的 where 表达式.
+
+    Args:
+        groups: build_filter 返回的过滤键分组.
+
+    Returns:
+        where 字典，没有条件时为None.
+    """
+    clauses = []
+    for group in groups:
+        terms = [{key: True} for key in group]
+        clauses.append(terms[0] if len(terms) == 1 else {"$or": terms})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def filter_scope(groups: List[List[str]]) -> str:
+    """返回过滤条件的规范化文本，用于区分不同过滤范围的缓存条目."""
+    return ";".join("|".join(group) for group in groups)
@@ -1,19 +1,30 @@
 # -*- coding: utf-8 -*-
 """Trilium知识体代理的问答服务."""
 
+from app.core.answer_cache import AnswerCache
 from app.core.config import Config
-from app.core.llm_service import LLMService
+from app.core.context_builder import ContextAssembler
+from app.core.indexer import IndexVersionTracker
+from app.core.lexical_index import reciprocal_rank_fusion
+from app.core.llm_service import GenerationCancelled, LLMService
 from app.core.knowledge_base import KnowledgeBase
+from app.core.note_filters import build_filter, filter_scope, to_chroma_where
+from app.core.reranker import CrossEncoderReranker
+from app.core.session_memory import SessionMemory
+from typing import Callable, List, Optional, Tuple
+import queue
+import threading
+import time
 
-# 尝试导入langchain组件
-try:
-    from langchain.chains import RetrievalQA
-    from langchain.memory import ConversationBufferMemory
-    LANGCHAIN_IMPORTED = True
-except ImportError:
-    LANGCHAIN_IMPORTED = False
-    RetrievalQA = None
-    ConversationBufferMemory = None
+# 与RetrievalQA "stuff" 链默认提示一致，保证流式和非流式回答行为相同
+PROMPT_TEMPLATE = (
+    "Use the following pieces of context to answer the question at the end. "
+    "If you don't know the answer, just say that you don't know, "
+    "don't try to make up an answer.\n\n"
+    "{context}\n\n"
+    "Question: {question}\n"
+    "Helpful Answer:"
+)
 
 
 class QAService:
@@ -31,65 +42,86 @@ class QAService:
         self.llm_service = llm_service
         self.knowledge_base = knowledge_base
         self.init_errors = []
+        self.retrieval_k = config.retrieval_k
         
-        # 初始化对话记忆
-        if LANGCHAIN_IMPORTED and ConversationBufferMemory:
+        # 答案缓存绑定索引版本，重新索引后自动失效
+        self.index_version_tracker = IndexVersionTracker(config.index_manifest_path)
+        self.answer_cache = None
+        if config.answer_cache_enabled:
+            self.answer_cache = AnswerCache(
+                max_entries=config.answer_cache_max_entries,
+                ttl_seconds=config.answer_cache_ttl,
+                similarity_threshold=config.answer_cache_similarity
+            )
+        
+        # 按语言模型的token数整理上下文，避免提示超出模型窗口；
+        # 提示和生成的答案共用上下文窗口，预算不能超过窗口减去最大生成token数
+        token_budget = config.context_token_budget
+        prompt_window = config.llm_n_ctx - config.llm_max_tokens
+        if prompt_window > 0 and (token_budget <= 0 or token_budget > prompt_window):
+            print(
+                f"上下文token预算 {token_budget} 超出模型窗口 {config.llm_n_ctx} 减去最大生成数 "
+                f"{config.llm_max_tokens}，调整为 {prompt_window}"
+            )
+            token_budget = prompt_window
+        self.context_assembler = ContextAssembler(
+            llm_service.count_tokens,
+            token_budget=token_budget,
+            dedup_threshold=config.context_dedup_threshold,
+            prompt_template=PROMPT_TEMPLATE
+        )
+        
+        # 交叉编码器重排序（可选）
+        self.reranker = None
+        if config.rerank_model:
             try:
-                self.memory = ConversationBufferMemory(
-                    memory_key="chat_history",
-                    return_messages=True
+                self.reranker = CrossEncoderReranker(
+                    config.rerank_model,
+                    time_budget_ms=config.rerank_budget_ms,
+                    batch_size=config.rerank_batch_size
                 )
             except Exception as e:
-                error_msg = f"初始化对话记忆失败: {e}"
+                error_msg = f"加载重排序模型失败: {e}"
                 print(error_msg)
                 self.init_errors.append(error_msg)
-                self.memory = None
-        else:
-            error_msg = "ConversationBufferMemory不可用"
+        
+        # 按会话隔离的对话记忆，历史放在上下文开头并计入token预算
+        try:
+            self.memory = SessionMemory(
+                llm_service.count_tokens,
+                window_tokens=config.memory_window_tokens,
+                summary_tokens=config.memory_summary_tokens,
+                max_sessions=config.memory_max_sessions,
+                idle_seconds=config.memory_idle_seconds,
+                persist_path=config.memory_persist_path
+            )
+        except Exception as e:
+            error_msg = f"初始化对话记忆失败: {e}"
+            print(error_msg)
             self.init_errors.append(error_msg)
             self.memory = None
         
-        # 获取LLM实例
-        self.llm = llm_service.get_llm()
-        if not self.llm:
+        # 回答由 llm_service 按 PROMPT_TEMPLATE 直接生成
+        if not llm_service.available:
+            print("LLM不可用")
             self.init_errors.append("LLM不可用")
-        
-        # 创建检索问答链
-        if (LANGCHAIN_IMPORTED and RetrievalQA and self.llm and 
-            self.knowledge_base.vector_store):
-            try:
-                self.qa_chain = RetrievalQA.from_chain_type(
-                    llm=self.llm,
-                    chain_type="stuff",
-                    retriever=self.knowledge_base.vector_store.as_retriever(),
-                    memory=self.memory,
-                    return_source_documents=True
-                )
-            except Exception as e:
-                error_msg = f"初始化问答链失败: {e}"
-                print(error_msg)
-                self.init_errors.append(error_msg)
-                self.qa_chain = None
         else:
-            self.qa_chain = None
-            if not LANGCHAIN_IMPORTED:
-                self.init_errors.append("Langchain未导入")
-            if not RetrievalQA:
-                self.init_errors.append("RetrievalQA不可用")
-            if not self.llm:
-                self.init_errors.append("LLM不可用")
-            if not self.knowledge_base.vector_store:
-                self.init_errors.append("向量存储不可用")
-            
-            # 打印错误信息
-            for error in self.init_errors:
-                print(error)
-    
-    def ask_question(self, question: str) -> dict:
+            # 模板中上下文之前的指令对所有问题相同，让后端预先计算
+            llm_service.cache_prompt_prefix(PROMPT_TEMPLATE.split("{context}")[0])
+        if not self.knowledge_base.vector_store:
+            print("向量存储不可用")
+            self.init_errors.append("向量存储不可用")
+    
+    def ask_question(self, question: str, subtree: Optional[List[str]] = None,
+                     labels: Optional[List[str]] = None,
+                     session_id: Optional[str] = None) -> dict:
         """提出问题并获得答案.
         
         Args:
             question: 要提出的问题.
+            subtree: 只在这些笔记的子树中检索（可选）.
+            labels: 只检索带有全部这些标签的笔记（可选）.
+            session_id: 会话ID，提供时使用并更新该会话的对话记忆（可选）.
             
         Returns:
             包含答案和来源的字典.
@@ -106,9 +138,22 @@ class QAService:
                 "sources": []
             }
         
-        # 尝试在知识库中搜索相关信息
+        # 相同或近似的问题直接返回缓存的答案（答案依赖对话历史时不使用缓存）
+        timings = {}
+        tag_filter = build_filter(subtree, labels)
+        scope = filter_scope(tag_filter)
+        history = self._history(session_id)
+        cached, query_embedding, index_version = (
+            self._lookup_cache(question, timings, scope) if not history else (None, None, None)
+        )
+        if cached:
+            self._save_memory(session_id, question, cached["answer"])
+            return cached
+        
+        # 尝试在知识库中搜索相关信息（只嵌入和检索一次，结果同时用于空结果判断和生成）
         try:
-            docs = self.knowledge_base.vector_store.similarity_search(question, k=3)
+            docs, scores = self._retrieve(question, query_embedding, timings, tag_filter)
+            docs, scores, prompt_tokens = self._assemble_context(question, docs, scores, timings, history)
         except Exception as e:
             error_details = ""
             if hasattr(self, 'init_errors') and self.init_errors:
@@ -118,6 +163,29 @@ class QAService:
                 "sources": []
             }
         
+        result, generated = self._answer_from_documents(question, docs, scores, timings, prompt_tokens, history)
+        if generated:
+            self._save_memory(session_id, question, result["answer"])
+            if not history:
+                self._cache_answer(question, index_version, query_embedding, result, scope)
+        return result
+    
+    def _answer_from_documents(self, question: str, docs: list, scores: list,
+                               timings: dict, prompt_tokens: Optional[int] = None,
+                               history: str = "") -> Tuple[dict, bool]:
+        """根据已检索到的文档生成答案.
+        
+        Args:
+            question: 用户问题.
+            docs: 整理后放入上下文的文档.
+            scores: 与文档一一对应的向量距离.
+            timings: 本次请求的各阶段耗时，会记录语言模型的预填充和解码耗时.
+            prompt_tokens: 提示的token数.
+            history: 放在上下文开头的对话历史（可选）.
+            
+        Returns:
+            (结果字典, 是否由语言模型生成)；只有语言模型生成的答案才应写入记忆和缓存.
+        """
         if not docs:
             error_details = ""
             if hasattr(self, 'init_errors') and self.init_errors:
@@ -125,18 +193,26 @@ class QAService:
             return {
                 "answer": f"{error_details}在知识库中未找到相关信息。",
                 "sources": []
-            }
+            }, False
+        
+        sources = self._format_sources(docs, scores)
         
-        # 如果LLM可用，使用它生成答案
-        if self.qa_chain:
+        # 如果LLM可用，用与"stuff"合并链相同的提示直接生成答案，不再重复检索；
+        # 经由llm_service生成才能记录预填充和解码耗时
+        if self.llm_service.available:
             try:
-                result = self.qa_chain({"query": question})
+                answer = self.llm_service.complete(
+                    self._build_prompt(question, docs, history), timings, prompt_tokens=prompt_tokens
+                )
                 return {
-                    "answer": result["result"],
-                    "sources": self._format_sources(result.get("source_documents", []))
-                }
+                    "answer": answer,
+                    "sources": sources,
+                    "retrieval_k": self.retrieval_k,
+                    "prompt_tokens": prompt_tokens,
+                    "timings": timings
+                }, True
             except Exception as e:
-                print(f"使用问答链时出错: {e}")
+                print(f"生成答案时出错: {e}")
         
         # 如果LLM不可用，提供基于检索的简单回答
         error_details = ""
@@ -144,31 +220,503 @@ class QAService:
             error_details = "问答服务初始化失败详情: " + "; ".join(self.init_errors) + "\n\n"
             
         # 即使没有LLM，也要返回基于检索的信息
+        answer_content = self._format_retrieval_answer(docs)
+        return {
+            "answer": f"{error_details}{answer_content}",
+            "sources": sources,
+            "retrieval_k": self.retrieval_k,
+            "prompt_tokens": prompt_tokens,
+            "timings": timings
+        }, False
+    
+    def stream_answer(self, question: str, emit: Callable[[str, object], None],
+                      should_stop: Optional[Callable[[], bool]] = None,
+                      subtree: Optional[List[str]] = None,
+                      labels: Optional[List[str]] = None,
+                      session_id: Optional[str] = None) -> dict:
+        """提出问题并以事件形式流式输出答案.
+        
+        检索完成后立即发送 "sources" 事件，随后每生成一个token发送一个 "token" 事件。
+        
+        Args:
+            question: 要提出的问题.
+            emit: 事件回调，参数为事件名和事件数据.
+            should_stop: 返回True时停止生成（例如客户端已断开）.
+            subtree: 只在这些笔记的子树中检索（可选）.
+            labels: 只检索带有全部这些标签的笔记（可选）.
+            session_id: 会话ID，提供时使用并更新该会话的对话记忆（可选）.
+            
+        Returns:
+            包含完整答案和来源的字典.
+            
+        Raises:
+            GenerationCancelled: 调用方在生成完成前请求停止.
+        """
+        # 排队期间客户端可能已经断开，此时无需再检索
+        if should_stop and should_stop():
+            raise GenerationCancelled()
+        
+        if not self.knowledge_base.vector_store:
+            result = self.ask_question(question, subtree=subtree, labels=labels, session_id=session_id)
+            emit("sources", result["sources"])
+            emit("token", result["answer"])
+            return result
+        
+        timings = {}
+        tag_filter = build_filter(subtree, labels)
+        scope = filter_scope(tag_filter)
+        history = self._history(session_id)
+        cached, query_embedding, index_version = (
+            self._lookup_cache(question, timings, scope) if not history else (None, None, None)
+        )
+        if cached:
+            emit("sources", cached["sources"])
+            emit("token", cached["answer"])
+            self._save_memory(session_id, question, cached["answer"])
+            return cached
+        
+        try:
+            docs, scores = self._retrieve(question, query_embedding, timings, tag_filter)
+            docs, scores, prompt_tokens = self._assemble_context(question, docs, scores, timings, history)
+        except Exception as e:
+            answer = f"搜索知识库时出错: {str(e)}"
+            emit("sources", [])
+            emit("token", answer)
+            return {"answer": answer, "sources": []}
+        
+        sources = self._format_sources(docs, scores)
+        emit("sources", sources)
+        
+        if not docs:
+            answer = "在知识库中未找到相关信息。"
+            emit("token", answer)
+            return {"answer": answer, "sources": []}
+        
+        if not self.llm_service.available:
+            answer = self._format_retrieval_answer(docs)
+            emit("token", answer)
+            return {"answer": answer, "sources": sources}
+        
+        prompt = self._build_prompt(question, docs, history)
+        answer = self.llm_service.stream_text(
+            prompt,
+            on_token=lambda token: emit("token", token),
+            should_stop=should_stop,
+            timings=timings,
+            prompt_tokens=prompt_tokens
+        )
+        self._save_memory(session_id, question, answer)
+        result = {
+            "answer": answer,
+            "sources": sources,
+            "retrieval_k": self.retrieval_k,
+            "prompt_tokens": prompt_tokens,
+            "timings": timings
+        }
+        if not history:
+            self._cache_answer(question, index_version, query_embedding, result, scope)
+        return result
+    
+    def ask_batch(self, questions: List[str],
+                  on_result: Optional[Callable[[dict], None]] = None,
+                  should_stop: Optional[Callable[[], bool]] = None,
+                  subtree: Optional[List[str]] = None,
+                  labels: Optional[List[str]] = None) -> List[dict]:
+        """批量回答一组问题.
+        
+        所有问题在一次编码器调用中嵌入，向量检索合并为一次多查询请求；
+        其余检索步骤（BM25融合、重排序）在后台线程中提前进行，
+        使第 i+1 个问题的检索与第 i 个问题的生成重叠。批量问答不写入对话记忆。
+        
+        Args:
+            questions: 问题列表.
+            on_result: 每个问题完成后按顺序调用，参数为带 index 和 question 字段的结果.
+            should_stop: 返回True时停止处理剩余问题（例如客户端已断开）.
+            subtree: 只在这些笔记的子树中检索（可选）.
+            labels: 只检索带有全部这些标签的笔记（可选）.
+            
+        Returns:
+            与问题一一对应的结果列表.
+            
+        Raises:
+            GenerationCancelled: 调用方在全部完成前请求停止.
+        """
+        results: List[dict] = []
+        
+        def deliver(index: int, result: dict) -> None:
+            item = dict(result, index=index, question=questions[index])
+            results.append(item)
+            if on_result:
+                on_result(item)
+        
+        embedding_model = self.knowledge_base.embedding_model
+        if not questions:
+            return results
+        if not self.knowledge_base.vector_store or not embedding_model:
+            for index, question in enumerate(questions):
+                if should_stop and should_stop():
+                    raise GenerationCancelled()
+                deliver(index, self.ask_question(question, subtree=subtree, labels=labels))
+            return results
+        
+        tag_filter = build_filter(subtree, labels)
+        scope = filter_scope(tag_filter)
+        index_version = self.index_version_tracker.current()
+        
+        # 一次编码器调用嵌入所有问题
+        start = time.perf_counter()
+        vectors = embedding_model.embed_documents(list(questions))
+        batch_timings = {"batch_embed_ms": round((time.perf_counter() - start) * 1000, 2)}
+        
+        cached_results = {}
+        if self.answer_cache:
+            for index, (question, vector) in enumerate(zip(questions, vectors)):
+                cached, kind, _ = self.answer_cache.lookup(
+                    question, index_version, lambda _question, vector=vector: vector, scope
+                )
+                if cached:
+                    cached_results[index] = dict(cached, cache=kind, timings=dict(batch_timings))
+        pending = [index for index in range(len(questions)) if index not in cached_results]
+        
+        # 未命中缓存的问题合并为一次多查询向量检索
+        vector_results = {}
+        if pending:
+            start = time.perf_counter()
+            try:
+                searched = self.knowledge_base.search_by_vectors(
+                    [vectors[index] for index in pending],
+                    self._fetch_k(),
+                    to_chroma_where(tag_filter)
+                )
+                vector_results = dict(zip(pending, searched))
+            except Exception as e:
+                print(f"批量向量检索失败: {e}")
+            batch_timings["batch_vector_search_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        
+        # 后台线程按顺序完成剩余检索步骤，最多领先生成 batch_prefetch 个问题
+        retrieved: "queue.Queue" = queue.Queue(maxsize=max(1, self.config.batch_prefetch))
+        stop = threading.Event()
+        
+        def retrieve_all() -> None:
+            for index in pending:
+                if stop.is_set():
+                    return
+                timings = dict(batch_timings)
+                try:
+                    if index in vector_results:
+                        docs, scores = self._refine(questions[index], vector_results[index], timings, tag_filter)
+                    else:
+                        docs, scores = self._retrieve(questions[index], vectors[index], timings, tag_filter)
+                    item = self._assemble_context(questions[index], docs, scores, timings)
+                except Exception as e:
+                    item = e
+                while not stop.is_set():
+                    try:
+                        retrieved.put((index, item, timings), timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+        
+        retriever = threading.Thread(target=retrieve_all, name="batch-retrieve", daemon=True)
+        retriever.start()
+        try:
+            for index, question in enumerate(questions):
+                if should_stop and should_stop():
+                    raise GenerationCancelled()
+                if index in cached_results:
+                    deliver(index, cached_results[index])
+                    continue
+                _, item, timings = retrieved.get()
+                if isinstance(item, Exception):
+                    deliver(index, {"answer": f"搜索知识库时出错: {str(item)}", "sources": []})
+                    continue
+                docs, scores, prompt_tokens = item
+                start = time.perf_counter()
+                result, generated = self._answer_from_documents(question, docs, scores, timings, prompt_tokens)
+                timings["generate_ms"] = round((time.perf_counter() - start) * 1000, 2)
+                if generated:
+                    self._cache_answer(question, index_version, vectors[index], result, scope)
+                deliver(index, result)
+        finally:
+            stop.set()
+        return results
+    
+    def close(self) -> None:
+        """停止重排序线程并关闭对话记忆."""
+        if self.reranker is not None:
+            self.reranker.close()
+        if self.memory is not None:
+            self.memory.close()
+    
+    def _lookup_cache(self, question: str, timings: Optional[dict] = None,
+                      scope: str = "") -> Tuple[Optional[dict], Optional[List[float]], int]:
+        """在答案缓存中查找问题.
+        
+        Args:
+            question: 用户问题.
+            timings: 用于记录耗时（毫秒）的字典，会被就地更新.
+            scope: 检索范围，只命中同一范围内缓存的答案.
+            
+        Returns:
+            (带 cache 字段的缓存结果或None, 问题向量或None, 当前索引版本)；
+            问题向量可直接用于检索，避免再次嵌入.
+        """
+        index_version = self.index_version_tracker.current()
+        if not self.answer_cache or not self.knowledge_base.embedding_model:
+            return None, None, index_version
+        start = time.perf_counter()
+        try:
+            cached, kind, vector = self.answer_cache.lookup(
+                question,
+                index_version,
+                self.knowledge_base.embedding_model.embed_query,
+                scope
+            )
+        except Exception as e:
+            print(f"查询答案缓存时出错: {e}")
+            return None, None, index_version
+        if timings is not None:
+            # 精确匹配未命中时包含问题嵌入的耗时
+            timings["cache_lookup_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        if cached:
+            return dict(cached, cache=kind, timings=dict(timings or {})), vector, index_version
+        return None, vector, index_version
+    
+    def _cache_answer(self, question: str, index_version: int,
+                      query_embedding: Optional[List[float]], result: dict, scope: str = "") -> None:
+        """缓存由语言模型生成的答案（不含本次请求的耗时）."""
+        if self.answer_cache and query_embedding is not None:
+            cached = {key: value for key, value in result.items() if key != "timings"}
+            self.answer_cache.put(question, index_version, query_embedding, cached, scope)
+    
+    def _retrieve(self, question: str, query_embedding: Optional[List[float]] = None,
+                  timings: Optional[dict] = None, tag_filter: Optional[List[List[str]]] = None):
+        """对问题执行一次检索.
+        
+        问题只被嵌入一次，返回的文档同时用于空结果判断和答案生成。
+        启用倒排索引时，向量检索和BM25检索各取若干候选，再用倒数排名融合合并；
+        启用重排序时，多取的候选再由交叉编码器批量打分，超过时间预算则保留原顺序。
+        子树和标签过滤作为元数据条件下推到向量检索和BM25检索中，而不是在检索后再筛选。
+        
+        Args:
+            question: 用户问题.
+            query_embedding: 已经计算好的问题向量，为空时在这里计算.
+            timings: 用于记录各阶段耗时（毫秒）的字典，会被就地更新.
+            tag_filter: build_filter 生成的过滤键分组（可选）.
+            
+        Returns:
+            (文档列表, 向量距离列表)，距离越小越相关；只由BM25检索到的文档距离为None.
+        """
+        timings = timings if timings is not None else {}
+        vector_store = self.knowledge_base.vector_store
+        fetch_k = self._fetch_k()
+        where = to_chroma_where(tag_filter or [])
+        search_kwargs = {"filter": where} if where else {}
+        
+        if query_embedding is None and self.knowledge_base.embedding_model:
+            start = time.perf_counter()
+            query_embedding = self.knowledge_base.embedding_model.embed_query(question)
+            timings["embed_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        
+        start = time.perf_counter()
+        if query_embedding is not None and hasattr(vector_store, "similarity_search_by_vector_with_relevance_scores"):
+            results = vector_store.similarity_search_by_vector_with_relevance_scores(
+                query_embedding,
+                k=fetch_k,
+                **search_kwargs
+            )
+        else:
+            results = vector_store.similarity_search_with_score(
+                question,
+                k=fetch_k,
+                **search_kwargs
+            )
+        timings["vector_search_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return self._refine(question, results, timings, tag_filter)
+    
+    def _fetch_k(self) -> int:
+        """向量检索的候选数：融合和重排序阶段需要多取一些候选."""
+        fetch_k = self.retrieval_k
+        if self.knowledge_base.lexical_index:
+            fetch_k = max(fetch_k, self.config.hybrid_candidates)
+        if self.reranker:
+            fetch_k = max(fetch_k, self.config.rerank_candidates)
+        return fetch_k
+    
+    def _refine(self, question: str, results: list, timings: dict,
+                tag_filter: Optional[List[List[str]]] = None):
+        """对向量检索结果做混合融合和重排序，截取前 retrieval_k 个.
+        
+        Args:
+            question: 用户问题.
+            results: 向量检索返回的 (文档, 距离) 列表.
+            timings: 用于记录各阶段耗时（毫秒）的字典，会被就地更新.
+            tag_filter: 过滤键分组（可选）.
+            
+        Returns:
+            (文档列表, 向量距离列表).
+        """
+        lexical_index = self.knowledge_base.lexical_index
+        fetch_k = self._fetch_k()
+        docs = [doc for doc, _ in results]
+        scores = [float(score) for _, score in results]
+        
+        if lexical_index:
+            start = time.perf_counter()
+            hits = lexical_index.search(question, k=self.config.hybrid_candidates, tag_filter=tag_filter)
+            timings["lexical_search_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            if hits:
+                start = time.perf_counter()
+                docs, scores = self._fuse(docs, scores, [chunk_id for chunk_id, _ in hits], fetch_k)
+                timings["fusion_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        
+        if self.reranker and len(docs) > 1:
+            start = time.perf_counter()
+            order = self.reranker.rerank(question, docs, self.retrieval_k)
+            timings["rerank_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            if order is not None:
+                docs = [docs[i] for i in order]
+                scores = [scores[i] for i in order]
+        return docs[:self.retrieval_k], scores[:self.retrieval_k]
+    
+    def _assemble_context(self, question: str, docs: list, scores: list,
+                          timings: dict, history: str = "") -> Tuple[list, list, Optional[int]]:
+        """合并、去重检索结果并按token预算装入上下文.
+        
+        Args:
+            question: 用户问题.
+            docs: 按相关性排序的文档.
+            scores: 与文档一一对应的向量距离.
+            timings: 用于记录耗时（毫秒）的字典，会被就地更新.
+            history: 放在上下文开头的对话历史，占用同一预算.
+            
+        Returns:
+            (放入上下文的文档, 对应的向量距离, 提示的token数).
+        """
+        if not docs:
+            return docs, scores, None
+        start = time.perf_counter()
+        docs, scores, stats = self.context_assembler.assemble(question, docs, scores, preamble=history)
+        timings["context_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return docs, scores, stats["prompt_tokens"]
+    
+    def _fuse(self, docs: list, scores: List[float], lexical_ids: List[str], limit: int):
+        """用倒数排名融合合并向量检索和BM25检索的结果.
+        
+        Args:
+            docs: 向量检索到的文档，按相关性排序.
+            scores: 与文档一一对应的向量距离.
+            lexical_ids: BM25检索到的文本块ID，按相关性排序.
+            limit: 保留的文档数.
+            
+        Returns:
+            (融合后的前 limit 个文档, 向量距离或None).
+        """
+        vector_keys = [
+            doc.metadata.get("chunk_id") or (doc.metadata.get("note_id"), doc.page_content)
+            for doc in docs
+        ]
+        by_key = {key: (doc, score) for key, doc, score in zip(vector_keys, docs, scores)}
+        fused = reciprocal_rank_fusion([vector_keys, lexical_ids], k=self.config.rrf_k)
+        selected = [key for key, _ in fused[:limit]]
+        
+        # 只由BM25检索到的文本块从向量存储中按ID一次取回
+        fetched = {}
+        missing = [key for key in selected if key not in by_key]
+        if missing:
+            fetched = {
+                doc.metadata.get("chunk_id"): doc
+                for doc in self.knowledge_base.get_documents(missing)
+            }
+        fused_docs, fused_scores = [], []
+        for key in selected:
+            if key in by_key:
+                doc, score = by_key[key]
+            elif key in fetched:
+                doc, score = fetched[key], None
+            else:
+                continue
+            fused_docs.append(doc)
+            fused_scores.append(score)
+        return fused_docs, fused_scores
+    
+    def _history(self, session_id: Optional[str]) -> str:
+        """读取会话的对话历史，没有会话或记忆不可用时返回空字符串.
+        
+        Args:
+            session_id: 会话ID.
+            
+        Returns:
+            要放在上下文开头的对话历史.
+        """
+        if not session_id or not self.memory:
+            return ""
+        try:
+            return self.memory.history(session_id)
+        except Exception as e:
+            print(f"读取对话记忆时出错: {e}")
+            return ""
+    
+    def _save_memory(self, session_id: Optional[str], question: str, answer: str) -> None:
+        """将一轮问答写入会话的对话记忆.
+        
+        Args:
+            session_id: 会话ID，为空时不记录.
+            question: 用户问题.
+            answer: 生成的答案.
+        """
+        if not session_id or not self.memory:
+            return
+        try:
+            self.memory.add_turn(session_id, question, answer)
+        except Exception as e:
+            print(f"保存对话记忆时出错: {e}")
+    
+    def _build_prompt(self, question: str, documents, history: str = "") -> str:
+        """将检索到的文档填入提示模板.
+        
+        Args:
+            question: 用户问题.
+            documents: 检索到的文档.
+            history: 放在上下文开头的对话历史（可选）.
+            
+        Returns:
+            完整的提示文本.
+        """
+        context = history + "\n\n".join(doc.page_content for doc in documents)
+        return PROMPT_TEMPLATE.format(context=context, question=question)
+    
+    def _format_retrieval_answer(self, documents) -> str:
+        """在LLM不可用时，将检索到的文档整理为回答.
+        
+        Args:
+            documents: 检索到的文档.
+            
+        Returns:
+            基于检索结果的回答文本.
+        """
         # 整合多个文档的内容，提供更全面的回答
         answer_parts = []
-        for i, doc in enumerate(docs, 1):
+        for i, doc in enumerate(documents, 1):
             content = doc.page_content[:800]  # 增加内容长度到800字符
             if len(doc.page_content) > 800:
                 content += "..."
             answer_parts.append(f"文档 {i}:\n{content}")
         
-        answer_content = "已找到相关文档，但语言模型不可用。以下是相关内容：\n\n" + "\n\n---\n\n".join(answer_parts)
-        return {
-            "answer": f"{error_details}{answer_content}",
-            "sources": self._format_sources(docs)
-        }
+        return "已找到相关文档，但语言模型不可用。以下是相关内容：\n\n" + "\n\n---\n\n".join(answer_parts)
     
-    def _format_sources(self, documents) -> list:
+    def _format_sources(self, documents, scores=None) -> list:
         """格式化源文档.
         
         Args:
             documents: 源文档.
+            scores: 与文档一一对应的检索分数（可选）.
             
         Returns:
             格式化的源.
         """
         sources = []
-        for doc in documents:
+        for i, doc in enumerate(documents):
             source = doc.metadata.get("source", "未知")
             title = doc.metadata.get("title", "未知标题")
             
@@ -193,6 +741,7 @@ class QAService:
                 "title": title,
                 "url": trilium_url,
                 "source": source,
-                "content": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content
+                "content": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content,
+                "score": round(scores[i], 4) if scores is not None and i < len(scores) and scores[i] is not None else None
             })
         return sources
\ No newline at end of file
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""在CPU上批量运行的交叉编码器重排序阶段."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional, Tuple
+
+# 尝试导入sentence-transformers组件
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:
+    CrossEncoder = None
+
+
+class CrossEncoderReranker:
+    """用交叉编码器对检索候选重新打分.
+
+    所有候选在一次批量前向计算中打分。每个请求有硬性的时间预算：
+    超时后直接返回原有的检索顺序，打分结果被丢弃。根据最近的单对耗时
+    预估候选数，使打分尽量在预算内完成；超时会把单对耗时的估计加倍，
+    且至少提高到预算除以候选数。上一次超时的打分仍在运行时，新请求直接跳过重排序，
+    不在打分线程后面排队。
+    """
+
+    def __init__(self, model_name: str, time_budget_ms: float = 300, batch_size: int = 32,
+                 max_length: int = 256) -> None:
+        """初始化重排序器.
+
+        Args:
+            model_name: 交叉编码器模型路径或名称.
+            time_budget_ms: 每个请求的打分时间预算（毫秒），0表示不限制.
+            batch_size: 前向计算的批大小.
+            max_length: 问题和文本块拼接后的最大token数.
+
+        Raises:
+            RuntimeError: sentence-transformers 不可用.
+        """
+        if CrossEncoder is None:
+            raise RuntimeError("sentence-transformers不可用，无法加载交叉编码器")
+        self.model = CrossEncoder(model_name, max_length=max_length, device="cpu")
+        self.model_name = model_name
+        self.time_budget = time_budget_ms / 1000 if time_budget_ms > 0 else None
+        self.batch_size = batch_size
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.skipped = 0
+        # 单对候选打分耗时的指数移动平均（秒）
+        self._seconds_per_pair: Optional[float] = None
+        self._lock = threading.Lock()
+        # 最近一次提交的打分任务，超时后可能仍在运行
+        self._pending = None
+        # 打分在单独的线程中进行，超时后请求线程不再等待
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+
+    def _score(self, pairs: List[Tuple[str, str]]) -> Tuple[List[float], float]:
+        """批量计算候选分数并返回耗时."""
+        start = time.perf_counter()
+        scores = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+        return [float(score) for score in scores], time.perf_counter() - start
+
+    def _affordable(self, count: int, top_k: int) -> int:
+        """根据历史耗时估算预算内能打分的候选数."""
+        if not self.time_budget or not self._seconds_per_pair:
+            return count
+        return max(top_k, min(count, int(self.time_budget * 0.8 / self._seconds_per_pair)))
+
+    def rerank(self, question: str, documents: list, top_k: int) -> Optional[List[int]]:
+        """对候选文档重新排序.
+
+        Args:
+            question: 用户问题.
+            documents: 按检索顺序排列的候选文档.
+            top_k: 保留的文档数.
+
+        Returns:
+            按新顺序排列的前 top_k 个候选下标；超时、出错或上一次打分仍在运行时返回None，
+                调用方应保留原顺序.
+        """
+        if len(documents) <= 1:
+            return list(range(len(documents)))[:top_k]
+        with self._lock:
+            self.calls += 1
+            if self._pending is not None and not self._pending.done():
+                self.skipped += 1
+                return None
+            count = self._affordable(len(documents), top_k)
+            pairs = [(question, doc.page_content) for doc in documents[:count]]
+            future = self._pending = self._executor.submit(self._score, pairs)
+
+        try:
+            scores, elapsed = future.result(timeout=self.time_budget)
+        except FutureTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+                # 实际单对耗时至少为预算除以候选数；已有估计时加倍，下次候选数至少减半
+                floor = self.time_budget / len(pairs)
+                self._seconds_per_pair = max((self._seconds_per_pair or 0.0) * 2, floor)
+            print(f"重排序超过时间预算 {self.time_budget * 1000:.0f} 毫秒，使用检索顺序")
+            return None
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            print(f"重排序时出错，使用检索顺序: {e}")
+            return None
+
+        with self._lock:
+            per_pair = elapsed / len(pairs)
+            self._seconds_per_pair = (
+                per_pair if self._seconds_per_pair is None
+                else 0.8 * self._seconds_per_pair + 0.2 * per_pair
+            )
+        order = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        return order[:top_k]
+
+    def stats(self) -> Dict[str, Any]:
+        """返回重排序统计."""
+        with self._lock:
+            return {
+                "model": self.model_name,
+                "calls": self.calls,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+                "skipped": self.skipped,
+                "time_budget_ms": self.time_budget * 1000 if self.time_budget else None,
+                "ms_per_pair": round(self._seconds_per_pair * 1000, 3) if self._seconds_per_pair else None,
+            }
+
+    def close(self) -> None:
+        """停止打分线程."""
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""进程级服务容器，管理问答相关组件的生命周期."""
+
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from app.core.config import Config, get_config
+from app.core.inference_executor import InferenceExecutor
+from app.core.ingest_pipeline import BackgroundReindexer, run_trilium_delta_sync, run_trilium_ingest
+from app.core.llm_service import LLMService
+from app.core.knowledge_base import KnowledgeBase
+from app.core.qa_service import QAService
+from app.core.trilium_integration import TriliumService, TriliumSyncPoller, TriliumWatcher
+
+# 重新加载后等待旧组件上的请求完成的最长时间（秒）
+_RETIRE_TIMEOUT = 300.0
+
+
+class ServiceContainer:
+    """在进程生命周期内持有 LLMService、KnowledgeBase 和 QAService 的单一实例.
+
+    组件只加载一次并在所有请求间共享；重新加载时先在锁外构建新组件，
+    再原子地替换引用，因此正在处理的请求会继续使用旧组件完成。对话记忆
+    交给新组件，其余旧组件在替换前提交的推理任务结束后关闭。
+    """
+
+    def __init__(self, config: Optional[Config] = None) -> None:
+        """初始化服务容器.
+
+        Args:
+            config: 应用程序配置，为空时使用 get_config() 的结果.
+        """
+        self.config = config or get_config()
+        self.llm_service: Optional[LLMService] = None
+        self.knowledge_base: Optional[KnowledgeBase] = None
+        self.qa_service: Optional[QAService] = None
+        self.loaded_at: Optional[float] = None
+        self.load_seconds: Optional[float] = None
+        self.reload_count = 0
+        self.executor = InferenceExecutor(
+            max_workers=self.config.inference_workers,
+            max_queue_size=self.config.inference_max_queue,
+            max_queue_wait=self.config.inference_queue_timeout or None
+        )
+        self.reindexer = BackgroundReindexer(self._reindex)
+        self.watcher: Optional[TriliumWatcher] = None
+        self.sync_poller: Optional[TriliumSyncPoller] = None
+        self.last_sync_stats: Optional[Dict[str, Any]] = None
+        self._trilium_service: Optional[TriliumService] = None
+        # 监控器触发的重新索引和增量同步写同一个索引，不能并发运行
+        self._ingest_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def initialize(self) -> None:
+        """加载所有组件（若尚未加载）."""
+        with self._reload_lock:
+            if self.qa_service is None:
+                self._load(self.config)
+
+    def reload(self, config: Optional[Config] = None) -> None:
+        """重新读取配置并重建所有组件.
+
+        Args:
+            config: 新的配置，为空时重新调用 get_config().
+        """
+        with self._reload_lock:
+            self._load(config or get_config())
+            self.reload_count += 1
+
+    def _load(self, config: Config) -> None:
+        """构建一组新组件并替换当前实例.
+
+        Args:
+            config: 用于构建组件的配置.
+        """
+        start = time.perf_counter()
+        llm_service = LLMService(config)
+        knowledge_base = KnowledgeBase(config)
+        qa_service = QAService(config, llm_service, knowledge_base)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            previous = (self.qa_service, self.knowledge_base, self.llm_service)
+            # 旧实例中只在内存里的会话交给新实例，之后旧实例的调用转发给新实例
+            if previous[0] is not None and previous[0].memory is not None and qa_service.memory is not None:
+                previous[0].memory.transfer_to(qa_service.memory)
+            self.config = config
+            self.llm_service = llm_service
+            self.knowledge_base = knowledge_base
+            self.qa_service = qa_service
+            self.loaded_at = time.time()
+            self.load_seconds = elapsed
+            barrier = self.executor.mark()
+        # 旧组件在进行中的请求完成后关闭，不阻塞重新加载
+        if any(component is not None for component in previous):
+            threading.Thread(
+                target=self._retire, args=(*previous, barrier), name="service-retire", daemon=True
+            ).start()
+        print(f"服务组件加载完成，耗时 {elapsed:.2f} 秒")
+
+    def _retire(self, qa_service: Optional[QAService], knowledge_base: Optional[KnowledgeBase],
+                llm_service: Optional[LLMService], barrier: int) -> None:
+        """等待替换前提交的推理任务结束后关闭旧组件（在后台线程中运行）.
+
+        Args:
+            qa_service: 旧的问答服务.
+            knowledge_base: 旧的知识库.
+            llm_service: 旧的语言模型服务.
+            barrier: 替换时执行器的任务序号.
+        """
+        if not self.executor.wait_until_done(barrier, _RETIRE_TIMEOUT):
+            print("旧组件仍有未完成的请求，超时后强制关闭")
+        if qa_service is not None:
+            qa_service.close()
+        if knowledge_base is not None:
+            # 后台导入可能仍在写旧知识库的倒排索引
+            with self._ingest_lock:
+                knowledge_base.close()
+        # 模型工作池还会等待直接调用（不经过执行器）的生成结束
+        if llm_service is not None:
+            llm_service.close()
+
+    def get_qa_service(self) -> QAService:
+        """获取共享的问答服务实例.
+
+        Returns:
+            QAService 实例；若容器尚未加载则先完成加载.
+        """
+        qa_service = self.qa_service
+        if qa_service is None:
+            self.initialize()
+            qa_service = self.qa_service
+        return qa_service
+
+    def _ingest_components(self):
+        """返回当前配置、知识库和缓存的Trilium服务."""
+        with self._lock:
+            config = self.config
+            knowledge_base = self.knowledge_base
+        if knowledge_base is None:
+            raise RuntimeError("知识库尚未加载")
+        if self._trilium_service is None:
+            self._trilium_service = TriliumService(config)
+        return config, knowledge_base, self._trilium_service
+
+    def _reindex(self) -> Dict[str, Any]:
+        """使用当前知识库执行一次增量重新索引（在后台线程中运行）."""
+        with self._ingest_lock:
+            config, knowledge_base, trilium_service = self._ingest_components()
+            return run_trilium_ingest(config, knowledge_base, trilium_service)
+
+    def _delta_sync(self, full_scan: bool = False) -> Dict[str, Any]:
+        """通过ETAPI执行一次增量同步（在轮询线程中运行）.
+
+        Args:
+            full_scan: 是否完整遍历子树的元数据.
+        """
+        with self._ingest_lock:
+            config, knowledge_base, trilium_service = self._ingest_components()
+            self.last_sync_stats = run_trilium_delta_sync(
+                config, knowledge_base, trilium_service, full_scan=full_scan
+            )
+            return self.last_sync_stats
+
+    def start_watcher(self) -> None:
+        """启动唯一的Trilium数据目录监控器，变更平息后触发后台重新索引."""
+        if self.watcher is not None or not self.config.trilium_watch_enabled:
+            return
+        watcher = TriliumWatcher(
+            self.config.trilium_data_dir,
+            on_change=self.reindexer.request,
+            quiet_period=self.config.trilium_watch_quiet_period,
+            max_delay=self.config.trilium_watch_max_delay
+        )
+        if watcher.start():
+            self.watcher = watcher
+
+    def start_sync_poller(self) -> None:
+        """启动唯一的ETAPI增量同步轮询器（TRILIUM_SYNC_INTERVAL 为0时不启动）."""
+        if self.sync_poller is not None:
+            return
+        poller = TriliumSyncPoller(
+            self.config.trilium_sync_interval,
+            on_sync=self._delta_sync,
+            full_scan_every=self.config.trilium_sync_full_scan_every
+        )
+        if poller.start():
+            self.sync_poller = poller
+
+    def status(self) -> Dict[str, Any]:
+        """返回已缓存组件的状态，不会触发任何实例化.
+
+        Returns:
+            组件状态信息.
+        """
+        with self._lock:
+            llm_service = self.llm_service
+            knowledge_base = self.knowledge_base
+            qa_service = self.qa_service
+            loaded_at = self.loaded_at
+            load_seconds = self.load_seconds
+
+        return {
+            "loaded": qa_service is not None,
+            "loaded_at": loaded_at,
+            "load_seconds": load_seconds,
+            "reload_count": self.reload_count,
+            "components": {
+                "llm": bool(llm_service and llm_service.available),
+                "embedding_model": bool(knowledge_base and knowledge_base.embedding_model),
+                "vector_store": bool(knowledge_base and knowledge_base.vector_store),
+            },
+            "initialization_errors": list(qa_service.init_errors) if qa_service else [],
+            "inference_executor": self.executor.stats(),
+            "reindex": self.reindexer.status(),
+            "watcher": self.watcher.status() if self.watcher else None,
+            "sync": (
+                dict(self.sync_poller.status(), last_stats=self.last_sync_stats)
+                if self.sync_poller else None
+            ),
+            "answer_cache": (
+                qa_service.answer_cache.stats() if qa_service and qa_service.answer_cache else None
+            ),
+            "llm": llm_service.stats() if llm_service else None,
+            "session_memory": (
+                qa_service.memory.stats() if qa_service and qa_service.memory else None
+            ),
+            "reranker": (
+                qa_service.reranker.stats() if qa_service and qa_service.reranker else None
+            ),
+            "lexical_index": (
+                knowledge_base.lexical_index.stats()
+                if knowledge_base and knowledge_base.lexical_index else None
+            ),
+            "embedding_cache": (
+                knowledge_base.embedding_cache.stats()
+                if knowledge_base and knowledge_base.embedding_cache else None
+            ),
+        }
+
+    def shutdown(self) -> None:
+        """停止监控器和同步轮询器、关闭推理执行器并释放对组件的引用."""
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        if self.sync_poller is not None:
+            self.sync_poller.stop()
+            self.sync_poller = None
+        self.executor.shutdown()
+        if self.qa_service is not None:
+            self.qa_service.close()
+        if self.knowledge_base is not None:
+            self.knowledge_base.close()
+        if self.llm_service is not None:
+            self.llm_service.close()
+        with self._lock:
+            self.qa_service = None
+            self.knowledge_base = None
+            self.llm_service = None
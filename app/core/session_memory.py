@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""按会话隔离、有上限的对话记忆."""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# 摘要中每轮回答保留的最大字符数
+_SUMMARY_ANSWER_CHARS = 160
+# 清理过期持久化会话的最小间隔（秒）
+_PRUNE_INTERVAL = 60.0
+
+
+def _first_sentence(text: str, limit: int = _SUMMARY_ANSWER_CHARS) -> str:
+    """取回答的第一句话，最多 limit 个字符."""
+    text = " ".join(text.split())
+    for mark in ("。", "！", "？", ". ", "! ", "? "):
+        position = text.find(mark)
+        if 0 < position < limit:
+            return text[:position + len(mark)].strip()
+    return text if len(text) <= limit else text[:limit].rstrip() + "..."
+
+
+class _Session:
+    """一个会话的最近几轮问答和更早问答的摘要."""
+
+    __slots__ = ("turns", "summary", "last_used")
+
+    def __init__(self, turns: Optional[List[Tuple[str, str, int]]] = None, summary: str = "",
+                 last_used: Optional[float] = None) -> None:
+        # (问题, 回答, token数)，从旧到新
+        self.turns: List[Tuple[str, str, int]] = turns or []
+        self.summary = summary
+        self.last_used = last_used if last_used is not None else time.time()
+
+
+class SessionMemory:
+    """以会话ID为键的对话记忆.
+
+    每个会话保留最近几轮完整问答（滑动窗口，不超过 window_tokens 个token），
+    滑出窗口的问答压缩为一行写入滚动摘要，摘要超过 summary_tokens 个token时
+    丢弃最早的行，因此每个会话注入提示的历史最多 window_tokens + summary_tokens
+    个token。摘要采用抽取方式（问题加回答首句），不额外占用语言模型。
+
+    内存中最多保留 max_sessions 个会话，超出时淘汰最久未使用的会话；空闲超过
+    idle_seconds 的会话被删除。指定 persist_path 时会话写入SQLite文件，
+    被淘汰或重启后再次访问时从文件恢复。重新加载配置时用 transfer_to 把会话
+    交给新实例，之后对旧实例的调用都转发给新实例。
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], window_tokens: int = 384,
+                 summary_tokens: int = 128, max_sessions: int = 1000,
+                 idle_seconds: float = 3600, persist_path: str = "") -> None:
+        """初始化会话记忆.
+
+        Args:
+            count_tokens: 使用语言模型分词器统计token数的函数.
+            window_tokens: 最近几轮完整问答的token上限.
+            summary_tokens: 滚动摘要的token上限.
+            max_sessions: 内存中最多保留的会话数.
+            idle_seconds: 会话空闲多少秒后删除，0表示不过期.
+            persist_path: SQLite文件路径，为空时只保存在内存中.
+        """
+        self.count_tokens = count_tokens
+        self.window_tokens = max(0, window_tokens)
+        self.summary_tokens = max(0, summary_tokens)
+        self.max_sessions = max(1, max_sessions)
+        self.idle_seconds = idle_seconds
+        self.persist_path = persist_path
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        self.evicted = 0
+        self.expired = 0
+        # 会话已交给的新实例，设置后所有调用都转发给它
+        self._successor: Optional["SessionMemory"] = None
+
+        self._conn = None
+        if persist_path:
+            directory = os.path.dirname(persist_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(persist_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY,"
+                " summary TEXT NOT NULL,"
+                " turns TEXT NOT NULL,"
+                " last_used REAL NOT NULL"
+                ")"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_sessions_last_used ON sessions (last_used)"
+            )
+            self._conn.commit()
+
+    def _is_expired(self, session: _Session, now: float) -> bool:
+        """会话是否已空闲超时."""
+        return bool(self.idle_seconds) and now - session.last_used > self.idle_seconds
+
+    def _load(self, session_id: str) -> Optional[_Session]:
+        """从SQLite读取会话（调用方需持有锁）."""
+        if self._conn is None:
+            return None
+        row = self._conn.execute(
+            "SELECT summary, turns, last_used FROM sessions WHERE session_id = ?",
+            (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        turns = [tuple(turn) for turn in json.loads(row[1])]
+        return _Session(turns, row[0], row[2])
+
+    def _store(self, session_id: str, session: _Session) -> None:
+        """把会话写入SQLite（调用方需持有锁）."""
+        if self._conn is None:
+            return
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, summary, turns, last_used) VALUES (?, ?, ?, ?)",
+            (session_id, session.summary, json.dumps(session.turns, ensure_ascii=False), session.last_used)
+        )
+        self._conn.commit()
+
+    def _get(self, session_id: str, create: bool) -> Optional[_Session]:
+        """取出会话并标记为最近使用（调用方需持有锁）."""
+        now = time.time()
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._load(session_id)
+            if session is None and not create:
+                return None
+        if session is not None and self._is_expired(session, now):
+            self.expired += 1
+            self._discard(session_id)
+            session = None
+            if not create:
+                return None
+        if session is None:
+            session = _Session()
+        session.last_used = now
+        self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        # 超出内存上限时淘汰最久未使用的会话（持久化的会话仍可从文件恢复）
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+        return session
+
+    def _discard(self, session_id: str) -> None:
+        """删除会话（调用方需持有锁）."""
+        self._sessions.pop(session_id, None)
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def _prune(self, now: float) -> None:
+        """删除空闲超时的会话（调用方需持有锁）."""
+        if not self.idle_seconds or now - self._last_prune < _PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        cutoff = now - self.idle_seconds
+        # 有序字典按最近使用排列，最旧的在前
+        removed = 0
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_used > cutoff:
+                break
+            self._sessions.popitem(last=False)
+            removed += 1
+        if self._conn is not None:
+            # 文件中包含所有会话，按删除的行数统计
+            removed = self._conn.execute("DELETE FROM sessions WHERE last_used < ?", (cutoff,)).rowcount
+            self._conn.commit()
+        self.expired += removed
+
+    def _fold(self, session: _Session, question: str, answer: str) -> None:
+        """把滑出窗口的一轮问答压缩进滚动摘要."""
+        line = f"- {' '.join(question.split())} -> {_first_sentence(answer)}"
+        lines = session.summary.split("\n") if session.summary else []
+        lines.append(line)
+        # 超出上限时丢弃最早的摘要行；仅剩的一行仍超出时按比例截短
+        while lines and self.count_tokens("\n".join(lines)) > self.summary_tokens:
+            if len(lines) > 1:
+                lines.pop(0)
+                continue
+            tokens = self.count_tokens(lines[0])
+            shortened = lines[0][:max(0, int(len(lines[0]) * self.summary_tokens / tokens) - 1)].rstrip()
+            lines = [shortened] if shortened else []
+        session.summary = "\n".join(lines)
+
+    def add_turn(self, session_id: str, question: str, answer: str) -> None:
+        """记录一轮问答.
+
+        Args:
+            session_id: 会话ID.
+            question: 用户问题.
+            answer: 生成的答案.
+        """
+        with self._lock:
+            successor = self._successor
+            if successor is None:
+                self._add_turn(session_id, question, answer)
+        if successor is not None:
+            successor.add_turn(session_id, question, answer)
+
+    def _add_turn(self, session_id: str, question: str, answer: str) -> None:
+        """记录一轮问答（调用方需持有锁）."""
+        self._prune(time.time())
+        session = self._get(session_id, create=True)
+        tokens = self.count_tokens(f"User: {question}\nAssistant: {answer}")
+        session.turns.append((question, answer, tokens))
+        # 滑动窗口：最早的问答移入摘要，直到窗口不超过上限
+        while session.turns and sum(turn[2] for turn in session.turns) > self.window_tokens:
+            old_question, old_answer, _ = session.turns.pop(0)
+            self._fold(session, old_question, old_answer)
+        self._store(session_id, session)
+
+    def history(self, session_id: str) -> str:
+        """返回要放在上下文之前的对话历史.
+
+        Args:
+            session_id: 会话ID.
+
+        Returns:
+            摘要和最近几轮问答组成的文本，以空行结尾；会话不存在时为空字符串.
+        """
+        with self._lock:
+            successor = self._successor
+            if successor is None:
+                return self._history(session_id)
+        return successor.history(session_id)
+
+    def _history(self, session_id: str) -> str:
+        """返回会话的对话历史（调用方需持有锁）."""
+        session = self._get(session_id, create=False)
+        if session is None or not (session.summary or session.turns):
+            return ""
+        parts = []
+        if session.summary:
+            parts.append(f"Summary of the earlier conversation:\n{session.summary}")
+        if session.turns:
+            recent = "\n".join(f"User: {q}\nAssistant: {a}" for q, a, _ in session.turns)
+            parts.append(f"Recent conversation:\n{recent}")
+        return "\n\n".join(parts) + "\n\n"
+
+    def clear(self, session_id: str) -> None:
+        """删除会话的全部记忆.
+
+        Args:
+            session_id: 会话ID.
+        """
+        with self._lock:
+            successor = self._successor
+            if successor is None:
+                self._discard(session_id)
+        if successor is not None:
+            successor.clear(session_id)
+
+    def transfer_to(self, successor: "SessionMemory") -> None:
+        """把内存中的会话交给新实例并关闭本实例.
+
+        新实例中已有同一会话的较新记录（例如来自同一个持久化文件）时保留新实例的记录。
+        交接后仍在使用本实例的请求会被转发到新实例，不会丢失问答。
+
+        Args:
+            successor: 接收会话的新实例.
+        """
+        with self._lock:
+            # 在持有本实例的锁时交接，转发来的调用要等会话全部交给新实例后才执行
+            successor._adopt(list(self._sessions.items()))
+            self._sessions.clear()
+            self._successor = successor
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _adopt(self, sessions: List[Tuple[str, _Session]]) -> None:
+        """接收另一个实例交来的会话，按从旧到新的顺序排列."""
+        with self._lock:
+            for session_id, session in sessions:
+                existing = self._sessions.get(session_id) or self._load(session_id)
+                if existing is not None and existing.last_used >= session.last_used:
+                    continue
+                self._sessions[session_id] = session
+                self._sessions.move_to_end(session_id)
+                self._store(session_id, session)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """返回会话记忆的统计."""
+        with self._lock:
+            persisted = None
+            if self._conn is not None:
+                persisted = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            return {
+                "sessions": len(self._sessions),
+                "persisted_sessions": persisted,
+                "max_sessions": self.max_sessions,
+                "window_tokens": self.window_tokens,
+                "summary_tokens": self.summary_tokens,
+                "evicted": self.evicted,
+                "expired": self.expired,
+            }
+
+    def close(self) -> None:
+        """关闭SQLite连接."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
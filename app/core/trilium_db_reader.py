@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""直接读取Trilium本地 document.db 的批量加载器."""
+
+import os
+import sqlite3
+import time
+from contextlib import closing
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app.core.trilium_fetcher import TEXT_NOTE_TYPES
+
+# 单条 IN (...) 查询的最大参数数，低于SQLite的默认上限
+_MAX_PARAMS = 500
+
+
+class TriliumDatabaseReader:
+    """以只读方式打开Trilium的SQLite数据库，用批量SQL流式读取笔记.
+
+    子树通过 branches 表上的递归查询一次展开，元数据（不含内容）一次读完；
+    之后按页处理，每页的内容、属性和祖先各用一条 IN 查询取回，因此查询次数
+    与页数成正比，而不是与笔记数成正比。每条查询在产出文档之前就已读完，
+    调用方处理文档期间不持有读事务，不会阻止Trilium的WAL检查点。
+    产出的文档与 TriliumFetcher 的结构相同。同时支持新版的 blobs 表和旧版的
+    note_contents 表。
+    """
+
+    def __init__(self, db_path: str, page_size: int = 200) -> None:
+        """初始化数据库读取器.
+
+        Args:
+            db_path: document.db 的路径.
+            page_size: 每页处理的笔记数，限制同时驻留内存的笔记内容.
+        """
+        self.db_path = db_path
+        self.page_size = max(1, min(page_size, _MAX_PARAMS))
+        self.timings: Dict[str, float] = {"metadata": 0.0, "content": 0.0}
+        # 与 TriliumFetcher 保持一致的计数器；这里统计的是SQL查询次数
+        self.request_count = 0
+        self.error_count = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        """以只读模式打开数据库，不会修改Trilium的数据文件."""
+        if not os.path.exists(self.db_path):
+            raise FileNotFoundError(f"Trilium数据库不存在: {self.db_path}")
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def _execute(self, conn: sqlite3.Connection, sql: str, params: Tuple = ()) -> sqlite3.Cursor:
+        """执行一条查询并计数."""
+        self.request_count += 1
+        return conn.execute(sql, params)
+
+    @staticmethod
+    def _content_source(conn: sqlite3.Connection) -> Tuple[str, str]:
+        """返回存放笔记内容的表及其与 notes 表的连接列.
+
+        Returns:
+            (内容查询SQL前缀, 连接列名).
+        """
+        tables = {
+            row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        }
+        if "blobs" in tables:
+            return "SELECT n.noteId, b.content FROM notes n JOIN blobs b ON b.blobId = n.blobId", "n.noteId"
+        return "SELECT noteId, content FROM note_contents", "noteId"
+
+    @staticmethod
+    def _decode(content: Any) -> str:
+        """将内容列解码为文本."""
+        if content is None:
+            return ""
+        if isinstance(content, bytes):
+            return content.decode("utf-8", errors="replace")
+        return str(content)
+
+    def _subtree_sql(self, root_count: int, where: str = "") -> str:
+        """构建展开子树并返回可索引笔记元数据的查询.
+
+        Args:
+            root_count: 根笔记数量.
+            where: 附加的过滤条件.
+
+        Returns:
+            SQL语句；参数依次为根笔记ID、可索引的笔记类型和附加条件的参数.
+        """
+        roots = ",".join("?" * root_count)
+        types = ",".join("?" * len(TEXT_NOTE_TYPES))
+        # UNION 会去重，克隆笔记形成的多条路径和环都不会导致重复遍历
+        return (
+            "WITH RECURSIVE tree(noteId) AS ("
+            f" SELECT noteId FROM notes WHERE noteId IN ({roots}) AND isDeleted = 0"
+            " UNION"
+            " SELECT br.noteId FROM branches br JOIN tree t ON br.parentNoteId = t.noteId"
+            " WHERE br.isDeleted = 0"
+            ")"
+            " SELECT n.noteId, n.title, n.utcDateModified, n.mime FROM tree"
+            " JOIN notes n ON n.noteId = tree.noteId"
+            f" WHERE n.isDeleted = 0 AND n.isProtected = 0 AND n.type IN ({types}){where}"
+            " ORDER BY n.utcDateModified, n.noteId"
+        )
+
+    def _iter_query(self, root_ids: List[str], where: str = "", params: Tuple = (),
+                    known_versions: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+        """读取子树查询的元数据，再按页补全内容和属性.
+
+        Args:
+            root_ids: 子树根笔记ID.
+            where: 附加的过滤条件.
+            params: 附加条件的参数.
+            known_versions: 已索引笔记的修改时间，未变化的笔记不读取内容.
+
+        Yields:
+            文档字典.
+        """
+        known_versions = known_versions or {}
+        root_ids = list(dict.fromkeys(root_ids))
+        if not root_ids:
+            return
+        with closing(self._connect()) as conn:
+            content_sql, content_key = self._content_source(conn)
+            # 元数据一次读完，游标随之结束，不会在整个导入期间保持读事务
+            start = time.perf_counter()
+            rows = self._execute(
+                conn,
+                self._subtree_sql(len(root_ids), where),
+                (*root_ids, *sorted(TEXT_NOTE_TYPES), *params)
+            ).fetchall()
+            self.timings["metadata"] += time.perf_counter() - start
+            for offset in range(0, len(rows), self.page_size):
+                yield from self._emit_page(
+                    conn, rows[offset:offset + self.page_size], content_sql, content_key, known_versions
+                )
+
+    def _emit_page(self, conn: sqlite3.Connection, rows: List[Tuple], content_sql: str,
+                   content_key: str, known_versions: Dict[str, str]) -> Iterator[Dict[str, Any]]:
+        """批量读取一页笔记的内容、属性和祖先，三条查询都读完后才产出文档.
+
+        Args:
+            conn: 数据库连接.
+            rows: (noteId, title, utcDateModified, mime) 元组.
+            content_sql: 内容查询SQL前缀.
+            content_key: 内容查询中笔记ID的列名.
+            known_versions: 已索引笔记的修改时间.
+
+        Yields:
+            文档字典.
+        """
+        if not rows:
+            return
+        start = time.perf_counter()
+        # 属性和祖先对未变化的笔记也要读取，移动笔记或修改标签不会改变修改时间
+        note_ids = [row[0] for row in rows]
+        placeholders = ",".join("?" * len(note_ids))
+        attributes: Dict[str, List[Dict[str, Any]]] = {}
+        for note_id, attr_type, name, value in self._execute(
+            conn,
+            "SELECT noteId, type, name, value FROM attributes "
+            f"WHERE isDeleted = 0 AND noteId IN ({placeholders}) ORDER BY noteId, position",
+            tuple(note_ids)
+        ).fetchall():
+            attributes.setdefault(note_id, []).append({'type': attr_type, 'name': name, 'value': value})
+        # 沿 branches 向上展开所有祖先；UNION 对 (笔记, 祖先) 去重，克隆和环都会终止
+        ancestors: Dict[str, List[str]] = {}
+        for note_id, ancestor_id in self._execute(
+            conn,
+            "WITH RECURSIVE up(noteId, ancestorId) AS ("
+            f" SELECT noteId, parentNoteId FROM branches WHERE isDeleted = 0 AND noteId IN ({placeholders})"
+            " UNION"
+            " SELECT up.noteId, br.parentNoteId FROM branches br JOIN up ON br.noteId = up.ancestorId"
+            " WHERE br.isDeleted = 0"
+            ")"
+            " SELECT noteId, ancestorId FROM up WHERE ancestorId != 'none' AND ancestorId != noteId",
+            tuple(note_ids)
+        ).fetchall():
+            ancestors.setdefault(note_id, []).append(ancestor_id)
+
+        # 修改时间未变的笔记不读取内容
+        to_fetch = [
+            row[0] for row in rows
+            if not (row[2] and known_versions.get(row[0]) == row[2])
+        ]
+        contents = {}
+        if to_fetch:
+            fetch_placeholders = ",".join("?" * len(to_fetch))
+            contents = dict(self._execute(
+                conn, f"{content_sql} WHERE {content_key} IN ({fetch_placeholders})", tuple(to_fetch)
+            ).fetchall())
+        self.timings["content"] += time.perf_counter() - start
+
+        fetched = set(to_fetch)
+        for note_id, title, utc_date_modified, mime in rows:
+            if note_id not in fetched:
+                yield {
+                    'title': title or '',
+                    'note_id': note_id,
+                    'utc_date_modified': utc_date_modified,
+                    'unchanged': True,
+                    'ancestors': ancestors.get(note_id, []),
+                    'attributes': attributes.get(note_id, [])
+                }
+                continue
+            content = self._decode(contents.get(note_id))
+            if not content.strip():
+                continue
+            yield {
+                'content': content,
+                'title': title or f"笔记 {note_id}",
+                'note_id': note_id,
+                'utc_date_modified': utc_date_modified,
+                'mime': mime,
+                'ancestors': ancestors.get(note_id, []),
+                'attributes': attributes.get(note_id, [])
+            }
+
+    def iter_subtree(
+        self,
+        root_ids: List[str],
+        max_depth: Optional[int] = None,
+        known_versions: Optional[Dict[str, str]] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """流式读取子树中的所有可索引笔记.
+
+        Args:
+            root_ids: 子树根笔记ID.
+            max_depth: 为与 TriliumFetcher 接口一致而保留，数据库读取总是展开整棵子树.
+            known_versions: 已索引笔记的修改时间，未变化的笔记不读取内容.
+
+        Yields:
+            与 TriliumService.load_documents 相同结构的文档字典.
+        """
+        yield from self._iter_query(root_ids, known_versions=known_versions)
+
+    def iter_modified_since(
+        self,
+        root_ids: List[str],
+        since: str,
+        known_versions: Optional[Dict[str, str]] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """读取子树中自 since 以来变化过的笔记.
+
+        除笔记本身的 utcDateModified 外，属性变化的笔记、分支变化（移动、增删克隆）
+        的笔记及其所有后代也会被读取，它们的祖先和标签元数据可能已经改变。
+
+        Args:
+            root_ids: 子树根笔记ID.
+            since: 水位线，Trilium的UTC时间字符串.
+            known_versions: 已索引笔记的修改时间.
+
+        Yields:
+            文档字典.
+        """
+        # 删除的分支同样会更新 utcDateModified，因此不按 isDeleted 过滤
+        where = (
+            " AND (n.utcDateModified >= ?"
+            " OR n.noteId IN (SELECT noteId FROM attributes WHERE utcDateModified >= ?)"
+            " OR n.noteId IN ("
+            "WITH RECURSIVE moved(noteId) AS ("
+            " SELECT noteId FROM branches WHERE utcDateModified >= ?"
+            " UNION"
+            " SELECT br.noteId FROM branches br JOIN moved m ON br.parentNoteId = m.noteId"
+            " WHERE br.isDeleted = 0"
+            ") SELECT noteId FROM moved))"
+        )
+        yield from self._iter_query(root_ids, where, (since, since, since), known_versions=known_versions)
+
+    def iter_notes(self, note_ids: List[str],
+                   known_versions: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+        """读取指定的笔记（不展开子笔记）.
+
+        Args:
+            note_ids: 笔记ID.
+            known_versions: 已索引笔记的修改时间.
+
+        Yields:
+            文档字典.
+        """
+        types = ",".join("?" * len(TEXT_NOTE_TYPES))
+        with closing(self._connect()) as conn:
+            content_sql, content_key = self._content_source(conn)
+            for offset in range(0, len(note_ids), self.page_size):
+                page = note_ids[offset:offset + self.page_size]
+                start = time.perf_counter()
+                rows = self._execute(
+                    conn,
+                    "SELECT noteId, title, utcDateModified, mime FROM notes "
+                    f"WHERE noteId IN ({','.join('?' * len(page))}) "
+                    f"AND isDeleted = 0 AND isProtected = 0 AND type IN ({types})",
+                    (*page, *sorted(TEXT_NOTE_TYPES))
+                ).fetchall()
+                self.timings["metadata"] += time.perf_counter() - start
+                yield from self._emit_page(conn, rows, content_sql, content_key, known_versions or {})
+
+    def iter_subtree_ids(self, root_ids: List[str]) -> Iterator[str]:
+        """列出子树中所有可索引笔记的ID，不读取内容.
+
+        Args:
+            root_ids: 子树根笔记ID.
+
+        Yields:
+            笔记ID.
+        """
+        root_ids = list(dict.fromkeys(root_ids))
+        if not root_ids:
+            return
+        with closing(self._connect()) as conn:
+            rows = self._execute(
+                conn, self._subtree_sql(len(root_ids)), (*root_ids, *sorted(TEXT_NOTE_TYPES))
+            ).fetchall()
+        for row in rows:
+            yield row[0]
+
+    def close(self) -> None:
+        """与 TriliumFetcher 接口一致；每次遍历结束时连接已关闭."""
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""从Trilium导出的.zip归档流式读取笔记."""
+
+import json
+import posixpath
+import zipfile
+from typing import Any, Dict, Iterator, List, Optional
+
+from app.core.trilium_fetcher import TEXT_NOTE_TYPES
+
+# Trilium导出归档中描述笔记树的元数据文件
+EXPORT_META_FILENAME = "!!!meta.json"
+
+
+class TriliumExportReader:
+    """读取Trilium的HTML或Markdown导出归档.
+
+    根据 !!!meta.json 重建笔记树并解析每个笔记的数据文件路径，
+    成员按需从归档中读取，不会解压到磁盘；内存中只保留元数据和
+    当前正在处理的笔记内容。产出的文档与 TriliumService.load_documents 结构相同。
+
+    归档只包含导出子树本身，祖先链止于导出根；导出的不是整个知识库时，
+    应通过 root_ancestors 给出导出根在Trilium中的祖先，否则按更上层笔记
+    过滤子树时检索不到这些笔记，之后通过ETAPI或本地数据库同步时也会改写它们的元数据。
+    """
+
+    def __init__(self, archive_path: str, root_ancestors: Optional[List[str]] = None) -> None:
+        """初始化导出归档读取器.
+
+        Args:
+            archive_path: 导出的.zip文件路径.
+            root_ancestors: 导出根笔记在Trilium中的祖先笔记ID（包括克隆的所有路径），
+                会追加到每个笔记的祖先之后.
+        """
+        self.archive_path = archive_path
+        self.root_ancestors = [ancestor for ancestor in dict.fromkeys(root_ancestors or []) if ancestor]
+        self.error_count = 0
+        self.note_count = 0
+        # 归档最外层的笔记ID，即导出的子树根；导出整个知识库时为 root
+        self.root_ids: List[str] = []
+        # 最近一次遍历是否读取了所有笔记，只有完整时才能据此判断删除
+        self.last_load_complete = False
+
+    @staticmethod
+    def _find_meta(archive: zipfile.ZipFile) -> str:
+        """在归档中找到最外层的元数据文件."""
+        candidates = [
+            name for name in archive.namelist()
+            if posixpath.basename(name) == EXPORT_META_FILENAME
+        ]
+        if not candidates:
+            raise ValueError(f"归档中没有 {EXPORT_META_FILENAME}，不是Trilium导出文件")
+        return min(candidates, key=lambda name: name.count("/"))
+
+    def _walk(self, files: List[Dict[str, Any]], directory: str) -> Iterator[Dict[str, Any]]:
+        """深度优先遍历元数据中的笔记树.
+
+        Args:
+            files: 同一父笔记下的笔记元数据.
+            directory: 这些笔记所在的归档目录.
+
+        Yields:
+            附带 data_path 字段（数据文件在归档中的路径）和 ancestors 字段
+            （归档中的祖先笔记ID，由近及远）的笔记元数据.
+        """
+        stack = [(files, directory, list(self.root_ancestors))]
+        while stack:
+            entries, current, ancestors = stack.pop()
+            for entry in reversed(entries):
+                if entry.get("dataFileName"):
+                    yield dict(
+                        entry,
+                        data_path=posixpath.join(current, entry["dataFileName"]),
+                        ancestors=ancestors
+                    )
+                if entry.get("children"):
+                    child_dir = posixpath.join(current, entry["dirFileName"]) if entry.get("dirFileName") else current
+                    child_ancestors = [entry["noteId"], *ancestors] if entry.get("noteId") else ancestors
+                    stack.append((entry["children"], child_dir, child_ancestors))
+
+    def iter_documents(self, known_versions: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+        """流式读取归档中的可索引笔记.
+
+        Args:
+            known_versions: 为与其他加载器接口一致而保留；导出元数据不含修改时间，
+                未变化的笔记由索引器通过内容哈希识别.
+
+        Yields:
+            文档字典.
+
+        Raises:
+            ValueError: 归档不是Trilium导出文件.
+        """
+        self.last_load_complete = False
+        self.error_count = 0
+        self.note_count = 0
+        seen = set()
+        with zipfile.ZipFile(self.archive_path) as archive:
+            meta_name = self._find_meta(archive)
+            meta = json.loads(archive.read(meta_name).decode("utf-8"))
+            base_dir = posixpath.dirname(meta_name)
+            self.root_ids = [entry["noteId"] for entry in meta.get("files") or [] if entry.get("noteId")]
+            if "root" not in self.root_ids and not self.root_ancestors:
+                print("警告: 归档不是整个知识库的导出且未指定导出根的祖先，按更上层笔记过滤子树时将检索不到这些笔记")
+            members = set(archive.namelist())
+
+            for entry in self._walk(meta.get("files") or [], base_dir):
+                note_id = entry.get("noteId")
+                # 克隆笔记在导出中出现多次，只读取一次
+                if not note_id or note_id in seen or entry.get("isClone"):
+                    continue
+                if entry.get("type") not in TEXT_NOTE_TYPES:
+                    continue
+                seen.add(note_id)
+                data_path = entry["data_path"]
+                if data_path not in members:
+                    print(f"导出归档中缺少笔记 {note_id} 的数据文件: {data_path}")
+                    self.error_count += 1
+                    continue
+                try:
+                    content = archive.read(data_path).decode("utf-8", errors="replace")
+                except Exception as e:
+                    print(f"读取导出笔记 {note_id} 时出错: {e}")
+                    self.error_count += 1
+                    continue
+                if not content.strip():
+                    continue
+                self.note_count += 1
+                yield {
+                    'content': content,
+                    'title': entry.get('title') or f"笔记 {note_id}",
+                    'note_id': note_id,
+                    'utc_date_modified': None,
+                    # Markdown导出中文本笔记的数据文件是.md而不是HTML
+                    'mime': 'text/markdown' if data_path.endswith('.md') else entry.get('mime'),
+                    'ancestors': entry['ancestors'],
+                    'attributes': [
+                        {'type': attr.get('type'), 'name': attr.get('name'), 'value': attr.get('value')}
+                        for attr in entry.get('attributes') or []
+                    ]
+                }
+
+        self.last_load_complete = self.error_count == 0
+        print(f"导出归档读取完成: {self.note_count} 个文档，{self.error_count} 个错误")
@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""并发的Trilium ETAPI笔记拉取引擎."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 含有可索引文本内容的笔记类型
+TEXT_NOTE_TYPES = {"text", "code", "mermaid"}
+
+
+class RateLimiter:
+    """令牌桶限速器，多个线程共享."""
+
+    def __init__(self, rate: float, burst: Optional[int] = None) -> None:
+        """初始化限速器.
+
+        Args:
+            rate: 每秒允许的请求数，小于等于0表示不限速.
+            burst: 允许的突发请求数，默认等于rate.
+        """
+        self.rate = rate
+        self.capacity = max(1, int(burst or rate or 1))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """获取一个令牌，必要时阻塞等待."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class TriliumFetcher:
+    """通过连接池并发拉取笔记元数据和内容.
+
+    按层广度优先遍历子树：每一层的元数据并发拉取，随后并发拉取该层
+    文本笔记的内容。失败的请求按指数退避重试。
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        token: str,
+        concurrency: int = 8,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        rate_limit: float = 0,
+        timeout: float = 30,
+        page_size: int = 200
+    ) -> None:
+        """初始化拉取引擎.
+
+        Args:
+            base_url: Trilium服务器地址.
+            token: ETAPI令牌.
+            concurrency: 并发请求数，同时也是连接池大小.
+            max_retries: 每个请求的最大重试次数.
+            backoff: 指数退避的基础秒数.
+            rate_limit: 每秒最大请求数，0表示不限速.
+            timeout: 单个请求的超时秒数.
+            page_size: 每页处理的笔记数，限制同时驻留内存的笔记内容.
+        """
+        self.api_url = f"{base_url.rstrip('/')}/etapi"
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.page_size = max(1, page_size)
+        self.timings: Dict[str, float] = {"metadata": 0.0, "content": 0.0}
+        self.request_count = 0
+        self.error_count = 0
+        self._count_lock = threading.Lock()
+        # 笔记的父笔记和祖先，用于生成子树过滤元数据；每次遍历开始时清空
+        self._parents: Dict[str, List[str]] = {}
+        self._ancestor_cache: Dict[str, List[str]] = {}
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"])
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.concurrency,
+            pool_maxsize=self.concurrency,
+            max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Authorization"] = token
+
+    def _get(self, path: str, params: Optional[Dict[str, Any]] = None) -> requests.Response:
+        """发送限速的GET请求."""
+        self.rate_limiter.acquire()
+        with self._count_lock:
+            self.request_count += 1
+        response = self.session.get(f"{self.api_url}{path}", params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def get_note(self, note_id: str) -> Optional[Dict[str, Any]]:
+        """获取笔记元数据.
+
+        Args:
+            note_id: 笔记ID.
+
+        Returns:
+            笔记元数据，失败时返回None.
+        """
+        try:
+            note = self._get(f"/notes/{note_id}").json()
+            self._parents[note_id] = list(note.get('parentNoteIds') or [])
+            return note
+        except Exception as e:
+            print(f"获取笔记 {note_id} 元数据时出错: {e}")
+            with self._count_lock:
+                self.error_count += 1
+            return None
+
+    def get_note_content(self, note_id: str) -> str:
+        """获取笔记内容.
+
+        Args:
+            note_id: 笔记ID.
+
+        Returns:
+            笔记内容，失败时返回空字符串.
+        """
+        try:
+            response = self._get(f"/notes/{note_id}/content")
+            response.encoding = response.encoding or "utf-8"
+            return response.text
+        except Exception as e:
+            print(f"获取笔记 {note_id} 内容时出错: {e}")
+            with self._count_lock:
+                self.error_count += 1
+            return ""
+
+    def _reset_tree(self) -> None:
+        """清空缓存的笔记树结构，使移动过的笔记重新解析祖先."""
+        self._parents = {}
+        self._ancestor_cache = {}
+
+    def _ancestors(self, note_id: str, visiting: Optional[Set[str]] = None) -> List[str]:
+        """沿 parentNoteIds 向上解析笔记的所有祖先.
+
+        克隆笔记有多个父笔记，所有路径上的祖先都会被记录。已拉取过元数据的笔记
+        直接使用缓存的父笔记，只有遍历范围之外的祖先才需要额外请求。
+
+        Args:
+            note_id: 笔记ID.
+            visiting: 本次解析中已访问的笔记，用于防止环.
+
+        Returns:
+            祖先笔记ID，由近及远.
+        """
+        cached = self._ancestor_cache.get(note_id)
+        if cached is not None:
+            return cached
+        visiting = visiting if visiting is not None else set()
+        visiting.add(note_id)
+        parents = self._parents.get(note_id)
+        if parents is None:
+            self.get_note(note_id)
+            parents = self._parents.get(note_id, [])
+        ancestors = []
+        for parent_id in parents:
+            # 根笔记的父笔记为 none
+            if parent_id == "none" or parent_id in visiting:
+                continue
+            ancestors.append(parent_id)
+            ancestors.extend(self._ancestors(parent_id, visiting))
+        ancestors = [ancestor for ancestor in dict.fromkeys(ancestors) if ancestor != note_id]
+        self._ancestor_cache[note_id] = ancestors
+        return ancestors
+
+    @staticmethod
+    def _attributes(note: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """取出笔记元数据中的属性."""
+        return [
+            {'type': attr.get('type'), 'name': attr.get('name'), 'value': attr.get('value')}
+            for attr in note.get('attributes') or []
+        ]
+
+    def iter_subtree(
+        self,
+        root_ids: List[str],
+        max_depth: Optional[int] = None,
+        known_versions: Optional[Dict[str, str]] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """广度优先遍历子树并逐个返回文档.
+
+        Args:
+            root_ids: 子树根笔记ID.
+            max_depth: 最大遍历深度，根为第0层；为空表示不限制.
+            known_versions: 已索引笔记的修改时间，未变化的笔记不拉取内容.
+
+        Yields:
+            与 TriliumService.load_documents 相同结构的文档字典.
+        """
+        known_versions = known_versions or {}
+        self._reset_tree()
+        seen = set()
+        level = []
+        for note_id in root_ids:
+            if note_id not in seen:
+                seen.add(note_id)
+                level.append(note_id)
+        depth = 0
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="trilium-fetch") as pool:
+            while level:
+                next_level = []
+                expand = max_depth is None or depth < max_depth
+                # 按页处理当前层，内存中只保留一页笔记的内容
+                for offset in range(0, len(level), self.page_size):
+                    page = level[offset:offset + self.page_size]
+                    yield from self._fetch_page(pool, page, expand, seen, next_level, known_versions)
+                level = next_level
+                depth += 1
+
+    def _fetch_page(self, pool: ThreadPoolExecutor, page: List[str], expand: bool,
+                    seen: Set[str], next_level: List[str],
+                    known_versions: Dict[str, str]) -> Iterator[Dict[str, Any]]:
+        """并发拉取一页笔记的元数据和内容.
+
+        Args:
+            pool: 共享的线程池.
+            page: 本页的笔记ID.
+            expand: 是否将子笔记加入下一层.
+            seen: 已发现的笔记ID集合.
+            next_level: 下一层的笔记ID，会被就地追加.
+            known_versions: 已索引笔记的修改时间.
+
+        Yields:
+            文档字典.
+        """
+        start = time.perf_counter()
+        notes = [note for note in pool.map(self.get_note, page) if note]
+        self.timings["metadata"] += time.perf_counter() - start
+
+        if expand:
+            for note in notes:
+                for child_id in note.get('childNoteIds') or []:
+                    if child_id not in seen:
+                        seen.add(child_id)
+                        next_level.append(child_id)
+
+        yield from self._fetch_contents(pool, notes, known_versions)
+
+    def _fetch_contents(self, pool: ThreadPoolExecutor, notes: List[Dict[str, Any]],
+                        known_versions: Dict[str, str]) -> Iterator[Dict[str, Any]]:
+        """并发拉取一组笔记的内容，修改时间未变的笔记只产出占位条目.
+
+        Args:
+            pool: 共享的线程池.
+            notes: 笔记元数据.
+            known_versions: 已索引笔记的修改时间.
+
+        Yields:
+            文档字典.
+        """
+        to_fetch = []
+        for note in notes:
+            note_id = note.get('noteId')
+            # 搜索结果同样带有父笔记，解析祖先时无需再请求
+            self._parents.setdefault(note_id, list(note.get('parentNoteIds') or []))
+            if note.get('type') not in TEXT_NOTE_TYPES or note.get('isProtected'):
+                continue
+            utc_date_modified = note.get('utcDateModified')
+            if utc_date_modified and known_versions.get(note_id) == utc_date_modified:
+                # 祖先和属性来自已拉取的元数据，移动笔记或修改标签不会改变修改时间
+                yield {
+                    'title': note.get('title', ''),
+                    'note_id': note_id,
+                    'utc_date_modified': utc_date_modified,
+                    'unchanged': True,
+                    'ancestors': self._ancestors(note_id),
+                    'attributes': self._attributes(note)
+                }
+                continue
+            to_fetch.append(note)
+
+        start = time.perf_counter()
+        contents = list(pool.map(self.get_note_content, [note['noteId'] for note in to_fetch]))
+        self.timings["content"] += time.perf_counter() - start
+
+        for note, content in zip(to_fetch, contents):
+            if not content or not content.strip():
+                continue
+            note_id = note['noteId']
+            yield {
+                'content': content,
+                'title': note.get('title') or f"笔记 {note_id}",
+                'note_id': note_id,
+                'utc_date_modified': note.get('utcDateModified'),
+                'mime': note.get('mime'),
+                'ancestors': self._ancestors(note_id),
+                'attributes': self._attributes(note)
+            }
+
+    def iter_notes(self, note_ids: List[str],
+                   known_versions: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+        """按页拉取指定笔记（不遍历子笔记）.
+
+        Args:
+            note_ids: 笔记ID.
+            known_versions: 已索引笔记的修改时间.
+
+        Yields:
+            文档字典.
+        """
+        known_versions = known_versions or {}
+        self._reset_tree()
+        seen = set(note_ids)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="trilium-fetch") as pool:
+            for offset in range(0, len(note_ids), self.page_size):
+                page = note_ids[offset:offset + self.page_size]
+                yield from self._fetch_page(pool, page, False, seen, [], known_versions)
+
+    def search_notes(self, search: str, ancestor_note_id: Optional[str] = None,
+                     order_by: Optional[str] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """使用ETAPI搜索笔记.
+
+        Args:
+            search: Trilium搜索表达式.
+            ancestor_note_id: 只在该笔记的子树中搜索.
+            order_by: 排序字段（升序）.
+            limit: 最大结果数.
+
+        Returns:
+            笔记元数据列表.
+
+        Raises:
+            requests.RequestException: 请求失败.
+        """
+        # 子树遍历包含已归档的笔记，搜索也要包含，否则增量同步与完整导入的范围不一致
+        params: Dict[str, Any] = {"search": search, "fastSearch": "false", "includeArchivedNotes": "true"}
+        if ancestor_note_id:
+            params["ancestorNoteId"] = ancestor_note_id
+        if order_by:
+            params["orderBy"] = order_by
+            params["orderDirection"] = "asc"
+        if limit:
+            params["limit"] = limit
+        return self._get("/notes", params=params).json().get("results", [])
+
+    def iter_modified_since(
+        self,
+        root_ids: List[str],
+        since: str,
+        known_versions: Optional[Dict[str, str]] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """返回各子树中 utcDateModified 不早于 since 的笔记.
+
+        按修改时间升序分页搜索，只为真正变化的笔记拉取内容，
+        因此开销与变更数量成正比，而不是与知识库规模成正比。
+        移动笔记、增删克隆或修改标签不会改变 utcDateModified，ETAPI也不能按
+        分支或属性的修改时间搜索，这类变化由定期的完整遍历发现。
+
+        Args:
+            root_ids: 子树根笔记ID.
+            since: 水位线，Trilium的UTC时间字符串.
+            known_versions: 已索引笔记的修改时间.
+
+        Yields:
+            文档字典.
+
+        Raises:
+            requests.RequestException: 搜索请求失败.
+        """
+        known_versions = known_versions or {}
+        self._reset_tree()
+        seen = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="trilium-fetch") as pool:
+            for root_id in root_ids:
+                watermark = since
+                limit = self.page_size
+                while True:
+                    start = time.perf_counter()
+                    results = self.search_notes(
+                        f"note.utcDateModified >= '{watermark}'",
+                        ancestor_note_id=root_id,
+                        order_by="utcDateModified",
+                        limit=limit
+                    )
+                    self.timings["metadata"] += time.perf_counter() - start
+
+                    notes = [note for note in results if note.get('noteId') not in seen]
+                    seen.update(note.get('noteId') for note in notes)
+                    yield from self._fetch_contents(pool, notes, known_versions)
+
+                    if len(results) < limit:
+                        break
+                    last_modified = results[-1].get('utcDateModified') or watermark
+                    if last_modified == watermark:
+                        # 整页都是同一时间戳，扩大页面以越过该时间点
+                        limit *= 2
+                    else:
+                        watermark = last_modified
+                        limit = self.page_size
+
+    def iter_subtree_ids(self, root_ids: List[str]) -> Iterator[str]:
+        """只拉取元数据，遍历子树中所有可索引笔记的ID.
+
+        Args:
+            root_ids: 子树根笔记ID.
+
+        Yields:
+            笔记ID.
+        """
+        seen = set(root_ids)
+        level = list(dict.fromkeys(root_ids))
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="trilium-fetch") as pool:
+            while level:
+                next_level = []
+                for offset in range(0, len(level), self.page_size):
+                    page = level[offset:offset + self.page_size]
+                    start = time.perf_counter()
+                    notes = [note for note in pool.map(self.get_note, page) if note]
+                    self.timings["metadata"] += time.perf_counter() - start
+                    for note in notes:
+                        for child_id in note.get('childNoteIds') or []:
+                            if child_id not in seen:
+                                seen.add(child_id)
+                                next_level.append(child_id)
+                        if note.get('type') in TEXT_NOTE_TYPES and not note.get('isProtected'):
+                            yield note['noteId']
+                level = next_level
+
+    def close(self) -> None:
+        """关闭HTTP会话."""
+        self.session.close()
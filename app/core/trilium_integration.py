@@ -4,9 +4,16 @@
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from app.core.config import Config
-from typing import List, Dict, Any, Optional
+from app.core.trilium_db_reader import TriliumDatabaseReader
+from app.core.trilium_fetcher import TriliumFetcher
+from typing import Any, Callable, Dict, Iterator, List, Optional
 from trilium_py.client import ETAPI
 import os
+import threading
+import time
+
+# Trilium数据目录中的SQLite数据库文件名（同名前缀的-wal/-journal文件也算）
+TRILIUM_DB_FILENAME = "document.db"
 
 
 class TriliumService:
@@ -22,9 +29,23 @@ class TriliumService:
         self.token = config.trilium_token or ""
         self.note_ids = config.note_ids or ['root']
         self.data_dir = config.trilium_data_dir or "."
+        # 最近一次加载是否完整地来自Trilium（示例文档不算）
+        self.last_load_complete = False
+        
+        # 直接读取本地 document.db 的批量加载器，与Trilium部署在同一台机器时使用
+        self.db_reader = None
+        if config.trilium_loader == "sqlite":
+            db_path = os.path.join(self.data_dir, TRILIUM_DB_FILENAME)
+            if os.path.exists(db_path):
+                self.db_reader = TriliumDatabaseReader(db_path, page_size=config.ingest_batch_size)
+                print(f"使用本地Trilium数据库加载文档: {db_path}")
+            else:
+                print(f"Trilium数据库不存在，回退到ETAPI: {db_path}")
         
         # 初始化Trilium客户端
-        if self.base_url and self.token:
+        if self.db_reader:
+            self.client = None
+        elif self.base_url and self.token:
             try:
                 self.client = ETAPI(server_url=self.base_url, token=self.token)
                 print("Trilium客户端初始化成功")
@@ -44,38 +65,51 @@ class TriliumService:
             self.client = None
             print("Trilium配置不完整，部分功能可能不可用")
         
-        # 设置文件系统监控
-        try:
-            self.event_handler = TriliumChangeHandler(self)
-            self.observer = Observer()
-            self.observer.schedule(
-                self.event_handler,
-                path=self.data_dir,
-                recursive=True
+        # 并发拉取引擎，批量加载文档时使用
+        self.fetcher = None
+        if self.client:
+            self.fetcher = TriliumFetcher(
+                self.base_url,
+                self.token,
+                concurrency=config.trilium_fetch_concurrency,
+                max_retries=config.trilium_fetch_retries,
+                backoff=config.trilium_fetch_backoff,
+                rate_limit=config.trilium_rate_limit,
+                timeout=config.trilium_timeout,
+                page_size=config.ingest_batch_size
             )
-            self.observer.start()
-        except Exception as e:
-            print(f"文件系统监控初始化失败: {e}")
     
-    def load_documents(self) -> List[Dict[str, Any]]:
+    @property
+    def loader(self):
+        """当前使用的批量加载器：本地数据库读取器或ETAPI拉取引擎，均不可用时为None."""
+        return self.db_reader or self.fetcher
+    
+    def load_documents(self, known_versions: Optional[Dict[str, str]] = None) -> List[Dict[str, Any]]:
         """从Trilium加载文档.
         
+        Args:
+            known_versions: 已索引笔记的 note_id 到 utcDateModified 映射.
+                修改时间未变的笔记不会再拉取内容，只返回带 unchanged=True 以及祖先和属性的占位条目.
+        
         Returns:
             从Trilium加载的文档列表.
         """
         documents = []
+        self.last_load_complete = False
         
-        # 如果Trilium客户端可用，尝试加载真实文档
-        if self.client:
+        # 如果Trilium客户端或本地数据库可用，尝试加载真实文档
+        if self.loader:
             try:
                 # 尝试获取一些真实内容
-                self._try_load_real_documents(documents)
+                self._try_load_real_documents(documents, known_versions or {})
                 if documents:
                     print(f"成功从Trilium加载 {len(documents)} 个真实文档")
                     return documents
             except Exception as e:
                 print(f"加载真实Trilium文档时出错: {e}")
         
+        # 示例文档不能用于判断笔记删除
+        self.last_load_complete = False
         # 只有在没有成功加载真实文档时才使用示例文档
         print("加载Trilium文档（使用示例内容）...")
         
@@ -106,77 +140,86 @@ class TriliumService:
         
         return documents
     
-    def _try_load_real_documents(self, documents: List[Dict[str, Any]]) -> None:
-        """尝试加载真实的Trilium文档.
+    def iter_documents(self, known_versions: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+        """流式遍历每个 NOTE_IDS 根笔记下的整棵子树.
+        
+        文档在拉取后立即产出，不在内存中累积。遍历正常结束、没有请求失败且
+        至少产出一个文档时，last_load_complete 被置为True，表示结果可用于判断笔记删除。
+        中途抛出异常或调用方提前停止遍历时保持为False。
         
         Args:
-            documents: 文档列表
+            known_versions: 已索引笔记的修改时间，用于跳过未变化的笔记.
+            
+        Yields:
+            文档字典.
         """
-        if not self.client:
+        self.last_load_complete = False
+        if not self.loader:
             return
+        
+        # 使用配置中指定的note_ids或者默认使用'root'
+        note_ids_to_process = self.note_ids
+        print(f"准备从以下笔记ID加载文档: {note_ids_to_process}")
+        
+        start = time.perf_counter()
+        errors_before = self.loader.error_count
+        count = 0
+        for doc in self.loader.iter_subtree(note_ids_to_process, known_versions=known_versions):
+            count += 1
+            yield doc
+        
+        elapsed = time.perf_counter() - start
+        errors = self.loader.error_count - errors_before
+        # 空结果多半是配置或权限问题，不能据此删除整个索引
+        self.last_load_complete = errors == 0 and count > 0
+        print(
+            f"拉取完成: {count} 个文档，{self.loader.request_count} 次请求，{errors} 次失败，"
+            f"总耗时 {elapsed:.2f} 秒（元数据 {self.loader.timings['metadata']:.2f} 秒，"
+            f"内容 {self.loader.timings['content']:.2f} 秒）"
+        )
+    
+    def iter_changed_documents(self, since: str,
+                               known_versions: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+        """只拉取自水位线以来修改过的笔记.
+        
+        通过ETAPI搜索 utcDateModified 不早于 since 的笔记，开销与变更数量成正比。
+        搜索请求失败时抛出异常；内容请求全部成功时 last_load_complete 被置为True。
+        
+        Args:
+            since: 水位线，Trilium的UTC时间字符串.
+            known_versions: 已索引笔记的修改时间.
             
+        Yields:
+            文档字典.
+        """
+        self.last_load_complete = False
+        if not self.loader:
+            return
+        
+        start = time.perf_counter()
+        errors_before = self.loader.error_count
+        count = 0
+        for doc in self.loader.iter_modified_since(self.note_ids, since, known_versions=known_versions):
+            count += 1
+            yield doc
+        
+        errors = self.loader.error_count - errors_before
+        self.last_load_complete = errors == 0
+        print(
+            f"增量同步拉取完成: 自 {since} 以来 {count} 个文档，{errors} 次失败，"
+            f"耗时 {time.perf_counter() - start:.2f} 秒"
+        )
+    
+    def _try_load_real_documents(self, documents: List[Dict[str, Any]],
+                                 known_versions: Optional[Dict[str, str]] = None) -> None:
+        """尝试加载真实的Trilium文档.
+        
+        Args:
+            documents: 文档列表
+            known_versions: 已索引笔记的修改时间，用于跳过未变化的笔记
+        """
         try:
-            # 使用配置中指定的note_ids或者默认使用'root'
-            note_ids_to_process = self.note_ids
-            print(f"准备从以下笔记ID加载文档: {note_ids_to_process}")
-            
-            for note_id in note_ids_to_process:
-                # 使用 traverse_note_tree 获取笔记树
-                tree_data = self.client.traverse_note_tree(noteId=note_id, depth=3, limit=50)
-                if tree_data:
-                    print(f"从笔记 {note_id} 遍历到 {len(tree_data)} 个笔记项")
-                    # 处理遍历结果
-                    for item in tree_data:
-                        if isinstance(item, dict) and 'noteId' in item:
-                            # 检查是否已添加过该笔记
-                            if any(doc.get('note_id') == item['noteId'] for doc in documents):
-                                continue
-                                
-                            # 获取笔记详细信息
-                            try:
-                                note_detail = self.client.get_note(item['noteId'])
-                                if note_detail and isinstance(note_detail, dict) and 'note' in note_detail:
-                                    note = note_detail['note']
-                                    title = note.get('title', 'Untitled')
-                                    
-                                    # 获取笔记内容
-                                    content = ""
-                                    try:
-                                        content_response = self.client.get_note_content(item['noteId'])
-                                        if content_response and isinstance(content_response, str):
-                                            content = content_response
-                                            print(f"通过 get_note_content 成功获取笔记 {item['noteId']} 内容，长度: {len(content)}")
-                                    except Exception as e:
-                                        print(f"获取笔记 {item['noteId']} 内容时出错: {e}")
-                                        continue
-                                    
-                                    # 如果通过 get_note_content 获取不到内容，则尝试从 note 对象获取
-                                    if not content:
-                                        content = note.get('content', '')
-                                        if content:
-                                            print(f"通过 note 对象获取笔记 {item['noteId']} 内容，长度: {len(content)}")
-                                    
-                                    # 只有当内容不为空且不是字典时才添加到文档列表
-                                    if content and not isinstance(content, dict) and isinstance(content, str) and content.strip():
-                                        documents.append({
-                                            'content': content,
-                                            'title': title if title else f"笔记 {item['noteId']}",
-                                            'note_id': item['noteId'],
-                                            'attributes': []
-                                        })
-                                        print(f"成功添加笔记: {title} ({item['noteId']})")
-                                        
-                                        # 限制文档数量
-                                        if len(documents) >= 30:
-                                            print("达到文档数量上限 (30)")
-                                            return
-                                    elif content and isinstance(content, str):
-                                        print(f"跳过空内容笔记: {title} ({item['noteId']})")
-                                    else:
-                                        print(f"完全无法获取内容: {title} ({item['noteId']})")
-                            except Exception as e:
-                                print(f"处理笔记 {item['noteId']} 时出错: {e}")
-                                continue
+            documents.extend(self.iter_documents(known_versions))
         except Exception as e:
             print(f"尝试加载真实文档时出错: {e}")
             raise
@@ -210,31 +253,203 @@ class TriliumService:
             print(f"获取笔记内容时出错: {e}")
             
         return ""
+
+
+class TriliumSyncPoller:
+    """定期通过ETAPI做增量同步的后台轮询器.
+    
+    每 interval 秒调用一次 on_sync；每隔 full_scan_every 次轮询做一次
+    完整遍历，用于发现被删除、移动、移入子树或标签变化的笔记。适用于Trilium
+    运行在其他机器上、无法监控其数据目录的部署。
+    """
     
-    def update_knowledge_base(self) -> None:
-        """当Trilium笔记更改时更新知识库."""
-        # 触发知识库更新处理
-        print("正在更新知识库...")
+    def __init__(self, interval: float, on_sync: Callable[[bool], Any],
+                 full_scan_every: int = 12) -> None:
+        """初始化轮询器.
+        
+        Args:
+            interval: 轮询间隔秒数.
+            on_sync: 同步回调，参数表示本次是否完整遍历.
+            full_scan_every: 每隔多少次轮询做一次完整比对，0表示从不.
+        """
+        self.interval = interval
+        self.on_sync = on_sync
+        self.full_scan_every = max(0, full_scan_every)
+        self.cycles = 0
+        self.last_error: Optional[str] = None
+        self._thread = None
+        self._stop_event = threading.Event()
+    
+    def start(self) -> bool:
+        """启动轮询线程.
+        
+        Returns:
+            是否成功启动.
+        """
+        if self._thread is not None:
+            return True
+        if self.interval <= 0:
+            return False
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="trilium-sync", daemon=True)
+        self._thread.start()
+        print(f"已启动Trilium增量同步，间隔 {self.interval:g} 秒")
+        return True
+    
+    def _loop(self) -> None:
+        """按间隔执行同步，直到被停止."""
+        while not self._stop_event.wait(self.interval):
+            self.cycles += 1
+            full_scan = bool(self.full_scan_every) and self.cycles % self.full_scan_every == 0
+            try:
+                self.on_sync(full_scan)
+                self.last_error = None
+            except Exception as e:
+                print(f"Trilium增量同步失败: {e}")
+                self.last_error = str(e)
+    
+    def status(self) -> Dict[str, Any]:
+        """返回轮询器状态."""
+        return {
+            "running": self._thread is not None,
+            "interval": self.interval,
+            "cycles": self.cycles,
+            "full_scan_every": self.full_scan_every,
+            "last_error": self.last_error,
+        }
+    
+    def stop(self) -> None:
+        """停止轮询."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
 
 
 class TriliumChangeHandler(FileSystemEventHandler):
     """Trilium文件系统事件的处理程序."""
     
-    def __init__(self, service: TriliumService) -> None:
+    def __init__(self, watcher: "TriliumWatcher") -> None:
         """初始化变更处理器.
         
         Args:
-            service: 要通知变更的Trilium服务.
+            watcher: 要通知变更的数据目录监控器.
         """
-        self.service = service
+        self.watcher = watcher
     
-    def on_modified(self, event) -> None:
-        """处理文件修改事件.
+    def on_any_event(self, event) -> None:
+        """处理文件创建、修改和移动事件.
         
         Args:
             event: 文件系统事件.
         """
-        if "notes" in event.src_path:
-            print(f"检测到知识库更新: {event.src_path}")
-            # 触发知识库更新处理
-            self.service.update_knowledge_base()
\ No newline at end of file
+        if event.is_directory or event.event_type not in ("created", "modified", "moved"):
+            return
+        paths = [event.src_path, getattr(event, "dest_path", "")]
+        # 只关心Trilium的SQLite数据库及其WAL/日志文件
+        if any(path and os.path.basename(path).startswith(TRILIUM_DB_FILENAME) for path in paths):
+            self.watcher.notify(event.src_path)
+
+
+class TriliumWatcher:
+    """长期运行的Trilium数据目录监控器.
+    
+    Trilium每次保存都会产生一连串SQLite/WAL写入。监控器把这些事件合并：
+    最后一次事件之后静默 quiet_period 秒才触发回调；持续写入时最迟在
+    max_delay 秒后触发一次。每个进程只应创建一个实例。
+    """
+    
+    def __init__(self, data_dir: str, on_change: Callable[[], Any],
+                 quiet_period: float = 5.0, max_delay: float = 60.0) -> None:
+        """初始化监控器.
+        
+        Args:
+            data_dir: Trilium数据目录.
+            on_change: 一批变更平息后调用的回调.
+            quiet_period: 静默期秒数.
+            max_delay: 从一批变更的第一个事件起最长等待秒数.
+        """
+        self.data_dir = data_dir
+        self.on_change = on_change
+        self.quiet_period = quiet_period
+        self.max_delay = max(max_delay, quiet_period)
+        self.observer = None
+        self.event_count = 0
+        self.trigger_count = 0
+        self._timer = None
+        self._burst_started = None
+        self._lock = threading.Lock()
+    
+    def start(self) -> bool:
+        """开始监控数据目录.
+        
+        Returns:
+            是否成功启动.
+        """
+        if self.observer is not None:
+            return True
+        if not os.path.isdir(self.data_dir):
+            print(f"Trilium数据目录不存在，跳过文件系统监控: {self.data_dir}")
+            return False
+        try:
+            observer = Observer()
+            observer.schedule(TriliumChangeHandler(self), path=self.data_dir, recursive=True)
+            observer.daemon = True
+            observer.start()
+            self.observer = observer
+            print(f"已开始监控Trilium数据目录: {self.data_dir}")
+            return True
+        except Exception as e:
+            print(f"文件系统监控初始化失败: {e}")
+            return False
+    
+    def notify(self, path: str = "") -> None:
+        """记录一次变更事件并重置静默计时器.
+        
+        Args:
+            path: 发生变化的文件路径.
+        """
+        with self._lock:
+            self.event_count += 1
+            now = time.monotonic()
+            if self._burst_started is None:
+                self._burst_started = now
+                print(f"检测到知识库更新: {path}")
+            if self._timer is not None:
+                self._timer.cancel()
+            delay = min(self.quiet_period, max(0.0, self._burst_started + self.max_delay - now))
+            self._timer = threading.Timer(delay, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+    
+    def _fire(self) -> None:
+        """静默期结束，触发回调."""
+        with self._lock:
+            self._timer = None
+            self._burst_started = None
+            self.trigger_count += 1
+        try:
+            self.on_change()
+        except Exception as e:
+            print(f"处理Trilium变更时出错: {e}")
+    
+    def status(self) -> Dict[str, Any]:
+        """返回监控器状态."""
+        return {
+            "running": self.observer is not None,
+            "data_dir": self.data_dir,
+            "events": self.event_count,
+            "triggers": self.trigger_count,
+            "quiet_period": self.quiet_period,
+        }
+    
+    def stop(self) -> None:
+        """停止监控."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join(timeout=5)
+            self.observer = None
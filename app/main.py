@@ -1,21 +1,43 @@
 # -*- coding: utf-8 -*-
 """Trilium知识库智能体主应用入口."""
 
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 import uvicorn
 
 from app.api.endpoints import router as api_router
 from app.core.config import get_config
+from app.core.metrics import INFERENCE_TASKS, REGISTRY
+from app.core.service_container import ServiceContainer
 
 # 获取配置
 config = get_config()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时加载一次服务组件，关闭时释放."""
+    container = ServiceContainer(config)
+    await run_in_threadpool(container.initialize)
+    container.start_watcher()
+    container.start_sync_poller()
+    app.state.service_container = container
+    try:
+        yield
+    finally:
+        container.shutdown()
+
+
 # 创建FastAPI应用
 app = FastAPI(
     title="Trilium Knowledge Agent",
     description="一个基于FastAPI的应用，用于与Trilium Notes知识库进行交互，使用RAG技术。",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan
 )
 
 # 添加CORS中间件
@@ -43,6 +65,19 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics(request: Request):
+    """以Prometheus文本格式导出各阶段耗时直方图和计数器."""
+    if not config.metrics_enabled:
+        raise HTTPException(status_code=404, detail="指标导出已禁用")
+    container = getattr(request.app.state, "service_container", None)
+    if container is not None:
+        executor_stats = container.executor.stats()
+        INFERENCE_TASKS.set(executor_stats["running"], state="running")
+        INFERENCE_TASKS.set(executor_stats["queued"], state="queued")
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 if __name__ == "__main__":
     uvicorn.run(
         app="app.main:app",
@@ -8,7 +8,7 @@ import requests
 import os
 import copy
 import json
-from typing import Optional
+from typing import Iterator, Optional, Tuple
 
 # 从环境变量获取API URL或使用默认值
 API_URL = os.getenv("API_URL", "http://localhost:8000/api/v1")
@@ -36,6 +36,97 @@ def send_question(question: str) -> Optional[dict]:
             st.error(f"详细错误信息: {e.response.text}")
         return None
 
+def stream_question(question: str) -> Iterator[Tuple[str, object]]:
+    """以Server-Sent Events方式向后端发送问题并逐个返回事件.
+    
+    Args:
+        question: 要发送的问题.
+        
+    Yields:
+        (事件名, 事件数据) 元组，事件名为 sources、token、done 或 error.
+    """
+    with requests.post(
+        f"{API_URL}/ask/stream",
+        json={"question": question},
+        headers={"Content-Type": "application/json", "Accept": "text/event-stream"},
+        stream=True
+    ) as response:
+        response.raise_for_status()
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                event = None
+                continue
+            if line.startswith(":"):
+                # 心跳注释行
+                continue
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:") and event:
+                yield event, json.loads(line[len("data:"):].strip())
+
+
+def render_sources(sources: list) -> None:
+    """在可展开区域中显示来源列表.
+    
+    Args:
+        sources: 后端返回的来源列表.
+    """
+    with st.expander("查看来源"):
+        for source in sources:
+            if isinstance(source, dict):
+                title = source.get("title", "未知标题")
+                url = source.get("url")
+                content = source.get("content", "")
+                if url:
+                    st.markdown(f"**[{title}]({url})**")
+                else:
+                    st.markdown(f"**{title}**")
+                
+                if content:
+                    st.markdown(f"> {content}")
+            else:
+                st.markdown(f"- {source}")
+
+
+def answer_with_stream(prompt: str) -> Optional[dict]:
+    """流式获取回答并在页面上增量渲染.
+    
+    Args:
+        prompt: 用户问题.
+        
+    Returns:
+        包含answer和sources的字典，失败时返回None.
+    """
+    answer = ""
+    sources = []
+    placeholder = st.empty()
+    placeholder.markdown("_正在检索..._")
+    try:
+        for event, data in stream_question(prompt):
+            if event == "sources":
+                sources = data or []
+                placeholder.markdown("_正在生成..._")
+            elif event == "token":
+                answer += data
+                placeholder.markdown(answer + "▌")
+            elif event == "done":
+                answer = data.get("answer", answer)
+            elif event == "error":
+                st.error(f"生成回答时出错: {data.get('detail')}")
+    except requests.exceptions.RequestException as e:
+        st.error(f"连接后端时出错: {e}")
+        if e.response is not None:
+            st.error(f"详细错误信息: {e.response.text}")
+        return None
+    
+    answer = answer or "抱歉，我没有找到答案。"
+    placeholder.markdown(answer)
+    if sources:
+        render_sources(sources)
+    return {"answer": answer, "sources": sources}
+
+
 def main():
     """主Streamlit应用程序."""
     st.set_page_config(
@@ -55,6 +146,7 @@ def main():
     with st.sidebar:
         st.header("⚙️ 设置")
         api_url = st.text_input("API 地址:", value=API_URL)
+        use_stream = st.checkbox("流式输出回答", value=True)
         
         st.header("🗑️ 操作")
         if st.button("清除对话历史"):
@@ -116,6 +208,18 @@ def main():
         
         # 从后端获取响应
         with st.chat_message("assistant"):
+            if use_stream:
+                response = answer_with_stream(prompt)
+                if response:
+                    st.session_state.conversation.append({
+                        "role": "assistant",
+                        "content": response["answer"],
+                        "sources": copy.deepcopy(response["sources"])
+                    })
+                else:
+                    st.error("无法获取回答，请检查后端服务是否正常运行。")
+                return
+            
             with st.spinner("正在思考..."):
                 response = send_question(prompt)
                 
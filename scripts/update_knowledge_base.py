@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 """用于更新知识库的脚本."""
 
+import argparse
 import sys
 import os
+import time
 
 # 将项目根目录添加到路径中
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -10,51 +12,64 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from app.core.config import get_config
 from app.core.trilium_integration import TriliumService
 from app.core.knowledge_base import KnowledgeBase
-from langchain.docstore.document import Document
+from app.core.ingest_pipeline import run_export_ingest, run_trilium_ingest
 
 
-def update_knowledge_base():
-    """使用来自Trilium的最新文档更新知识库."""
+def update_knowledge_base(full: bool = False, export_path: str = None, prune: bool = False,
+                          ancestors: list = None):
+    """使用来自Trilium的最新文档增量更新知识库.
+
+    Args:
+        full: 为True时忽略已记录的修改时间，重新拉取所有笔记内容.
+        export_path: Trilium导出的.zip归档路径；指定时从归档导入，不访问Trilium服务器.
+        prune: 从归档导入时，删除导出子树中归档里已不存在的笔记.
+        ancestors: 从归档导入时，导出根笔记在Trilium中的祖先笔记ID.
+    """
     print("正在更新知识库...")
-    
+    start = time.perf_counter()
+
     # 获取配置
     config = get_config()
-    
+
     # 初始化服务
-    trilium_service = TriliumService(config)
     knowledge_base = KnowledgeBase(config)
-    
-    # 从Trilium加载文档
-    print("正在从Trilium加载文档...")
-    raw_documents = trilium_service.load_documents()
-    
-    # 转换为Document对象
-    documents = []
-    for doc in raw_documents:
-        # 确保标题不为空
-        title = doc.get('title', '未知标题')
-        if not title or title.strip() == "":
-            title = "未知标题"
-            
-        # 创建Document对象
-        document = Document(
-            page_content=doc.get('content', ''),
-            metadata={
-                'title': title,
-                'note_id': doc.get('note_id', ''),
-                'source': f"trilium:{doc.get('note_id', '')}"
-            }
-        )
-        documents.append(document)
-    
-    print(f"已从Trilium加载 {len(documents)} 个文档。")
-    
-    # 更新向量存储
-    print("正在更新向量存储...")
-    knowledge_base.update_vector_store(documents)
-    
-    print("知识库更新成功。")
+
+    if export_path:
+        # 从导出归档流式读取文档，不解压到磁盘
+        print(f"正在从导出归档加载文档并更新向量存储: {export_path}")
+        stats = run_export_ingest(config, knowledge_base, export_path, prune=prune, ancestors=ancestors)
+    else:
+        # 从Trilium流式加载文档并增量更新向量存储
+        trilium_service = TriliumService(config)
+        print("正在从Trilium加载文档并更新向量存储...")
+        stats = run_trilium_ingest(config, knowledge_base, trilium_service, full=full)
+
+    if stats.get("error"):
+        print(f"知识库更新失败: {stats['error']}")
+        return
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"知识库更新成功（耗时 {elapsed:.1f} 秒）: "
+        f"新增 {stats['added']}，更新 {stats['updated']}，"
+        f"未变化 {stats['unchanged']}（其中 {stats['retagged']} 个仅更新元数据），删除 {stats['removed']}；"
+        f"写入 {stats['chunks_written']} 个文本块，删除 {stats['chunks_deleted']} 个文本块"
+    )
 
 
 if __name__ == "__main__":
-    update_knowledge_base()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="增量更新Trilium知识库")
+    parser.add_argument("--full", action="store_true", help="重新拉取并比较所有笔记的内容")
+    parser.add_argument("--export", metavar="ZIP", help="从Trilium导出的.zip归档（HTML或Markdown）导入")
+    parser.add_argument(
+        "--prune", action="store_true",
+        help="与 --export 一起使用：删除导出子树中归档里已不存在的笔记（导出整个知识库时默认删除）"
+    )
+    parser.add_argument(
+        "--ancestors", metavar="ID[,ID...]",
+        help="与 --export 一起使用：导出根笔记在Trilium中的所有祖先笔记ID（逗号分隔），"
+             "使按更上层笔记过滤子树时也能检索到导入的笔记"
+    )
+    args = parser.parse_args()
+    ancestors = [note_id.strip() for note_id in (args.ancestors or "").split(",") if note_id.strip()]
+    update_knowledge_base(full=args.full, export_path=args.export, prune=args.prune, ancestors=ancestors)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""IncrementalIndexer 判断笔记内容和过滤元数据变化的测试."""
+
+import os
+
+import pytest
+
+from app.core.config import Config
+from app.core.indexer import IncrementalIndexer, content_hash, filter_digest
+from app.core.note_filters import note_metadata
+
+
+def raw_note(**overrides):
+    """构造一篇加载器返回的原始文档."""
+    raw = {
+        "note_id": "beta",
+        "title": "Beta",
+        "content": "<p>Beta内容</p>",
+        "utc_date_modified": "2024-02-01 00:00:00.000Z",
+        "ancestors": ["alpha", "root"],
+        "attributes": [{"type": "label", "name": "todo", "value": ""}],
+    }
+    raw.update(overrides)
+    return raw
+
+
+@pytest.fixture
+def indexer(tmp_path) -> IncrementalIndexer:
+    """已记录 beta 的一个版本的索引器."""
+    config = Config()
+    config.index_manifest_path = os.path.join(tmp_path, "index_manifest.json")
+    indexer = IncrementalIndexer(config, knowledge_base=None)
+    raw = raw_note()
+    indexer.record_note(
+        "beta",
+        raw["utc_date_modified"],
+        content_hash(raw["title"], raw["content"]),
+        ["beta#0", "beta#1"],
+        filter_digest(note_metadata("beta", raw["ancestors"], raw["attributes"]))
+    )
+    return indexer
+
+
+def placeholder(**overrides):
+    """构造修改时间未变的占位条目."""
+    raw = raw_note(unchanged=True)
+    del raw["content"]
+    raw.update(overrides)
+    return raw
+
+
+def test_unchanged_note_keeps_filters(indexer):
+    assert indexer.check_unchanged(placeholder()) == (True, "")
+    chunk_ids, filters = indexer.check_filters(placeholder())
+
+    assert chunk_ids == []
+    assert filters["ancestors"] == "alpha,root"
+
+
+def test_moved_note_is_retagged_without_reindexing(indexer):
+    moved = placeholder(ancestors=["gamma", "root"])
+
+    assert indexer.check_unchanged(moved)[0]
+    chunk_ids, filters = indexer.check_filters(moved)
+
+    assert chunk_ids == ["beta#0", "beta#1"]
+    assert filters["anc_gamma"] is True
+    assert "anc_alpha" not in filters
+    # 新摘要已记录，再次检查时不再改写
+    assert indexer.check_filters(moved)[0] == []
+
+
+def test_label_change_is_retagged(indexer):
+    relabeled = raw_note(attributes=[{"type": "label", "name": "done", "value": ""}])
+
+    assert indexer.check_unchanged(relabeled)[0]
+    chunk_ids, filters = indexer.check_filters(relabeled)
+
+    assert chunk_ids == ["beta#0", "beta#1"]
+    assert filters["labels"] == "done"
+
+
+def test_content_change_is_reindexed(indexer):
+    unchanged, digest = indexer.check_unchanged(raw_note(content="<p>新内容</p>"))
+
+    assert not unchanged
+    assert digest == content_hash("Beta", "<p>新内容</p>")
+
+
+def test_documents_without_filters_are_not_retagged(indexer):
+    raw = placeholder()
+    del raw["ancestors"]
+    del raw["attributes"]
+
+    assert indexer.check_filters(raw) == ([], {})
+
+
+def test_filter_digest_ignores_ancestor_order():
+    nearest_first = note_metadata("beta", ["alpha", "gamma", "root"], [])
+    other_order = note_metadata("beta", ["gamma", "root", "alpha"], [])
+
+    assert filter_digest(nearest_first) == filter_digest(other_order)
+    assert filter_digest(nearest_first) != filter_digest(note_metadata("beta", ["alpha", "root"], []))
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""TriliumDatabaseReader 对本地 document.db 的读取测试.
+
+夹具按Trilium的表结构构建一个小型数据库，覆盖新版 blobs 和旧版
+note_contents 两种内容布局、克隆和环、已删除和受保护的笔记、标签属性
+以及按修改时间过滤。
+"""
+
+import os
+import sqlite3
+
+import pytest
+
+from app.core.config import Config
+from app.core.trilium_db_reader import TriliumDatabaseReader
+from app.core.trilium_integration import TRILIUM_DB_FILENAME, TriliumService
+
+# (noteId, title, type, mime, isProtected, isDeleted, utcDateModified, content)
+NOTES = [
+    ("root", "root", "text", "text/html", 0, 0, "2024-01-01 00:00:00.000Z", "<p>根笔记</p>"),
+    ("alpha", "Alpha", "text", "text/html", 0, 0, "2024-01-02 00:00:00.000Z", "<p>Alpha内容</p>"),
+    ("beta", "Beta", "text", "text/html", 0, 0, "2024-02-01 00:00:00.000Z", "<p>Beta内容</p>"),
+    ("gamma", "Gamma", "text", "text/html", 0, 0, "2024-01-03 00:00:00.000Z", "<p>Gamma内容</p>"),
+    ("loop", "Loop", "code", "text/x-python", 0, 0, "2024-03-01 00:00:00.000Z", "print('loop')"),
+    ("deleted", "Deleted", "text", "text/html", 0, 1, "2024-03-02 00:00:00.000Z", "<p>已删除</p>"),
+    ("secret", "Secret", "text", "text/html", 1, 0, "2024-03-03 00:00:00.000Z", "加密内容"),
+    ("orphan", "Orphan", "text", "text/html", 0, 0, "2024-03-04 00:00:00.000Z", "<p>分支已删除</p>"),
+    ("picture", "Picture", "image", "image/png", 0, 0, "2024-03-05 00:00:00.000Z", "PNG"),
+    ("blank", "Blank", "text", "text/html", 0, 0, "2024-03-06 00:00:00.000Z", "   "),
+]
+
+# (branchId, noteId, parentNoteId, isDeleted)
+BRANCHES = [
+    ("none_root", "root", "none", 0),
+    ("root_alpha", "alpha", "root", 0),
+    ("root_gamma", "gamma", "root", 0),
+    ("alpha_beta", "beta", "alpha", 0),
+    # beta 的克隆
+    ("gamma_beta", "beta", "gamma", 0),
+    # alpha -> loop -> alpha 构成环
+    ("alpha_loop", "loop", "alpha", 0),
+    ("loop_alpha", "alpha", "loop", 0),
+    ("root_deleted", "deleted", "root", 0),
+    ("root_secret", "secret", "root", 0),
+    ("root_orphan", "orphan", "root", 1),
+    ("root_picture", "picture", "root", 0),
+    ("root_blank", "blank", "root", 0),
+]
+
+# (attributeId, noteId, type, name, value, position, isDeleted)
+ATTRIBUTES = [
+    ("attr_lang", "alpha", "label", "lang", "zh", 20, 0),
+    ("attr_todo", "alpha", "label", "todo", "", 10, 0),
+    ("attr_link", "alpha", "relation", "seeAlso", "gamma", 30, 0),
+    ("attr_old", "alpha", "label", "archived", "", 40, 1),
+]
+
+# 分支和属性的修改时间，早于所有笔记
+TREE_MODIFIED = "2023-12-01 00:00:00.000Z"
+
+INDEXED_IDS = {"root", "alpha", "beta", "gamma", "loop"}
+DOCUMENT_KEYS = {"content", "title", "note_id", "utc_date_modified", "mime", "ancestors", "attributes"}
+
+
+def build_document_db(path: str, layout: str) -> None:
+    """按指定的内容布局写入夹具数据库.
+
+    Args:
+        path: 数据库文件路径.
+        layout: blobs（新版）或 note_contents（旧版）.
+    """
+    conn = sqlite3.connect(path)
+    blob_column = ", blobId TEXT" if layout == "blobs" else ""
+    conn.execute(
+        "CREATE TABLE notes (noteId TEXT PRIMARY KEY, title TEXT, type TEXT, mime TEXT,"
+        f" isProtected INTEGER, isDeleted INTEGER, utcDateModified TEXT{blob_column})"
+    )
+    conn.execute(
+        "CREATE TABLE branches (branchId TEXT PRIMARY KEY, noteId TEXT, parentNoteId TEXT,"
+        " notePosition INTEGER DEFAULT 0, isDeleted INTEGER,"
+        f" utcDateModified TEXT DEFAULT '{TREE_MODIFIED}')"
+    )
+    conn.execute(
+        "CREATE TABLE attributes (attributeId TEXT PRIMARY KEY, noteId TEXT, type TEXT, name TEXT,"
+        " value TEXT, position INTEGER, isDeleted INTEGER,"
+        f" utcDateModified TEXT DEFAULT '{TREE_MODIFIED}')"
+    )
+    if layout == "blobs":
+        conn.execute("CREATE TABLE blobs (blobId TEXT PRIMARY KEY, content TEXT)")
+    else:
+        conn.execute("CREATE TABLE note_contents (noteId TEXT PRIMARY KEY, content TEXT)")
+
+    for note_id, title, note_type, mime, protected, deleted, modified, content in NOTES:
+        if layout == "blobs":
+            conn.execute(
+                "INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (note_id, title, note_type, mime, protected, deleted, modified, f"blob_{note_id}")
+            )
+            # 新版把内容存为BLOB
+            conn.execute("INSERT INTO blobs VALUES (?, ?)", (f"blob_{note_id}", content.encode("utf-8")))
+        else:
+            conn.execute(
+                "INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (note_id, title, note_type, mime, protected, deleted, modified)
+            )
+            conn.execute("INSERT INTO note_contents VALUES (?, ?)", (note_id, content))
+    conn.executemany("INSERT INTO branches (branchId, noteId, parentNoteId, isDeleted) VALUES (?, ?, ?, ?)",
+                     BRANCHES)
+    conn.executemany(
+        "INSERT INTO attributes (attributeId, noteId, type, name, value, position, isDeleted)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ATTRIBUTES
+    )
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture(params=["blobs", "note_contents"])
+def data_dir(request, tmp_path) -> str:
+    """包含 document.db 的Trilium数据目录，分别使用两种内容布局."""
+    build_document_db(os.path.join(tmp_path, TRILIUM_DB_FILENAME), request.param)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def reader(data_dir) -> TriliumDatabaseReader:
+    """使用较小页大小的读取器，使夹具跨越多页."""
+    return TriliumDatabaseReader(os.path.join(data_dir, TRILIUM_DB_FILENAME), page_size=2)
+
+
+def by_id(documents):
+    """按笔记ID索引文档."""
+    return {doc["note_id"]: doc for doc in documents}
+
+
+def test_subtree_skips_deleted_protected_and_unindexable_notes(reader):
+    documents = list(reader.iter_subtree(["root"]))
+    note_ids = [doc["note_id"] for doc in documents]
+
+    # 克隆和环不产生重复文档
+    assert sorted(note_ids) == sorted(INDEXED_IDS)
+    assert reader.error_count == 0
+    for doc in documents:
+        assert set(doc) == DOCUMENT_KEYS
+
+
+def test_documents_are_ordered_by_modification_time(reader):
+    documents = list(reader.iter_subtree(["root"]))
+
+    modified = [doc["utc_date_modified"] for doc in documents]
+    assert modified == sorted(modified)
+
+
+def test_content_and_metadata(reader):
+    documents = by_id(reader.iter_subtree(["root"]))
+
+    assert documents["beta"]["content"] == "<p>Beta内容</p>"
+    assert documents["beta"]["title"] == "Beta"
+    assert documents["loop"]["mime"] == "text/x-python"
+    assert documents["loop"]["content"] == "print('loop')"
+
+
+def test_ancestors_follow_clones_and_cycles(reader):
+    documents = by_id(reader.iter_subtree(["root"]))
+
+    # beta 同时位于 alpha 和 gamma 之下，alpha 又经由环挂在 loop 之下
+    assert set(documents["beta"]["ancestors"]) == {"alpha", "gamma", "loop", "root"}
+    assert set(documents["alpha"]["ancestors"]) == {"root", "loop"}
+    assert documents["root"]["ancestors"] == []
+
+
+def test_attributes_are_ordered_and_exclude_deleted(reader):
+    documents = by_id(reader.iter_subtree(["root"]))
+
+    assert documents["alpha"]["attributes"] == [
+        {"type": "label", "name": "todo", "value": ""},
+        {"type": "label", "name": "lang", "value": "zh"},
+        {"type": "relation", "name": "seeAlso", "value": "gamma"},
+    ]
+    assert documents["beta"]["attributes"] == []
+
+
+def test_subtree_of_inner_note(reader):
+    documents = by_id(reader.iter_subtree(["gamma"]))
+
+    assert set(documents) == {"gamma", "beta"}
+
+
+def test_since_filter(reader):
+    documents = list(reader.iter_modified_since(["root"], "2024-02-01 00:00:00.000Z"))
+
+    assert sorted(doc["note_id"] for doc in documents) == ["beta", "loop"]
+
+
+def test_since_filter_includes_moved_notes_and_descendants(data_dir, reader):
+    conn = sqlite3.connect(os.path.join(data_dir, TRILIUM_DB_FILENAME))
+    # 把 gamma 移到 alpha 之下：旧分支被删除，新分支被创建
+    conn.execute(
+        "UPDATE branches SET isDeleted = 1, utcDateModified = '2024-04-01 00:00:00.000Z'"
+        " WHERE branchId = 'root_gamma'"
+    )
+    conn.execute(
+        "INSERT INTO branches (branchId, noteId, parentNoteId, isDeleted, utcDateModified)"
+        " VALUES ('alpha_gamma', 'gamma', 'alpha', 0, '2024-04-01 00:00:00.000Z')"
+    )
+    conn.commit()
+    conn.close()
+
+    documents = by_id(reader.iter_modified_since(["root"], "2024-04-01 00:00:00.000Z"))
+
+    assert set(documents) == {"gamma", "beta"}
+    assert "root" in documents["gamma"]["ancestors"] and "alpha" in documents["gamma"]["ancestors"]
+
+
+def test_since_filter_includes_attribute_changes(data_dir, reader):
+    conn = sqlite3.connect(os.path.join(data_dir, TRILIUM_DB_FILENAME))
+    conn.execute(
+        "INSERT INTO attributes (attributeId, noteId, type, name, value, position, isDeleted, utcDateModified)"
+        " VALUES ('attr_new', 'gamma', 'label', 'review', '', 10, 0, '2024-04-01 00:00:00.000Z')"
+    )
+    conn.commit()
+    conn.close()
+
+    documents = by_id(reader.iter_modified_since(["root"], "2024-04-01 00:00:00.000Z"))
+
+    assert set(documents) == {"gamma"}
+    assert documents["gamma"]["attributes"] == [{"type": "label", "name": "review", "value": ""}]
+
+
+def test_known_versions_skip_content(reader):
+    known = {"beta": "2024-02-01 00:00:00.000Z", "gamma": "2023-12-31 00:00:00.000Z"}
+    documents = by_id(reader.iter_subtree(["root"], known_versions=known))
+
+    placeholder = documents["beta"]
+    assert "content" not in placeholder
+    assert placeholder["unchanged"] is True
+    assert placeholder["utc_date_modified"] == "2024-02-01 00:00:00.000Z"
+    # 占位条目仍然带有祖先和属性，用于发现移动和标签变化
+    assert set(placeholder["ancestors"]) == {"alpha", "gamma", "loop", "root"}
+    assert placeholder["attributes"] == []
+    # 修改时间不同的笔记仍然读取内容
+    assert documents["gamma"]["content"] == "<p>Gamma内容</p>"
+
+
+def test_iter_notes_does_not_expand_children(reader):
+    documents = by_id(reader.iter_notes(["alpha", "deleted", "secret", "missing"]))
+
+    assert set(documents) == {"alpha"}
+    assert set(documents["alpha"]["ancestors"]) == {"root", "loop"}
+
+
+def test_subtree_ids(reader):
+    assert set(reader.iter_subtree_ids(["root"])) == INDEXED_IDS | {"blank"}
+
+
+def test_matches_trilium_service_load_documents(data_dir, reader):
+    config = Config()
+    config.trilium_loader = "sqlite"
+    config.trilium_data_dir = data_dir
+    config.note_ids = ["root"]
+    config.trilium_base_url = ""
+    config.trilium_token = ""
+    service = TriliumService(config)
+
+    assert service.db_reader is not None
+    documents = service.load_documents()
+
+    assert documents == list(reader.iter_subtree(["root"]))
+    assert service.last_load_complete